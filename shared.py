@@ -40,6 +40,7 @@ import pwd
 import uuid
 import time
 import glob
+import math
 import errno
 import ctypes
 import base64
@@ -47,12 +48,17 @@ import shutil
 import string
 import signal
 import hashlib
+import fcntl
+import mmap
+import struct
 import subprocess
 import StringIO
+import cPickle
 import urllib
 import datetime
 import tempfile
 import socket
+import threading
 import stat
 
 import pycurl
@@ -73,7 +79,9 @@ class VacError(Exception):
 # 01.01 has daemon_* and processor renames 
 # 01.02 adds num_processors to machine_status
 # 01.03 adds machine_model to machine_status 
-vacQueryVersion = '01.03'
+# 01.04 adds cycle_timings to factory_status
+# 01.05 adds max_payload_bytes to machines_query and machine_status_list replies
+vacQueryVersion = '01.05'
 
 vmModels = [ 'cernvm3', 'cernvm4', 'vm-raw' ] # Virtual Machine models
 dcModels = [ 'docker' ]                       # Docker Container models
@@ -90,6 +98,7 @@ mjfAddress          = '169.254.169.253'
 factoryAddress      = mjfAddress
 dummyAddress        = metaAddress
 udpBufferSize       = 16777216
+maxPayloadBytes     = 1400 # for VacQuery replies with several records, to fit in one Ethernet frame
 gbDiskPerProcessorDefault = 40
 singularityUser     = None
 singularityUid      = None
@@ -98,6 +107,12 @@ cpuCgroupFsRoot     = None
 memoryCgroupFsRoot  = None
 
 overloadPerProcessor = None
+creationsPerCycle = None
+creationsPerMinute = None
+prestageSlots = None
+imageRevalidateSeconds = None
+imageCacheGB = None
+proxyKeyBits = None
 gocdbSitename = None
 gocdbCertFile = None
 gocdbKeyFile = None
@@ -128,6 +143,9 @@ vacmons = None
 rootPublicKeyFile = None
 
 volumeGroup = None
+volumeGroupMode = None
+thinPool = None
+volumeGroupModel = None
 gbDiskPerProcessor = None
 machinefeaturesOptions = None
 
@@ -137,10 +155,20 @@ def readConf(includePipes = False, updatePipes = False, checkVolumeGroup = False
              numMachineSlots, numProcessors, processorCount, spaceName, spaceDesc, udpTimeoutSeconds, vacVersion, \
              processorsPerSuperslot, versionLogger, machinetypes, vacmons, rootPublicKeyFile, \
              singularityUser, singularityUid, singularityGid, \
-             volumeGroup, gbDiskPerProcessor, overloadPerProcessor, fixNetworking, machinefeaturesOptions
+             volumeGroup, gbDiskPerProcessor, overloadPerProcessor, fixNetworking, machinefeaturesOptions, \
+             creationsPerCycle, creationsPerMinute, prestageSlots, volumeGroupMode, thinPool, \
+             volumeGroupModel, imageRevalidateSeconds, imageCacheGB, proxyKeyBits, \
+             confSnapshotSignature
 
       # reset to defaults
+      confSnapshotSignature = None
       overloadPerProcessor = 1.25
+      creationsPerCycle = 4
+      creationsPerMinute = 4
+      prestageSlots = 0
+      imageRevalidateSeconds = 600
+      imageCacheGB = None
+      proxyKeyBits = 2048
       gocdbSitename = None
       gocdbCertFile = None
       gocdbKeyFile = None
@@ -169,6 +197,8 @@ def readConf(includePipes = False, updatePipes = False, checkVolumeGroup = False
       singularityUser = None
         
       volumeGroup = None
+      volumeGroupMode = 'plain'
+      thinPool = 'vac_thin_pool'
       machinefeaturesOptions = {}
       
       # Temporary dictionary of common user_data_option_XXX 
@@ -257,6 +287,49 @@ def readConf(includePipes = False, updatePipes = False, checkVolumeGroup = False
       elif parser.has_option('settings', 'overload_per_processor'):
           # Multiplier to calculate overload veto against creating more VMs
           overloadPerProcessor = float(parser.get('settings','overload_per_processor'))
+
+      if parser.has_option('settings', 'creations_per_cycle'):
+          # Maximum number of LMs to create in parallel in one cycle
+          try:
+            creationsPerCycle = int(parser.get('settings','creations_per_cycle').strip())
+          except:
+            return 'Failed to parse creations_per_cycle (must be an integer)'
+
+      if parser.has_option('settings', 'creations_per_minute'):
+          # Maximum number of LMs created in any 60 seconds, across cycles
+          try:
+            creationsPerMinute = int(parser.get('settings','creations_per_minute').strip())
+          except:
+            return 'Failed to parse creations_per_minute (must be an integer)'
+
+      if parser.has_option('settings', 'prestage_slots'):
+          # How many free slots to prepare in advance for the next LMs
+          try:
+            prestageSlots = int(parser.get('settings','prestage_slots').strip())
+          except:
+            return 'Failed to parse prestage_slots (must be an integer)'
+
+      if parser.has_option('settings', 'image_revalidate_seconds'):
+          # How often the background image manager checks root_image URLs for new versions
+          try:
+            imageRevalidateSeconds = int(parser.get('settings','image_revalidate_seconds').strip())
+          except:
+            return 'Failed to parse image_revalidate_seconds (must be an integer)'
+
+      if parser.has_option('settings', 'image_cache_gb'):
+          # Images not in use are removed, least recently used first, to keep 
+          # /var/lib/vac/imagecache below this size
+          try:
+            imageCacheGB = float(parser.get('settings','image_cache_gb').strip())
+          except:
+            return 'Failed to parse image_cache_gb (must be a number)'
+
+      if parser.has_option('settings', 'proxy_key_bits'):
+          # Size of the RSA keys of proxies made for user_data_proxy = True
+          try:
+            proxyKeyBits = int(parser.get('settings','proxy_key_bits').strip())
+          except:
+            return 'Failed to parse proxy_key_bits (must be an integer)'
              
       if parser.has_option('settings', 'singularity_user'):
           singularityUser = parser.get('settings','singularity_user').strip()
@@ -274,11 +347,28 @@ def readConf(includePipes = False, updatePipes = False, checkVolumeGroup = False
           # Volume group to search for logical volumes 
           volumeGroup = parser.get('settings','volume_group').strip()
 
+      if parser.has_option('settings', 'volume_group_mode'):
+          # plain creates and removes a logical volume for each LM, pool reuses them,
+          # and thin makes snapshots of formatted templates in an LVM thin pool
+          volumeGroupMode = parser.get('settings','volume_group_mode').strip().lower()
+
+          if volumeGroupMode not in [ 'plain', 'pool', 'thin' ]:
+            return 'volume_group_mode must be plain, pool or thin'
+
+      if parser.has_option('settings', 'thin_pool'):
+          thinPool = parser.get('settings','thin_pool').strip()
+
       if checkVolumeGroup:
+          # Reload the model of the volume group once per cycle
+          volumeGroupModel = None
+
           if volumeGroup:
             if not measureVolumeGroup(volumeGroup):
               # If volume_group is given, then it must exist
               return 'Specified volume_group %s does not exist!' % volumeGroup
+
+            if volumeGroupMode == 'thin' and thinPool not in volumeGroupModel['volumes']:
+              return 'Specified thin_pool %s does not exist in volume_group %s!' % (thinPool, volumeGroup)
           elif measureVolumeGroup('vac_volume_group'):
               # If volume_group is not given, then it's ok if default does not exist
               # but we use it if it does exist
@@ -756,6 +846,95 @@ def readConf(includePipes = False, updatePipes = False, checkVolumeGroup = False
       # Finished successfully, with no error to return
       return None
 
+# Module globals which readConf() sets from the configuration, and which are
+# kept in the configuration snapshot. volumeGroupModel is measured, not read
+confStateNames = [ 'gocdbSitename', 'gocdbCertFile', 'gocdbKeyFile', 'factories', 'hs06PerProcessor',
+                   'mbPerProcessor', 'fixNetworking', 'forwardDev', 'shutdownTime', 'draining',
+                   'numMachineSlots', 'numProcessors', 'processorCount', 'spaceName', 'spaceDesc',
+                   'udpTimeoutSeconds', 'vacVersion', 'processorsPerSuperslot', 'versionLogger',
+                   'machinetypes', 'vacmons', 'rootPublicKeyFile', 'singularityUser', 'singularityUid',
+                   'singularityGid', 'volumeGroup', 'gbDiskPerProcessor', 'overloadPerProcessor',
+                   'machinefeaturesOptions', 'creationsPerCycle', 'creationsPerMinute', 'prestageSlots',
+                   'volumeGroupMode', 'thinPool', 'imageRevalidateSeconds', 'imageCacheGB', 'proxyKeyBits' ]
+
+# Signature of the inputs the configuration globals were last loaded from
+confSnapshotSignature = None
+
+def confInputsSignature(includePipes = False):
+   # Signatures of every file readConf() reads, so that editing any of the
+   # configuration files, or vacd-factory updating a cached pipe, changes it.
+   # /proc/cpuinfo does not change while we are running so is not included
+   paths = [ '/var/lib/vac/VERSION', '/etc/vac.d', '/etc/vac.conf', '/var/run/vac.conf' ]
+
+   try:
+     confFiles = os.listdir('/etc/vac.d')
+   except:
+     pass
+   else:
+     for oneFile in sorted(confFiles):
+       if oneFile[-5:] == '.conf':
+         paths.append('/etc/vac.d/' + oneFile)
+
+   if includePipes:
+     paths.append('/var/lib/vac/pipescache')
+
+     try:
+       pipeFiles = os.listdir('/var/lib/vac/pipescache')
+     except:
+       pass
+     else:
+       for oneFile in sorted(pipeFiles):
+         paths.append('/var/lib/vac/pipescache/' + oneFile)
+
+   return [ os.uname()[1], includePipes ] + [ (path, pathSignature(path)) for path in paths ]
+
+def readConfSnapshot(includePipes = False):
+   # Load the configuration globals as readConf() would without updating 
+   # pipes, checking the volume group, or printing. If none of the inputs
+   # have changed since the last call in this process then nothing is done, 
+   # and otherwise the snapshot saved in /var/lib/vac by the last process to
+   # parse these inputs is used. Only if that is stale is readConf() run.
+   global confSnapshotSignature
+
+   signature = confInputsSignature(includePipes)
+
+   if signature == confSnapshotSignature:
+     return None
+
+   if includePipes:
+     snapshotFile = '/var/lib/vac/conf-snapshot-pipes'
+   else:
+     snapshotFile = '/var/lib/vac/conf-snapshot'
+
+   try:
+     f = open(snapshotFile, 'rb')
+     savedSignature, savedValues = cPickle.load(f)
+     f.close()
+   except:
+     pass
+   else:
+     if savedSignature == signature:
+       globals().update(savedValues)
+       confSnapshotSignature = signature
+       return None
+
+   readConfError = readConf(includePipes = includePipes)
+
+   if readConfError:
+     # Parse again next time, in case the error is fixed
+     return readConfError
+
+   confSnapshotSignature = signature
+
+   # The vac command may be run by users who cannot save the snapshot
+   if os.access('/var/lib/vac/tmp', os.W_OK):
+     vac.vacutils.createFile(snapshotFile,
+                             cPickle.dumps((signature, dict([ (name, globals()[name]) for name in confStateNames ])), cPickle.HIGHEST_PROTOCOL),
+                             stat.S_IWUSR + stat.S_IRUSR + stat.S_IRGRP + stat.S_IROTH,
+                             '/var/lib/vac/tmp')
+
+   return None
+
 def nameFromOrdinal(ordinal):
       nameParts = os.uname()[1].split('.',1)
       return nameParts[0] + '-%02d' % ordinal + '.' + nameParts[1]
@@ -878,14 +1057,169 @@ def canonicalFQDN(hostName):
      # If failed, then just return what we were given
      return hostName
 
+# One libvirt connection and one snapshot of all domains is shared
+# by everything in a cycle, rather than each slot opening its own
+libvirtConn  = None
+domainsStats = None
+
+def getLibvirtConn():
+   global libvirtConn
+
+   if libvirtConn is not None:
+     try:
+       if libvirtConn.isAlive():
+         return libvirtConn
+     except:
+       pass
+
+     closeLibvirtConn()
+
+   try:
+     libvirtConn = libvirt.open(None)
+   except Exception as e:
+     raise VacError('exception when opening connection to the hypervisor (' + str(e) + ')')
+
+   if libvirtConn is None:
+     raise VacError('failed to open connection to the hypervisor')
+
+   return libvirtConn
+
+def closeLibvirtConn():
+   global libvirtConn, domainsStats
+
+   domainsStats = None
+
+   if libvirtConn is not None:
+     try:
+       libvirtConn.close()
+     except:
+       pass
+
+     libvirtConn = None
+
+def getDomainsStats():
+   # Return a dictionary of libvirt domains, keyed by domain name, with the
+   # domain object, its state, and its total CPU seconds. These are fetched
+   # in one bulk call the first time they are needed in each cycle
+   global domainsStats
+
+   if domainsStats is not None:
+     return domainsStats
+
+   conn = getLibvirtConn()
+   stats = {}
+
+   try:
+     for (dom, domStats) in conn.getAllDomainStats(libvirt.VIR_DOMAIN_STATS_STATE | libvirt.VIR_DOMAIN_STATS_CPU_TOTAL):
+       stats[dom.name()] = { 'dom'        : dom,
+                             'state'      : domStats.get('state.state'),
+                             'cpuSeconds' : int(domStats.get('cpu.time', 0) / 1000000000.0) }
+   except Exception as e:
+     # Older libvirt without bulk stats, so ask each domain (still one listing)
+     vac.vacutils.logLine('getAllDomainStats() fails (' + str(e) + '), using listAllDomains()')
+     stats = {}
+
+     for dom in conn.listAllDomains():
+       try:
+         domInfo = dom.info()
+       except:
+         # Domain has gone since listing
+         continue
+
+       stats[dom.name()] = { 'dom'        : dom,
+                             'state'      : domInfo[0],
+                             'cpuSeconds' : int(domInfo[4] / 1000000000.0) }
+
+   domainsStats = stats
+   return domainsStats
+
+def updateDomainsStats(name, dom = None):
+   # Record a domain we have just created, or removed if dom is None
+   if domainsStats is None:
+     return
+
+   if dom is None:
+     domainsStats.pop(name, None)
+   else:
+     domainsStats[name] = { 'dom' : dom, 'state' : libvirt.VIR_DOMAIN_RUNNING, 'cpuSeconds' : 0 }
+
+# VMs which have been sent an ACPI shutdown, keyed by name, with the 
+# domain UUID, the time by which they must have stopped, and any shutdown
+# message to write once they have gone
+pendingShutdowns = {}
+
+# Time allowed for any ACPI handler in the VM before it is destroyed
+acpiShutdownSeconds = 30
+
+def requestShutdown(name, dom, machinesDir = None, shutdownMessage = None):
+   # Ask a VM to shut down, without waiting for it to do so
+
+   try:
+     dom.shutdown()
+   except Exception as e:
+     vac.vacutils.logLine('Failed to shutdown %s (%s) - already gone? paused?' % (name, str(e)))
+     destroyDomain(name, dom)
+     writeShutdownMessage(machinesDir, shutdownMessage)
+   else:
+     pendingShutdowns[name] = { 'uuid'            : dom.UUIDString(), 
+                                'deadline'        : int(time.time()) + acpiShutdownSeconds,
+                                'machinesDir'     : machinesDir,
+                                'shutdownMessage' : shutdownMessage }
+
+def writeShutdownMessage(machinesDir, shutdownMessage):
+   # Record why Vac destroyed a LM once it has gone, unless the LM gave its own reason
+   if machinesDir and shutdownMessage and not os.path.exists(machinesDir + '/joboutputs/shutdown_message'):
+     try:
+       open(machinesDir + '/joboutputs/shutdown_message', 'w').write(shutdownMessage)
+     except:
+       pass
+
+def destroyDomain(name, dom):
+   pendingShutdowns.pop(name, None)
+
+   try:
+     dom.destroy()
+   except Exception as e:
+     vac.vacutils.logLine('Failed to destroy %s (%s)' % (name, str(e)))
+   else:
+     updateDomainsStats(name)
+
+def reapShutdowns():
+   # Check the VMs which have been asked to shut down, and destroy any 
+   # which have passed their deadline. Returns the names of VMs now gone
+
+   reapedNames = []
+
+   if not pendingShutdowns:
+     return reapedNames
+
+   domains = getDomainsStats()
+
+   for name in pendingShutdowns.keys():
+     domStats = domains.get(name)
+     shutdown = pendingShutdowns[name]
+
+     if not domStats or \
+        domStats['state'] == libvirt.VIR_DOMAIN_SHUTOFF or \
+        domStats['dom'].UUIDString() != shutdown['uuid']:
+       vac.vacutils.logLine('VM %s has shut down' % name)
+       del pendingShutdowns[name]
+       writeShutdownMessage(shutdown.get('machinesDir'), shutdown.get('shutdownMessage'))
+       reapedNames.append(name)
+
+     elif int(time.time()) > shutdown['deadline']:
+       vac.vacutils.logLine('VM %s has not shut down within %d seconds - destroying' % (name, acpiShutdownSeconds))
+       destroyDomain(name, domStats['dom'])
+       writeShutdownMessage(shutdown.get('machinesDir'), shutdown.get('shutdownMessage'))
+       reapedNames.append(name)
+
+   return reapedNames
+
 def killZombieVMs():
    # Look for VMs which are not properly associated with
    # logical machine slots and kill them
    
-   conn = libvirt.open(None)
-   if conn == None:
-     vac.vacutils.logLine('Failed to open connection to the hypervisor')
-     raise
+   domains = getDomainsStats()
 
    for ordinal in xrange(numMachineSlots):
       name = nameFromOrdinal(ordinal)
@@ -904,17 +1238,17 @@ def killZombieVMs():
         except:
           uuidStr = None
 
-      try:
-        dom = conn.lookupByName(name)
-      except:
+      if name not in domains:
         # Not running so can continue
         continue
 
+      dom = domains[name]['dom']
+
       killZombie = False
       
       if machineModel not in vmModels:
         # We think a non-VM should be running here
-        vac.vacutils.logLine('VM still running alongside %s LM in slot %s, killing zombie' % (self.machineModel, self.name))
+        vac.vacutils.logLine('VM still running alongside %s LM in slot %s, killing zombie' % (machineModel, name))
         killZombie = True
 
       if uuidStr != dom.UUIDString():
@@ -927,33 +1261,22 @@ def killZombieVMs():
         vac.vacutils.logLine('No created time (or missing machines dir), killing zombie')
         killZombie = True
 
-      if killZombie:
-        try:
-          dom.shutdown()
-        except Exception as e:
-          vac.vacutils.logLine('Failed to shutdown %s (%s)' % (name, str(e)))
-        else:
-          # 30s delay for any ACPI handler in the VM
-          time.sleep(30.0)
-
-        try:
-          dom.destroy()
-        except Exception as e:
-          vac.vacutils.logLine('Failed to destroy %s (%s)' % (name, str(e)))
-             
-   conn.close()
+      if killZombie and name not in pendingShutdowns:
+        # reapShutdowns() destroys it if it does not stop in time
+        requestShutdown(name, dom)
    
 def killZombieDCs():
    # Look for Docker Container processes which are not properly associated with
    # logical machine slots and kill them
    
    try:
-     containers = dockerPsCommand()
+     containers = getDockerContainers()
    except Exception as e:
      vac.vacutils.logLine('Failed to get list of Docker zombie candidates (%s)' % str(e))
      return
 
-   for name in containers: 
+   # Copy of the names, as removing containers updates the snapshot
+   for name in containers.keys(): 
      # Look at this container looking for a mismatch. Unless we continue, remove the container
      
      try:
@@ -1062,235 +1385,532 @@ def killZombieSCs():
 class VacState:
    unknown, shutdown, starting, running, paused, zombie = ('Unknown', 'Shut down', 'Starting', 'Running', 'Paused', 'Zombie')
 
-class VacSlot:
-   # This class represents logical machine slots
+# Table of what we know about each slot from the files in /var/lib/vac/slots
+# and /var/lib/vac/machines, keyed by slot name. vacd-factory keeps this between
+# cycles and each group of values is only read from disk again if the file or
+# directory it came from has changed. VacSlot objects are built from this table.
+slotStates = {}
 
-   def __init__(self, ordinal, forResponder = False):
-      self.ordinal             = ordinal
-      self.name                = nameFromOrdinal(ordinal)
-      self.ip                  = None
-      self.state               = VacState.unknown
-      self.started             = None
-      self.finished            = None
-      self.heartbeat           = None
-      self.joboutputsHeartbeat = None
-      self.cpuSeconds          = 0
-      self.cpuPercentage       = 0
-      self.processors          = 0
-      self.mb                  = 0
-      self.hs06                = None
-      self.accountingFqan      = None
-      self.shutdownMessage     = None
-      self.shutdownMessageTime = None
-      self.created             = None
-      self.machinetypeName     = None
-      self.machineModel        = None
+def pathSignature(path):
+   # Return (inode, mtime, size) of path, or None if it does not exist.
+   # Files in the slots and machines directories are always replaced by
+   # renaming, so any change to a directory's contents changes its mtime
+   try:
+     st = os.stat(path)
+   except:
+     return None
 
-      try:
-        createdStr, self.machinetypeName, self.machineModel = open('/var/lib/vac/slots/' + self.name,'r').read().split()
-        self.created = int(createdStr)
-      except:
-        pass
+   return (st.st_ino, st.st_mtime, st.st_size)
 
-      try:
-        self.cvmfsRepositories = machinetypes[self.machinetypeName]['cvmfs_repositories']
-      except:
-        self.cvmfsRepositories = ''
+def cachedSlotValues(name, groupName, path, readFunction):
+   # Return a dictionary of values for one group of files in slot name, 
+   # using the copy in slotStates unless the signature of path has changed
 
-      try: 
-        self.uuidStr = open(self.machinesDir() + '/jobfeatures/job_id', 'r').read().strip()
-      except:
-        self.uuidStr = None
-                                              
-      if not self.created or not os.path.isdir(self.machinesDir()):
-        # if slot not properly set up or if machines directory is missing then stop now
-        self.state           = VacState.shutdown
-        self.machinetypeName = None
-        self.created         = None
-        return
+   signature = pathSignature(path)
 
-      try:
-        self.started = int(os.stat(self.machinesDir() + '/started').st_ctime)
-        # if created and started, state must be running or shutdown
-      except:
-        # if created but not yet started, then state is starting
-        self.started = None
-        self.state = VacState.starting
+   if signature is None:
+     # Nothing there to read, and nothing to remember
+     slotStates.setdefault(name, {}).pop(groupName, None)
+     return {}
 
-      try:
-        self.ip = open(self.machinesDir() + '/ip', 'r').read().strip()
-      except:
-        pass
+   try:
+     cachedPath, cachedSignature, values = slotStates[name][groupName]
+   except KeyError:
+     pass
+   else:
+     if cachedPath == path and cachedSignature == signature:
+       return values
 
-      try:
-        self.accountingFqan = open(self.machinesDir() + '/accounting_fqan', 'r').read().strip()
-      except:
-        self.accountingFqan = None
+   values = readFunction(path)
 
-      try:
-        self.finished = int(os.stat(self.machinesDir() + '/finished').st_ctime)
-      except:
-        self.finished = None
-      else:
-        self.state = VacState.shutdown
+   if time.time() - signature[1] < 2.0:
+     # Changed too recently to rely on the mtime, as a second change within
+     # the same timestamp tick would be missed. So read it again next time.
+     signature = None
 
-      if self.started and not self.finished:
-        self.state = VacState.running
+   slotStates.setdefault(name, {})[groupName] = (path, signature, values)
+   return values
 
-      try:
-        self.heartbeat = int(os.stat(self.machinesDir() + '/heartbeat').st_ctime)
-      except:
-        self.heartbeat = None
+def updateSlotValues(name, groupName, path, newValues):
+   # Record a change vacd has just made itself to one group of files, so
+   # they are not read back from disk because the directory mtime changed
 
-      try: 
-        self.shutdownTime = int(open(self.machinesDir() + '/jobfeatures/shutdowntime_job', 'r').read().strip())
-      except:
-        self.shutdownTime = None
+   try:
+     cachedPath, cachedSignature, values = slotStates[name][groupName]
+   except KeyError:
+     return
 
-      try:
-        self.joboutputsHeartbeat = int(os.stat(self.machinesDir() + '/joboutputs/' + 
-                                               machinetypes[self.machinetypeName]['heartbeat_file']).st_mtime)
-      except:
-        self.joboutputsHeartbeat = None
+   if cachedPath != path or cachedSignature is None:
+     # We did not have a reliable copy to update anyway
+     return
 
-      try: 
-        self.processors = int(open(self.machinesDir() + '/jobfeatures/allocated_cpu', 'r').read().strip())
-      except:
-        pass
-      
-      try: 
-        self.hs06 = float(open(self.machinesDir() + '/machinefeatures/hs06', 'r').read().strip())
-      except:
-        pass
-      
-      try: 
-        self.mb = (int(open(self.machinesDir() + '/jobfeatures/max_rss_bytes', 'r').read().strip()) / 1048576)
-      except:
-        self.mb = mbPerProcessor * self.processors
-      
-      try:
-        # this is written by Vac as it monitors the logical machine
-        oneLine = open(self.machinesDir() + '/heartbeat', 'r').readline()
-                                    
-        self.cpuSeconds = int(oneLine.split(' ')[0])
-        try:
-          self.cpuPercentage = float(oneLine.split(' ')[1])
-        except:
-          self.cpuPercentage = 0
-                    
-      except:
-        self.cpuSeconds    = 0
-        self.cpuPercentage = 0
- 
-      # Virtual Machine models
-      if not forResponder and self.machineModel in vmModels:
-        dom      = None
-        domState = None
+   values = values.copy()
+   values.update(newValues)
+   slotStates[name][groupName] = (path, pathSignature(path), values)
 
-        conn = libvirt.open(None)
-        if conn == None:
-          vac.vacutils.logLine('Failed to open connection to the hypervisor')
-          raise
+# Module globals which vacd-factory keeps from one cycle to the next
+factoryStateNames = [ 'slotStates', 'pendingShutdowns', 'factoryRoundTrips' ]
 
-        try:
-          dom = conn.lookupByName(self.name)
-          domState = dom.info()[0]
-        except:
-          pass
+def writeFactoryState(fd):
+   # Send the factory state back from a cycle subprocess to vacd-factory
+   try:
+     f = os.fdopen(fd, 'wb')
+     cPickle.dump(dict([ (name, globals()[name]) for name in factoryStateNames ]), f, cPickle.HIGHEST_PROTOCOL)
+     f.close()
+   except Exception as e:
+     vac.vacutils.logLine('Failed to write factory state (' + str(e) + ')')
 
-        conn.close()
+def readFactoryState(fd):
+   # Receive the factory state from a cycle subprocess. If it failed to send 
+   # it then keep what we had, which is checked against the disk anyway
+   try:
+     f = os.fdopen(fd, 'rb')
+     data = f.read()
+     f.close()
+   except Exception as e:
+     vac.vacutils.logLine('Failed to read factory state (' + str(e) + ')')
+     return
 
-        if dom:
-          if domState != libvirt.VIR_DOMAIN_RUNNING and domState != libvirt.VIR_DOMAIN_BLOCKED:
-            # If domain exists, but not Running/Blocked, then say Paused
-            self.state = VacState.paused
-            vac.vacutils.logLine('!!! libvirt state is ' + str(domState) + ', setting VacState.paused !!!')
+   if data:
+     try:
+       globals().update(cPickle.loads(data))
+     except Exception as e:
+       vac.vacutils.logLine('Failed to load factory state (' + str(e) + ')')
 
-          try:
-            # Overwrite with better estimate from hypervisor
-            self.cpuSeconds = int(dom.info()[4] / 1000000000.0)
-          except:
-            pass
+class monotonicTimespec(ctypes.Structure):
+   _fields_ = [ ('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long) ]
 
-        else:
-          # Actually, we're shutdown since VM not really running
-          self.state = VacState.shutdown
+clockGettime = None
 
-      # Singularity Container models
-      if not forResponder and self.machineModel in scModels:
+def monotonicTime():
+   # Seconds from CLOCK_MONOTONIC, which is not changed by setting the system 
+   # clock, or from time.time() if that is not available
+   global clockGettime
 
-        try:
-          pid = int(open(self.machinesDir() + '/pid', 'r').read().strip())
-        except:
-          pid = None
-          uid = None
-        else:
-          try:
-            uid = int(os.stat('/proc/' + str(pid)).st_uid)
-          except:
-            uid = None
+   try:
+     if clockGettime is None:
+       clockGettime = ctypes.CDLL('librt.so.1', use_errno = True).clock_gettime
 
-        if pid is None or uid is None or uid != singularityUid:
-          # Actually, we're shutdown since SC head process is not really running
-          self.state = VacState.shutdown
-        else:
-          try:
-            self.cpuSeconds = int(open(cpuCgroupFsRoot + '/vac/singularity-' + self.uuidStr + '/cpuacct.usage', 'r').read()) / 1000000000
-          except:
-            pass
+     timespec = monotonicTimespec()
+     if clockGettime(1, ctypes.byref(timespec)) == 0: # 1 = CLOCK_MONOTONIC
+       return timespec.tv_sec + timespec.tv_nsec / 1000000000.0
+   except:
+     pass
 
-      # Docker Container models
-      if not forResponder and self.machineModel in dcModels:
-      
-        id    = None          
-        state = None
+   return time.time()
+
+# Time spent in each phase of the current cycle, in seconds
+cyclePhaseTimes = {}
+
+# Set to targeted_ for targeted cycles, so their phases are kept apart
+# from those of full cycles and do not dilute their percentiles
+cyclePhasePrefix = ''
+
+# Number of cycles kept in /var/lib/vac/cycle-timings for each phase
+cycleTimingsSamples = 60
+
+def recordCyclePhase(phaseName, startTime):
+   # Add the time since startTime to phaseName, and return the current 
+   # time so it can be used as the start of the next phase
+   now = monotonicTime()
+   phaseName = cyclePhasePrefix + phaseName
+   cyclePhaseTimes[phaseName] = cyclePhaseTimes.get(phaseName, 0.0) + now - startTime
+   return now
+
+def summariseSamples(samples):
+   # Last value, nearest-rank percentiles, and maximum of a list of samples
+   sortedSamples = sorted(samples)
+   n = len(sortedSamples)
+
+   return { 'last' : round(samples[-1], 3),
+            'p50'  : round(sortedSamples[int(math.ceil(0.50 * n)) - 1], 3),
+            'p95'  : round(sortedSamples[int(math.ceil(0.95 * n)) - 1], 3),
+            'max'  : round(sortedSamples[-1], 3) }
+
+def saveCycleTimings():
+   # Add the phase times of this cycle to the rolling samples in 
+   # /var/lib/vac/cycle-timings and update the summary of each phase
+   
+   try:
+     timings = json.load(open('/var/lib/vac/cycle-timings', 'r'))
+   except:
+     timings = {}
+
+   for phaseName in cyclePhaseTimes:
+     try:
+       samples = timings[phaseName]['samples']
+     except:
+       samples = []
+
+     samples = (samples + [ cyclePhaseTimes[phaseName] ])[-cycleTimingsSamples:]
+     timings[phaseName] = summariseSamples(samples)
+     timings[phaseName]['samples'] = samples
+
+   try:
+     vac.vacutils.createFile('/var/lib/vac/cycle-timings', json.dumps(timings), 
+                             stat.S_IWUSR + stat.S_IRUSR + stat.S_IRGRP + stat.S_IROTH, '/var/lib/vac/tmp')
+   except Exception as e:
+     vac.vacutils.logLine('Failed to save cycle timings (' + str(e) + ')')
+
+   cyclePhaseTimes.clear()
+
+def readCycleTimings():
+   # Return the summary for each phase from /var/lib/vac/cycle-timings, without the samples
+   try:
+     timings = json.load(open('/var/lib/vac/cycle-timings', 'r'))
+   except:
+     return {}
+
+   for phaseName in timings:
+     timings[phaseName].pop('samples', None)
+
+   return timings
+
+def readSlotFile(path):
+   try:
+     createdStr, machinetypeName, machineModel = open(path, 'r').read().split()
+     return { 'created' : int(createdStr), 'machinetypeName' : machinetypeName, 'machineModel' : machineModel }
+   except:
+     return {}
+
+def readMachinesDirFiles(path):
+   values = {}
+
+   try:
+     values['started'] = int(os.stat(path + '/started').st_ctime)
+   except:
+     pass
+
+   try:
+     values['ip'] = open(path + '/ip', 'r').read().strip()
+   except:
+     pass
+
+   try:
+     values['accountingFqan'] = open(path + '/accounting_fqan', 'r').read().strip()
+   except:
+     pass
+
+   try:
+     values['finished'] = int(os.stat(path + '/finished').st_ctime)
+   except:
+     pass
+
+   try:
+     values['heartbeat'] = int(os.stat(path + '/heartbeat').st_ctime)
+   except:
+     pass
+
+   try:
+     # this is written by Vac as it monitors the logical machine
+     oneLine = open(path + '/heartbeat', 'r').readline()
+     values['heartbeatCpuSeconds'] = int(oneLine.split(' ')[0])
+     values['heartbeatCpuPercentage'] = float(oneLine.split(' ')[1])
+   except:
+     pass
+
+   try:
+     values['pid'] = int(open(path + '/pid', 'r').read().strip())
+   except:
+     pass
+
+   return values
+
+def readJobfeaturesFiles(path):
+   values = {}
+
+   try:
+     values['uuidStr'] = open(path + '/job_id', 'r').read().strip()
+   except:
+     pass
+
+   try: 
+     values['shutdownTime'] = int(open(path + '/shutdowntime_job', 'r').read().strip())
+   except:
+     pass
+
+   try: 
+     values['processors'] = int(open(path + '/allocated_cpu', 'r').read().strip())
+   except:
+     pass
+
+   try: 
+     values['mb'] = int(open(path + '/max_rss_bytes', 'r').read().strip()) / 1048576
+   except:
+     pass
+
+   return values
+
+def readMachinefeaturesFiles(path):
+   try: 
+     return { 'hs06' : float(open(path + '/hs06', 'r').read().strip()) }
+   except:
+     return {}
+
+def readShutdownMessageFile(path):
+   try:
+     return { 'shutdownMessage'     : open(path, 'r').read().strip(),
+              'shutdownMessageTime' : int(os.stat(path).st_ctime) }
+   except:
+     return {}
+
+def lockPrestaged(name):
+   # Return an open file holding the lock on prestaging slot name, 
+   # or None if another process is already prestaging it
+
+   try:
+     os.makedirs('/var/lib/vac/prestaged', stat.S_IRUSR|stat.S_IWUSR|stat.S_IXUSR)
+   except:
+     pass
+
+   try:
+     lockFile = open('/var/lib/vac/prestaged/' + name + '.lock', 'a')
+   except Exception as e:
+     vac.vacutils.logLine('Failed to open prestage lock for ' + name + ' (' + str(e) + ')')
+     return None
+
+   try:
+     fcntl.flock(lockFile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+   except:
+     lockFile.close()
+     return None
+
+   return lockFile
+
+def prestagingInProgress(name):
+   lockFile = lockPrestaged(name)
+
+   if lockFile is None:
+     return True
+
+   lockFile.close()
+   return False
+
+def readPrestaged(name):
+   # Return the dictionary describing what has been prestaged in slot name, or None
+   try:
+     return json.load(open('/var/lib/vac/prestaged/' + name, 'r'))
+   except:
+     return None
+
+def discardPrestaged(name):
+   # Remove anything prestaged in slot name. The caller must hold the lock
+   # or know that the slot is not being prestaged
+
+   prestaged = readPrestaged(name)
+
+   try:
+     os.remove('/var/lib/vac/prestaged/' + name)
+   except:
+     pass
+
+   try:
+     os.remove('/var/lib/vac/prestaged/' + name + '.qcow2')
+   except:
+     pass
+
+   if prestaged and prestaged.get('logicalVolume') and volumeGroup and os.path.exists('/dev/' + volumeGroup + '/' + name):
+     if volumeGroupMode == 'pool' and returnPoolVolume(name, 'ext4' if prestaged.get('filesystem') else 'raw'):
+       return
+
+     vac.vacutils.logLine('Remove prestaged logical volume /dev/' + volumeGroup + '/' + name)
+     if os.system('LVM_SUPPRESS_FD_WARNINGS=1 /sbin/lvremove -f ' + volumeGroup + '/' + name + ' 2>&1') == 0:
+       removeModelVolume(name)
+
+def claimPrestaged(name, machinetypeName, processors):
+   # Return the prestaged dictionary for slot name if it matches the LM 
+   # about to be created, otherwise discard anything prestaged there
+
+   prestaged = readPrestaged(name)
+
+   if prestaged is None:
+     return None
+
+   if prestaged.get('machinetypeName') != machinetypeName or prestaged.get('processors') != processors:
+     vac.vacutils.logLine('Discarding what was prestaged in ' + name + ' for ' + str(prestaged.get('machinetypeName')))
+     discardPrestaged(name)
+     return None
+
+   # It is ours now, so nothing else should use or discard it
+   try:
+     os.remove('/var/lib/vac/prestaged/' + name)
+   except:
+     pass
+
+   vac.vacutils.logLine('Using what was prestaged in ' + name + ' for ' + machinetypeName)
+   return prestaged
+
+class VacSlot:
+   # This class represents logical machine slots
+
+   def __init__(self, ordinal, forResponder = False):
+      self.ordinal             = ordinal
+      self.name                = nameFromOrdinal(ordinal)
+      self.ip                  = None
+      self.state               = VacState.unknown
+      self.started             = None
+      self.finished            = None
+      self.heartbeat           = None
+      self.joboutputsHeartbeat = None
+      self.cpuSeconds          = 0
+      self.cpuPercentage       = 0
+      self.heartbeatCpuSeconds = 0
+      self.processors          = 0
+      self.mb                  = 0
+      self.hs06                = None
+      self.accountingFqan      = None
+      self.shutdownMessage     = None
+      self.shutdownMessageTime = None
+      self.created             = None
+      self.machinetypeName     = None
+      self.machineModel        = None
+      self.prestaged           = None
+      self.volumeFormatted     = False
+
+      slotValues = cachedSlotValues(self.name, 'slot', '/var/lib/vac/slots/' + self.name, readSlotFile)
+      self.created         = slotValues.get('created')
+      self.machinetypeName = slotValues.get('machinetypeName')
+      self.machineModel    = slotValues.get('machineModel')
+
+      try:
+        self.cvmfsRepositories = machinetypes[self.machinetypeName]['cvmfs_repositories']
+      except:
+        self.cvmfsRepositories = ''
+
+      if self.created:
+        jobfeaturesValues = cachedSlotValues(self.name, 'jobfeatures', self.machinesDir() + '/jobfeatures', readJobfeaturesFiles)
+        self.uuidStr = jobfeaturesValues.get('uuidStr')
+      else:
+        self.uuidStr = None
+                                              
+      if not self.created or not os.path.isdir(self.machinesDir()):
+        # if slot not properly set up or if machines directory is missing then stop now
+        self.state           = VacState.shutdown
+        self.machinetypeName = None
+        self.created         = None
+        return
+
+      machinesDirValues      = cachedSlotValues(self.name, 'machines', self.machinesDir(), readMachinesDirFiles)
+      machinefeaturesValues  = cachedSlotValues(self.name, 'machinefeatures', self.machinesDir() + '/machinefeatures', readMachinefeaturesFiles)
+
+      self.started = machinesDirValues.get('started')
+      if self.started is None:
+        # if created but not yet started, then state is starting
+        self.state = VacState.starting
+
+      self.ip             = machinesDirValues.get('ip')
+      self.accountingFqan = machinesDirValues.get('accountingFqan')
+
+      self.finished = machinesDirValues.get('finished')
+      if self.finished is not None:
+        self.state = VacState.shutdown
+
+      if self.started and not self.finished:
+        self.state = VacState.running
+
+      self.heartbeat    = machinesDirValues.get('heartbeat')
+      self.shutdownTime = jobfeaturesValues.get('shutdownTime')
+
+      try:
+        # The LM itself updates this file, so we always check it
+        self.joboutputsHeartbeat = int(os.stat(self.machinesDir() + '/joboutputs/' + 
+                                               machinetypes[self.machinetypeName]['heartbeat_file']).st_mtime)
+      except:
+        self.joboutputsHeartbeat = None
+
+      self.processors = jobfeaturesValues.get('processors', 0)
+      self.hs06       = machinefeaturesValues.get('hs06')
+      self.mb         = jobfeaturesValues.get('mb', mbPerProcessor * self.processors)
+      
+      # Values from the last heartbeat file written by Vac
+      self.heartbeatCpuSeconds = machinesDirValues.get('heartbeatCpuSeconds', 0)
+      self.cpuSeconds          = self.heartbeatCpuSeconds
+      self.cpuPercentage       = machinesDirValues.get('heartbeatCpuPercentage', 0)
+ 
+      # Virtual Machine models
+      if not forResponder and self.machineModel in vmModels:
+        domStats = getDomainsStats().get(self.name)
+
+        if domStats:
+          if domStats['state'] != libvirt.VIR_DOMAIN_RUNNING and domStats['state'] != libvirt.VIR_DOMAIN_BLOCKED:
+            # If domain exists, but not Running/Blocked, then say Paused
+            self.state = VacState.paused
+            vac.vacutils.logLine('!!! libvirt state is ' + str(domStats['state']) + ', setting VacState.paused !!!')
+
+          # Overwrite with better estimate from hypervisor
+          self.cpuSeconds = domStats['cpuSeconds']
 
-        try:
-          containers = dockerPsCommand()
-        except:
-          vac.vacutils.logLine('Failed to get list of defined Docker containers')
         else:
-          if self.name in containers:
-            id = containers[self.name]['id']
-            status = containers[self.name]['status']
-            
-        if id is None or status != 'Up':
+          # Actually, we're shutdown since VM not really running
+          self.state = VacState.shutdown
+
+      # Singularity Container models
+      if not forResponder and self.machineModel in scModels:
+
+        pid = machinesDirValues.get('pid')
+
+        if pid is None:
+          uid = None
+        else:
+          try:
+            uid = int(os.stat('/proc/' + str(pid)).st_uid)
+          except:
+            uid = None
+
+        if pid is None or uid is None or uid != singularityUid:
+          # Actually, we're shutdown since SC head process is not really running
           self.state = VacState.shutdown
         else:
           try:
-            self.cpuSeconds = int(open(getProcessCpuCgroupPath(containers[self.name]['pid']) + '/cpuacct.usage', 'r').read()) / 1000000000
+            self.cpuSeconds = int(open(cpuCgroupFsRoot + '/vac/singularity-' + self.uuidStr + '/cpuacct.usage', 'r').read()) / 1000000000
           except:
             pass
 
-      if self.state == VacState.shutdown:
+      # Docker Container models
+      if not forResponder and self.machineModel in dcModels:
+      
+        container = None
+
         try:
-          self.shutdownMessage = open(self.machinesDir() + '/joboutputs/shutdown_message', 'r').read().strip()
-          self.shutdownMessageTime = int(os.stat(self.machinesDir() + '/joboutputs/shutdown_message').st_ctime)
+          container = getDockerContainers().get(self.name)
         except:
-          pass
+          vac.vacutils.logLine('Failed to get list of defined Docker containers')
+            
+        if container is None or container['status'] != 'Up':
+          self.state = VacState.shutdown
+        elif container['cpuSeconds']:
+          self.cpuSeconds = container['cpuSeconds']
+
+      if self.state == VacState.shutdown:
+        # Logical machines may write this file in place, so check the file itself
+        joboutputsValues = cachedSlotValues(self.name, 'joboutputs', self.machinesDir() + '/joboutputs/shutdown_message', readShutdownMessageFile)
+        self.shutdownMessage     = joboutputsValues.get('shutdownMessage')
+        self.shutdownMessageTime = joboutputsValues.get('shutdownMessageTime')
       
    def machinesDir(self):
       return '/var/lib/vac/machines/' + str(self.created) + '_' + self.machinetypeName + '_' + self.name
 
    def createHeartbeatFile(self):
+      lastHeartbeat  = self.heartbeat
       self.heartbeat = int(time.time())
       
       try:
-        f = open(self.machinesDir() + '/heartbeat', 'r')
-        lastCpuSeconds = int(f.readline().split(' ')[0])
-        f.close()
-        
-        lastHeartbeat = int(os.stat(self.machinesDir() + '/heartbeat').st_ctime)
-                                    
-        cpuPercentage = 100.0 * float(self.cpuSeconds - lastCpuSeconds) / (self.heartbeat - lastHeartbeat)
+        # Use the values from the previous heartbeat file, already read into the slot state table
+        cpuPercentage = 100.0 * float(self.cpuSeconds - self.heartbeatCpuSeconds) / (self.heartbeat - lastHeartbeat)
         heartbeatLine = str(self.cpuSeconds) + (" %.1f" % cpuPercentage)
       except:
+        cpuPercentage = 0.0
         heartbeatLine = str(self.cpuSeconds)
 
       try:
         vac.vacutils.createFile(self.machinesDir() + '/heartbeat', heartbeatLine + '\n', stat.S_IRUSR|stat.S_IWUSR|stat.S_IRGRP|stat.S_IROTH, '/var/lib/vac/tmp')
       except:
         pass
+      else:
+        updateSlotValues(self.name, 'machines', self.machinesDir(),
+                         { 'heartbeat'              : self.heartbeat,
+                           'heartbeatCpuSeconds'    : self.cpuSeconds,
+                           'heartbeatCpuPercentage' : float('%.1f' % cpuPercentage) })
                                   
    def createFinishedFile(self):
    
@@ -1302,6 +1922,8 @@ class VacSlot:
 
         except:
           vac.vacutils.logLine('Failed creating ' + self.machinesDir() + '/finished')
+        else:
+          self.finished = int(time.time())
 
       # Update the file for this machinetype in the finishes directory, about the most recently created but already finished machine
 
@@ -1427,109 +2049,94 @@ class VacSlot:
             raise VacError('Failed to create root_public_key')
 
    def makeMJF(self):
-      os.makedirs(self.machinesDir() + '/machinefeatures', stat.S_IRUSR|stat.S_IWUSR|stat.S_IXUSR|stat.S_IRGRP|stat.S_IXGRP|stat.S_IROTH|stat.S_IXOTH)
-      os.makedirs(self.machinesDir() + '/jobfeatures',     stat.S_IRUSR|stat.S_IWUSR|stat.S_IXUSR|stat.S_IRGRP|stat.S_IXGRP|stat.S_IROTH|stat.S_IXOTH)
-      os.makedirs(self.machinesDir() + '/joboutputs',      stat.S_IRUSR|stat.S_IWUSR|stat.S_IXUSR|stat.S_IRGRP|stat.S_IXGRP|stat.S_IROTH|stat.S_IXOTH)
+      # The machinefeatures and jobfeatures files are collected in dictionaries
+      # and then each directory is created with one rename
+      machinefeatures = {}
+      jobfeatures     = {}
 
       # HEPSPEC06 per virtual machine
       if hs06PerProcessor:
-        vac.vacutils.createFile(self.machinesDir() + '/machinefeatures/hs06',
-                 str(hs06PerProcessor * self.processors), stat.S_IWUSR + stat.S_IRUSR + stat.S_IRGRP + stat.S_IROTH, '/var/lib/vac/tmp')
+        machinefeatures['hs06'] = str(hs06PerProcessor * self.processors)
 
       # Easy in 2016 MJF
-      vac.vacutils.createFile(self.machinesDir() + '/machinefeatures/total_cpu',
-                 str(self.processors), stat.S_IWUSR + stat.S_IRUSR + stat.S_IRGRP + stat.S_IROTH, '/var/lib/vac/tmp')
+      machinefeatures['total_cpu'] = str(self.processors)
 
       # Deprecated. We don't know the physical vs logical cores distinction here so we just use cpu
-      vac.vacutils.createFile(self.machinesDir() + '/machinefeatures/phys_cores',
-                 str(self.processors), stat.S_IWUSR + stat.S_IRUSR + stat.S_IRGRP + stat.S_IROTH, '/var/lib/vac/tmp')
+      machinefeatures['phys_cores'] = str(self.processors)
 
       # Deprecated. Again just use cpu
-      vac.vacutils.createFile(self.machinesDir() + '/machinefeatures/log_cores',
-                 str(self.processors), stat.S_IWUSR + stat.S_IRUSR + stat.S_IRGRP + stat.S_IROTH, '/var/lib/vac/tmp')
+      machinefeatures['log_cores'] = str(self.processors)
 
       # Deprecated. Tell them they have the whole VM to themselves; they are in the only jobslot here
-      vac.vacutils.createFile(self.machinesDir() + '/machinefeatures/jobslots',
-                '1', stat.S_IWUSR + stat.S_IRUSR + stat.S_IRGRP + stat.S_IROTH, '/var/lib/vac/tmp')
+      machinefeatures['jobslots'] = '1'
       
       cpuLimitSecs = self.shutdownTime - int(time.time())
       if (cpuLimitSecs < 0):
         cpuLimitSecs = 0
 
       # calculate the absolute shutdown time for the VM, as a machine
-      vac.vacutils.createFile(self.machinesDir() + '/machinefeatures/shutdowntime',
-                 str(self.shutdownTime),
-                 stat.S_IWUSR + stat.S_IRUSR + stat.S_IRGRP + stat.S_IROTH, '/var/lib/vac/tmp')
+      machinefeatures['shutdowntime'] = str(self.shutdownTime)
 
       # additional machinefeatures options defined in configuration
       if machinefeaturesOptions:
         for oneOption,oneValue in machinefeaturesOptions.iteritems():
-          vac.vacutils.createFile(self.machinesDir() + '/machinefeatures/' + oneOption,
-                                  oneValue,
-                                  stat.S_IWUSR + stat.S_IRUSR + stat.S_IRGRP + stat.S_IROTH, '/var/lib/vac/tmp')
+          machinefeatures[oneOption] = oneValue
 
       # Jobfeatures
       
       # Calculate the absolute shutdown time for the VM, as a job
-      vac.vacutils.createFile(self.machinesDir() + '/jobfeatures/shutdowntime_job',
-                 str(self.shutdownTime),
-                 stat.S_IWUSR + stat.S_IRUSR + stat.S_IRGRP + stat.S_IROTH, '/var/lib/vac/tmp')
+      jobfeatures['shutdowntime_job'] = str(self.shutdownTime)
 
       # Deprecated. We don't do this, so just say 1.0 for cpu factor
-      vac.vacutils.createFile(self.machinesDir() + '/jobfeatures/cpufactor_lrms',
-                 '1.0', stat.S_IWUSR + stat.S_IRUSR + stat.S_IRGRP + stat.S_IROTH, '/var/lib/vac/tmp')
+      jobfeatures['cpufactor_lrms'] = '1.0'
 
       # Deprecated. For the scaled cpu limit, we use the wallclock seconds multiple by the cpu
-      vac.vacutils.createFile(self.machinesDir() + '/jobfeatures/cpu_limit_secs_lrms',
-                 str(cpuLimitSecs * self.processors),
-                 stat.S_IWUSR + stat.S_IRUSR + stat.S_IRGRP + stat.S_IROTH, '/var/lib/vac/tmp')
-
+      jobfeatures['cpu_limit_secs_lrms'] = str(cpuLimitSecs * self.processors)
 
       # For the cpu limit, we use the wallclock seconds multiple by the cpu
-      vac.vacutils.createFile(self.machinesDir() + '/jobfeatures/cpu_limit_secs',
-                 str(cpuLimitSecs * self.processors),
-                 stat.S_IWUSR + stat.S_IRUSR + stat.S_IRGRP + stat.S_IROTH, '/var/lib/vac/tmp')
+      jobfeatures['cpu_limit_secs'] = str(cpuLimitSecs * self.processors)
 
       # Deprecated. For the scaled wallclock limit, we use the wallclock seconds without factoring in cpu
-      vac.vacutils.createFile(self.machinesDir() + '/jobfeatures/wall_limit_secs_lrms',
-                 str(cpuLimitSecs),
-                 stat.S_IWUSR + stat.S_IRUSR + stat.S_IRGRP + stat.S_IROTH, '/var/lib/vac/tmp')
+      jobfeatures['wall_limit_secs_lrms'] = str(cpuLimitSecs)
 
       # For the wallclock limit, we use the wallclock seconds without factoring in cpu
-      vac.vacutils.createFile(self.machinesDir() + '/jobfeatures/wall_limit_secs',
-                 str(cpuLimitSecs),
-                 stat.S_IWUSR + stat.S_IRUSR + stat.S_IRGRP + stat.S_IROTH, '/var/lib/vac/tmp')
+      jobfeatures['wall_limit_secs'] = str(cpuLimitSecs)
 
       # We are about to start the VM now
-      vac.vacutils.createFile(self.machinesDir() + '/jobfeatures/jobstart_secs',
-                 str(int(time.time())), stat.S_IWUSR + stat.S_IRUSR + stat.S_IRGRP + stat.S_IROTH, '/var/lib/vac/tmp')
-
-
+      jobfeatures['jobstart_secs'] = str(int(time.time()))
 
       # Job=VM so per-job HEPSPEC06 is same as hs06
       if hs06PerProcessor:
-        vac.vacutils.createFile(self.machinesDir() + '/jobfeatures/hs06_job',
-                  str(hs06PerProcessor * self.processors), stat.S_IWUSR + stat.S_IRUSR + stat.S_IRGRP + stat.S_IROTH, '/var/lib/vac/tmp')
+        jobfeatures['hs06_job'] = str(hs06PerProcessor * self.processors)
 
       # mbPerProcessor is in units of 1024^2 bytes
-      vac.vacutils.createFile(self.machinesDir() + '/jobfeatures/max_rss_bytes',
-                 str(mbPerProcessor * self.processors * 1048576), stat.S_IWUSR + stat.S_IRUSR + stat.S_IRGRP + stat.S_IROTH, '/var/lib/vac/tmp')
+      jobfeatures['max_rss_bytes'] = str(mbPerProcessor * self.processors * 1048576)
 
       # Deprecated. mbPerProcessor is in units of 1024^2 bytes, whereas old jobfeatures wants 1000^2!!!
-      vac.vacutils.createFile(self.machinesDir() + '/jobfeatures/mem_limit_MB',
-                 str((mbPerProcessor * self.processors * 1048576) / 1000000), stat.S_IWUSR + stat.S_IRUSR + stat.S_IRGRP + stat.S_IROTH, '/var/lib/vac/tmp')
-
+      jobfeatures['mem_limit_MB'] = str((mbPerProcessor * self.processors * 1048576) / 1000000)
 
       # cpuPerMachine again
-      vac.vacutils.createFile(self.machinesDir() + '/jobfeatures/allocated_cpu',
-                 str(self.processors) + '\n', stat.S_IWUSR + stat.S_IRUSR + stat.S_IRGRP + stat.S_IROTH, '/var/lib/vac/tmp')
+      jobfeatures['allocated_cpu'] = str(self.processors) + '\n'
 
       # Deprecated. cpuPerMachine again
-      vac.vacutils.createFile(self.machinesDir() + '/jobfeatures/allocated_CPU',
-                 str(self.processors) + '\n', stat.S_IWUSR + stat.S_IRUSR + stat.S_IRGRP + stat.S_IROTH, '/var/lib/vac/tmp')
+      jobfeatures['allocated_CPU'] = str(self.processors) + '\n'
 
       # We do not know max_swap_bytes or scratch_limit_bytes so ignore them
 
+      vac.vacutils.createFilesDirectory(self.machinesDir() + '/machinefeatures', machinefeatures, 
+                                        stat.S_IWUSR + stat.S_IRUSR + stat.S_IRGRP + stat.S_IROTH)
+      vac.vacutils.createFilesDirectory(self.machinesDir() + '/jobfeatures',     jobfeatures,
+                                        stat.S_IWUSR + stat.S_IRUSR + stat.S_IRGRP + stat.S_IROTH)
+      os.makedirs(self.machinesDir() + '/joboutputs',      stat.S_IRUSR|stat.S_IWUSR|stat.S_IXUSR|stat.S_IRGRP|stat.S_IXGRP|stat.S_IROTH|stat.S_IXOTH)
+
+   def updateMJF(self, machinefeatures = {}, jobfeatures = {}):
+      # Update MJF values of a running LM in place, since the directories may be 
+      # bind mounted into containers. Only values which have changed are rewritten
+      vac.vacutils.updateFilesDirectory(self.machinesDir() + '/machinefeatures', machinefeatures,
+                                        stat.S_IWUSR + stat.S_IRUSR + stat.S_IRGRP + stat.S_IROTH, '/var/lib/vac/tmp')
+      vac.vacutils.updateFilesDirectory(self.machinesDir() + '/jobfeatures', jobfeatures,
+                                        stat.S_IWUSR + stat.S_IRUSR + stat.S_IRGRP + stat.S_IROTH, '/var/lib/vac/tmp')
+
    def setupUserDataContents(self):
    
       if machinetypes[self.machinetypeName]['root_image'].startswith('http://') or \
@@ -1570,7 +2177,11 @@ class VacSlot:
                                                machinefeaturesURL = machinefeaturesURL,
                                                jobfeaturesURL     = jobfeaturesURL,
                                                joboutputsURL      = joboutputsURL,
-                                               rootImageURL       = rootImageURL )
+                                               rootImageURL       = rootImageURL,
+                                               userDataCache      = '/var/lib/vac/userdatacache',
+                                               tmpDir             = '/var/lib/vac/tmp',
+                                               proxyKeyBits       = proxyKeyBits,
+                                               keyPool            = '/var/lib/vac/keypool' )
       except Exception as e:
         raise VacError('Failed to read ' + machinetypes[self.machinetypeName]['user_data'] + ' (' + str(e) + ')')
 
@@ -1585,7 +2196,10 @@ class VacSlot:
       # Destroy the logical machine in this slot
    
       if self.machineModel in vmModels:
-        self.destroyVM()
+        if not self.destroyVM(shutdownMessage):
+          # Still shutting down, so we finish off in a later cycle and
+          # the shutdown message is written by reapShutdowns()
+          return
       elif self.machineModel in dcModels:
         self.destroyDC()
       elif self.machineModel in scModels:
@@ -1598,11 +2212,13 @@ class VacSlot:
       self.state = VacState.shutdown
       self.removeLogicalVolume()
 
-      if shutdownMessage and not os.path.exists(self.machinesDir() + '/joboutputs/shutdown_message'):
-        try:
-          open(self.machinesDir() + '/joboutputs/shutdown_message', 'w').write(shutdownMessage)
-        except:
-          pass
+      # Only now the machine has gone, so the LM could not write its own message
+      writeShutdownMessage(self.machinesDir(), shutdownMessage)
+
+      # Keep any shutdown message for the status table
+      joboutputsValues = cachedSlotValues(self.name, 'joboutputs', self.machinesDir() + '/joboutputs/shutdown_message', readShutdownMessageFile)
+      self.shutdownMessage     = joboutputsValues.get('shutdownMessage')
+      self.shutdownMessageTime = joboutputsValues.get('shutdownMessageTime')
 
    def create(self, machinetypeName, cpus, machineShutdownTime):
       # Create a logical machine in this slot 
@@ -1613,6 +2229,7 @@ class VacSlot:
       self.shutdownTime    = machineShutdownTime
       self.machinetypeName = machinetypeName
       self.uuidStr         = None
+      self.prestaged       = claimPrestaged(self.name, machinetypeName, cpus)
 
       os.makedirs(self.machinesDir(), stat.S_IRUSR|stat.S_IWUSR|stat.S_IXUSR|stat.S_IRGRP|stat.S_IXGRP|stat.S_IROTH|stat.S_IXOTH)
 
@@ -1678,51 +2295,33 @@ class VacSlot:
         else:
           vac.vacutils.logLine('Unmount logical volume /dev/' + volumeGroup + '/' + self.name)
 
+        if volumeGroupMode == 'pool' and \
+           returnPoolVolume(self.name, 'ext4' if self.machineModel in dcModels + scModels else 'raw'):
+          # Volume will be wiped and reused
+          return
+
         # Now remove the logical volume itself
         vac.vacutils.logLine('Remove logical volume /dev/' + volumeGroup + '/' + self.name)
-        os.system('LVM_SUPPRESS_FD_WARNINGS=1 /sbin/lvremove -f ' + volumeGroup + '/' + self.name + ' 2>&1')
+        if os.system('LVM_SUPPRESS_FD_WARNINGS=1 /sbin/lvremove -f ' + volumeGroup + '/' + self.name + ' 2>&1') == 0:
+          removeModelVolume(self.name)
 
    def createLogicalVolume(self):
 
+     if self.prestaged and self.prestaged.get('logicalVolume') and os.path.exists('/dev/' + str(volumeGroup) + '/' + self.name):
+       vac.vacutils.logLine('Using prestaged logical volume /dev/' + volumeGroup + '/' + self.name)
+       self.volumeFormatted = bool(self.prestaged.get('filesystem'))
+       return
+
      # Always remove any leftover volume of the same name
      self.removeLogicalVolume()
 
-     if 'disk_gb_per_processor' in machinetypes[self.machinetypeName] and \
-          ((gbDiskPerProcessor is None) or (machinetypes[self.machinetypeName]['disk_gb_per_processor'] <= gbDiskPerProcessor)):
-       gbDiskPerProcessorTmp = machinetypes[self.machinetypeName]['disk_gb_per_processor']
-     else:
-       gbDiskPerProcessorTmp = gbDiskPerProcessor
-
-     try:
-       vgsResult = measureVolumeGroup(volumeGroup)
-       vgTotalBytes = int(vgsResult[0])
-       vgExtentBytes = int(vgsResult[1])
-     except Exception as e:
-       raise VacError('Failed to measure size of volume group ' + volumeGroup + ' - missing?')
-
-     try:
-       f = os.popen('LVM_SUPPRESS_FD_WARNINGS=1 /sbin/lvs --noheadings --units B --nosuffix --options lv_name,lv_size ' + volumeGroup, 'r')
-     except Exception as e:
-       raise VacError('Measuring size of logical volumes in ' + volumeGroup + ' fails with ' + str(e))
-
-     vgVacBytes = 0
-     vgNonVacBytes = 0
-     nameParts = os.uname()[1].split('.',1)
-     domainRegex = nameParts[1].replace('.','\.')
+     gbDiskPerProcessorTmp = machinetypeGbDiskPerProcessor(self.machinetypeName)
 
-     while True:
-       try:
-        name,sizeStr = f.readline().strip().split()
-        size = int(sizeStr)
-       except:
-        break
-
-       if re.search('^' + nameParts[0] + '-[0-9][0-9]\.' + domainRegex + '$', name) is None:
-        vgNonVacBytes += size
-       else:
-        vgVacBytes += size
+     if volumeGroupMode == 'thin':
+       self.createThinVolume(gbDiskPerProcessorTmp)
+       return
 
-     f.close()
+     (vgTotalBytes, vgExtentBytes, vgVacBytes, vgNonVacBytes) = volumeGroupUsage()
 
      vac.vacutils.logLine('Volume group ' + volumeGroup + ' has ' + str(vgVacBytes) + ' bytes used by Vac and ' + str(vgNonVacBytes) + 
                           ' bytes by others, out of ' + str(vgTotalBytes) + ' bytes in total. The extent size is ' + str(vgExtentBytes) + ' bytes.')
@@ -1730,15 +2329,178 @@ class VacSlot:
      # Now try to create logical volume
      vac.vacutils.logLine('Trying to create logical volume for ' + self.name + ' in ' + volumeGroup)
 
-     if gbDiskPerProcessorTmp:
-       # Fixed size has been given in configuration. Round down to match extent size.
-       sizeToCreate = ((gbDiskPerProcessorTmp * self.processors * 1000000000) / vgExtentBytes) * vgExtentBytes
-     else:
-       # Not given, so calculate. Round down to match extent size.
-       sizeToCreate = ((self.processors * (vgTotalBytes - vgNonVacBytes) / numProcessors) / vgExtentBytes) * vgExtentBytes
-     
+     sizeToCreate = logicalVolumeBytes(gbDiskPerProcessorTmp, self.processors, vgTotalBytes, vgExtentBytes, vgNonVacBytes)
+
+     if volumeGroupMode == 'pool':
+       volumeKind = 'ext4' if self.machineModel in dcModels + scModels else 'raw'
+
+       if claimPoolVolume(self.name, sizeToCreate, volumeKind):
+         self.volumeFormatted = (volumeKind == 'ext4')
+         return
+
+       # Make room by removing ready volumes we cannot use
+       makePoolSpace(sizeToCreate)
+     
      # Option -y means we wipe existing signatures etc
-     os.system('LVM_SUPPRESS_FD_WARNINGS=1 /sbin/lvcreate --yes --name ' + self.name + ' -L ' + str(sizeToCreate) + 'B ' + volumeGroup + ' 2>&1')
+     if os.system('LVM_SUPPRESS_FD_WARNINGS=1 /sbin/lvcreate --yes --name ' + self.name + ' -L ' + str(sizeToCreate) + 'B ' + volumeGroup + ' 2>&1') == 0:
+       addModelVolume(self.name, sizeToCreate)
+
+     try:
+       if not stat.S_ISBLK(os.stat('/dev/' + volumeGroup + '/' + self.name).st_mode):
+         raise VacError('Failing due to /dev/' + volumeGroup + '/' + self.name + ' not a block device')
+     except:
+         raise VacError('Failing due to /dev/' + volumeGroup + '/' + self.name + ' not existing')
+
+
+   def planLogicalVolume(self, machinetypeName, processors):
+     # Called by the factory before forking the subprocess that creates an
+     # LM of machinetypeName in this slot, since each subprocess only sees
+     # its own copy of the volume group model. Returns None if there is
+     # nothing to reserve, False if the volume group does not have room,
+     # or [ size, names ] for reserveLogicalVolume() where names are the
+     # ready pool volumes the creation will claim or remove
+
+     if not volumeGroup or volumeGroupMode == 'thin' or not measureVolumeGroup(volumeGroup):
+       return None
+
+     prestaged = readPrestaged(self.name)
+     if prestaged and prestaged.get('machinetypeName') == machinetypeName and \
+        prestaged.get('processors') == processors and prestaged.get('logicalVolume') and \
+        self.name in volumeGroupModel['volumes']:
+       return None
+
+     (vgTotalBytes, vgExtentBytes, vgVacBytes, vgNonVacBytes) = volumeGroupUsage()
+
+     sizeToCreate = logicalVolumeBytes(machinetypeGbDiskPerProcessor(machinetypeName), processors, 
+                                       vgTotalBytes, vgExtentBytes, vgNonVacBytes)
+
+     # Any leftover volume of the same name is removed before creation, 
+     # or in pool mode returned to the pool to be wiped
+     freeBytes = volumeGroupModel['freeBytes']
+     poolNames = []
+
+     if volumeGroupMode != 'pool':
+       freeBytes += volumeGroupModel['volumes'].get(self.name, 0)
+
+     if volumeGroupMode == 'pool':
+       volumeKind = 'ext4' if machinetypes[machinetypeName]['machine_model'] in dcModels + scModels else 'raw'
+
+       # Same choices as claimPoolVolume() and makePoolSpace() will make
+       for (lvName, state, size, lvKind) in listPoolVolumes():
+         if state == 'ready' and size == sizeToCreate and lvKind == volumeKind:
+           return [ sizeToCreate, [ lvName ] ]
+
+       for (lvName, state, size, lvKind) in sorted(listPoolVolumes(), key = lambda v: -v[2]):
+         if freeBytes >= sizeToCreate:
+           break
+
+         if state == 'ready':
+           freeBytes += size
+           poolNames.append(lvName)
+
+     if freeBytes < sizeToCreate:
+       vac.vacutils.logLine('Volume group ' + volumeGroup + ' has ' + str(freeBytes) + ' bytes free for ' + self.name + 
+                            ' but ' + str(sizeToCreate) + ' bytes are needed')
+       return False
+
+     return [ sizeToCreate, poolNames ]
+
+   def reserveLogicalVolume(self, plan):
+     # Record a plan from planLogicalVolume() in the factory's volume group
+     # model, after forking the creation subprocess, so that the next 
+     # creations in this cycle do not count on the same space
+
+     if not plan:
+       return
+
+     if volumeGroupMode == 'pool' and self.name in volumeGroupModel['volumes']:
+       renameModelVolume(self.name, 'vacdirty_%d_raw_%s' % (volumeGroupModel['volumes'][self.name], uuid.uuid4().hex[:12]))
+     else:
+       removeModelVolume(self.name)
+
+     for lvName in plan[1]:
+       removeModelVolume(lvName)
+
+     addModelVolume(self.name, plan[0])
+
+   def rawRootImageFileName(self):
+      # Return the file name of the root_image of a vm-raw machinetype, fetching it if necessary
+
+      if machinetypes[self.machinetypeName]['root_image'][0:7] == 'http://' or machinetypes[self.machinetypeName]['root_image'][0:8] == 'https://':
+        try:
+          return cachedRootImage(machinetypes[self.machinetypeName]['root_image'])
+        except Exception as e:
+          raise VacError('Failed fetching root_image ' + machinetypes[self.machinetypeName]['root_image'] + ' (' + str(e) + ')')
+      elif machinetypes[self.machinetypeName]['root_image'][0] == '/':
+        return machinetypes[self.machinetypeName]['root_image']
+      else:
+        return machinetypes[self.machinetypeName]['machinetype_path'] + '/files/' + machinetypes[self.machinetypeName]['root_image']
+
+   def prestage(self, machinetypeName, processors):
+      # Prepare the logical volume, filesystem and root disk for an LM of 
+      # machinetypeName in this free slot, so that create() can just use them.
+      # The caller must hold the lock from lockPrestaged()
+
+      discardPrestaged(self.name)
+
+      self.machinetypeName = machinetypeName
+      self.machineModel    = machinetypes[machinetypeName]['machine_model']
+      self.processors      = processors
+
+      prestaged = { 'machinetypeName' : machinetypeName, 
+                    'processors'      : processors,
+                    'time'            : int(time.time()) }
+
+      # Record the logical volume first, so it is discarded if we fail later
+      vac.vacutils.createFile('/var/lib/vac/prestaged/' + self.name, json.dumps(prestaged), stat.S_IRUSR|stat.S_IWUSR, '/var/lib/vac/tmp')
+
+      if self.machineModel in [ 'vm-raw', 'cernvm3' ] + dcModels + scModels and volumeGroup and measureVolumeGroup(volumeGroup):
+        self.createLogicalVolume()
+        prestaged['logicalVolume'] = True
+        vac.vacutils.createFile('/var/lib/vac/prestaged/' + self.name, json.dumps(prestaged), stat.S_IRUSR|stat.S_IWUSR, '/var/lib/vac/tmp')
+
+        if self.machineModel in dcModels + scModels:
+          if not self.volumeFormatted and \
+             os.system('/usr/sbin/mke2fs -q -t ext4 /dev/' + volumeGroup + '/' + self.name) != 0:
+            raise VacError('Failed to create filesystem on /dev/' + volumeGroup + '/' + self.name)
+
+          prestaged['filesystem'] = True
+
+      if self.machineModel == 'vm-raw':
+        rawFileName = self.rawRootImageFileName()
+
+        if os.system('qemu-img create -b ' + rawFileName + ' -f qcow2 /var/lib/vac/prestaged/' + self.name + '.qcow2 >/dev/null') != 0:
+          raise VacError('Creation of copy-on-write disk image fails!')
+
+        prestaged['rootDisk']  = '/var/lib/vac/prestaged/' + self.name + '.qcow2'
+        prestaged['rootImage'] = [ rawFileName, list(pathSignature(rawFileName) or []) ]
+
+      vac.vacutils.createFile('/var/lib/vac/prestaged/' + self.name, json.dumps(prestaged), stat.S_IRUSR|stat.S_IWUSR, '/var/lib/vac/tmp')
+      vac.vacutils.logLine('Prestaged ' + self.name + ' for ' + machinetypeName + ' with ' + str(processors) + ' processor(s)')
+
+   def createThinVolume(self, gbDiskPerProcessorTmp):
+     # Thin volumes only use pool space when written to, so can be overcommitted
+     # and the usual default size for disks is used if none is given
+
+     kind = 'ext4' if self.machineModel in dcModels + scModels else 'raw'
+
+     try:
+       vgExtentBytes = int(measureVolumeGroup(volumeGroup)[1])
+     except Exception as e:
+       raise VacError('Failed to measure size of volume group ' + volumeGroup + ' - missing?')
+
+     sizeToCreate = (((gbDiskPerProcessorTmp if gbDiskPerProcessorTmp else gbDiskPerProcessorDefault)
+                       * self.processors * 1000000000) / vgExtentBytes) * vgExtentBytes
+
+     templateName = makeThinTemplate(sizeToCreate, kind)
+
+     vac.vacutils.logLine('Create thin snapshot ' + volumeGroup + '/' + self.name + ' of ' + templateName)
+
+     if os.system('LVM_SUPPRESS_FD_WARNINGS=1 /sbin/lvcreate --yes --snapshot --setactivationskip n --activate y --name ' 
+                  + self.name + ' ' + volumeGroup + '/' + templateName + ' 2>&1') != 0:
+       raise VacError('Failed to create thin snapshot ' + volumeGroup + '/' + self.name + ' of ' + templateName)
+
+     addModelVolume(self.name, sizeToCreate, thin = True)
 
      try:
        if not stat.S_ISBLK(os.stat('/dev/' + volumeGroup + '/' + self.name).st_mode):
@@ -1746,6 +2508,13 @@ class VacSlot:
      except:
          raise VacError('Failing due to /dev/' + volumeGroup + '/' + self.name + ' not existing')
 
+     self.volumeFormatted = (kind == 'ext4')
+
+   def recordRootImage(self, fileName):
+      # Record the root image used by this LM, so it is not removed from
+      # the image cache while the LM may still be using it
+      vac.vacutils.createFile(self.machinesDir() + '/root_image_file', fileName + '\n',
+                              stat.S_IRUSR|stat.S_IWUSR|stat.S_IRGRP|stat.S_IROTH, '/var/lib/vac/tmp')
 
    def createVM(self):
       # Create Virtual Machine instance in this logical machine slot
@@ -1768,18 +2537,11 @@ class VacSlot:
       if self.machineModel == 'vm-raw':
         # non-CernVM VM model
       
-        if machinetypes[self.machinetypeName]['root_image'][0:7] == 'http://' or machinetypes[self.machinetypeName]['root_image'][0:8] == 'https://':
-          try:
-            rawFileName = vac.vacutils.getRemoteRootImage(machinetypes[self.machinetypeName]['root_image'], '/var/lib/vac/imagecache', '/var/lib/vac/tmp', 'Vac ' + vacVersion)
-          except Exception as e:
-            raise VacError('Failed fetching root_image ' + machinetypes[self.machinetypeName]['root_image'] + ' (' + str(e) + ')')
-        elif machinetypes[self.machinetypeName]['root_image'][0] == '/':
-           rawFileName = machinetypes[self.machinetypeName]['root_image']
-        else:
-           rawFileName = machinetypes[self.machinetypeName]['machinetype_path'] + '/files/' + machinetypes[self.machinetypeName]['root_image']
+        rawFileName = self.rawRootImageFileName()
+        self.recordRootImage(rawFileName)
 
         if 'cernvm_signing_dn' in machinetypes[self.machinetypeName]:
-          cernvmDict = vac.vacutils.getCernvmImageData(rawFileName)
+          cernvmDict = cernvmImageData(rawFileName)
           if cernvmDict['verified'] == False:
             raise VacError('Failed to verify signature/cert for ' + rawFileName)
           elif re.search(machinetypes[self.machinetypeName]['cernvm_signing_dn'],  cernvmDict['dn']) is None:
@@ -1787,11 +2549,17 @@ class VacSlot:
           else:
             vac.vacutils.logLine('Verified image signed by ' + cernvmDict['dn'])
 
-        fTmp, rootDiskFileName = tempfile.mkstemp(prefix = 'root.disk.', dir = '/var/lib/vac/tmp')
+        if self.prestaged and self.prestaged.get('rootDisk') and \
+           self.prestaged.get('rootImage') == [ rawFileName, list(pathSignature(rawFileName) or []) ]:
+          # Still backed by the same image file, so we can use it
+          rootDiskFileName = self.prestaged['rootDisk']
+          vac.vacutils.logLine('Using prestaged root disk ' + rootDiskFileName)
+        else:
+          fTmp, rootDiskFileName = tempfile.mkstemp(prefix = 'root.disk.', dir = '/var/lib/vac/tmp')
 
-        # Make a small QEMU qcow2 disk for this instance,  backed by the full image stored elsewhere
-        if os.system('qemu-img create -b ' + rawFileName + ' -f qcow2 ' + rootDiskFileName + ' >/dev/null') != 0:
-          raise VacError('Creation of copy-on-write disk image fails!')
+          # Make a small QEMU qcow2 disk for this instance,  backed by the full image stored elsewhere
+          if os.system('qemu-img create -b ' + rawFileName + ' -f qcow2 ' + rootDiskFileName + ' >/dev/null') != 0:
+            raise VacError('Creation of copy-on-write disk image fails!')
 
         root_disk_xml = """<disk type='file' device='disk'>
                            <driver name='qemu' type='qcow2' cache='unsafe' error_policy='report' />
@@ -1808,7 +2576,8 @@ class VacSlot:
             raise VacError('Failed to create required logical volume: ' + str(e))
 
           scratch_disk_xml = ("<disk type='block' device='disk'>\n" +
-                              " <driver name='qemu' type='raw' error_policy='report' cache='unsafe'/>\n" +
+                              " <driver name='qemu' type='raw' error_policy='report' cache='unsafe'" + 
+                              (" discard='unmap'" if volumeGroupMode == 'thin' else "") + "/>\n" +
                               " <source dev='/dev/" + volumeGroup + "/" + self.name  + "'/>\n" +
                               " <target dev='" + machinetypes[self.machinetypeName]['scratch_device'] + 
                               "' bus='" + ("virtio" if "vd" in machinetypes[self.machinetypeName]['scratch_device'] else "ide") + "'/>\n</disk>")
@@ -1819,7 +2588,7 @@ class VacSlot:
         # For cernvm3 always need to set up the ISO boot image
         if machinetypes[self.machinetypeName]['root_image'][0:7] == 'http://' or machinetypes[self.machinetypeName]['root_image'][0:8] == 'https://':
             try:
-              cernvmCdrom = vac.vacutils.getRemoteRootImage(machinetypes[self.machinetypeName]['root_image'], '/var/lib/vac/imagecache', '/var/lib/vac/tmp', 'Vac ' + vacVersion)
+              cernvmCdrom = cachedRootImage(machinetypes[self.machinetypeName]['root_image'])
             except Exception as e:
               raise VacError(str(e))
         elif machinetypes[self.machinetypeName]['root_image'][0] == '/':
@@ -1827,8 +2596,10 @@ class VacSlot:
         else:
             cernvmCdrom = machinetypes[self.machinetypeName]['root_image'] + '/files/' + machinetypes[self.machinetypeName]['root_image']
 
+        self.recordRootImage(cernvmCdrom)
+
         if 'cernvm_signing_dn' in machinetypes[self.machinetypeName]:
-            cernvmDict = vac.vacutils.getCernvmImageData(cernvmCdrom)
+            cernvmDict = cernvmImageData(cernvmCdrom)
             if cernvmDict['verified'] == False:
               raise VacError('Failed to verify signature/cert for ' + cernvmCdrom)
             elif re.search(machinetypes[self.machinetypeName]['cernvm_signing_dn'],  cernvmDict['dn']) is None:
@@ -1852,7 +2623,8 @@ class VacSlot:
             raise VacError('Failed to create required logical volume: ' + str(e))
       
           root_disk_xml = ("<disk type='block' device='disk'>\n" +
-                           " <driver name='qemu' type='raw' error_policy='report' cache='unsafe'/>\n" +
+                           " <driver name='qemu' type='raw' error_policy='report' cache='unsafe'" + 
+                           (" discard='unmap'" if volumeGroupMode == 'thin' else "") + "/>\n" +
                            " <source dev='/dev/" + volumeGroup + "/" + self.name  + "'/>\n" +
                            " <target dev='" + machinetypes[self.machinetypeName]['root_device'] + 
                            "' bus='" + ("virtio" if "vd" in machinetypes[self.machinetypeName]['root_device'] else "ide") + "'/>\n</disk>")        
@@ -1881,13 +2653,7 @@ class VacSlot:
       else:
         raise VacError('machine_model %s is not supported/recognised' % self.machineModel)
       
-      try:
-        conn = libvirt.open(None)
-      except:
-        raise VacError('exception when opening connection to the hypervisor')
-
-      if conn == None:
-        raise VacError('failed to open connection to the hypervisor')
+      conn = getLibvirtConn()
 
       if os.path.isfile("/usr/libexec/qemu-kvm"):
         qemuKvmFile = "/usr/libexec/qemu-kvm"
@@ -1947,7 +2713,6 @@ class VacSlot:
            dom = conn.createXML(xmldesc, 0)
       except Exception as e:
            vac.vacutils.logLine('Exception ("' + str(e) + '") when trying to create VM domain for ' + self.name)
-           conn.close()
            raise VacError('exception when trying to create VM domain')
       finally:
            # If used, we unlink the big, sparse root disk image once libvirt has it open too,
@@ -1957,42 +2722,30 @@ class VacSlot:
 
       if not dom:
            vac.vacutils.logLine('Failed when trying to create VM domain for ' + self.name)
-           conn.close()
-           raise VacErrpr('failed when trying to create VM domain')
-           
-      conn.close()
+           raise VacError('failed when trying to create VM domain')
+
+      updateDomainsStats(self.name, dom)
        
       self.state = VacState.running
       
    def destroyVM(self, shutdownMessage = None):
-      # Destory Virtual Machine running in this logical machine slot
+      # Destroy Virtual Machine running in this logical machine slot.
+      # Returns True if it has gone, or False if it is still shutting down
    
-      conn = libvirt.open(None)
-      if conn == None:
-          vac.vacutils.logLine('Failed to open connection to the hypervisor')
-          raise VacError('failed to open connection to the hypervisor')
+      domStats = getDomainsStats().get(self.name)
 
-      try:
-        dom = conn.lookupByName(self.name)
-      except:
+      if not domStats:
         vac.vacutils.logLine('VM %s has already gone' % self.name)
-        conn.close()
-        return
-        
-      try:
-        dom.shutdown()
-      except Exception as e:
-        vac.vacutils.logLine('Failed to shutdown %s (%s) - already gone? paused?' % (self.name, str(e)))
-      else:
-        # 30s delay for any ACPI handler in the VM
-        time.sleep(30.0)
+        pendingShutdowns.pop(self.name, None)
+        return True
 
-      try:
-        dom.destroy()
-      except Exception as e:
-        vac.vacutils.logLine('Failed to destroy %s (%s)' % (self.name, str(e)))
+      if self.name not in pendingShutdowns:
+        requestShutdown(self.name, domStats['dom'], self.machinesDir(), shutdownMessage)
+      elif shutdownMessage and not pendingShutdowns[self.name].get('shutdownMessage'):
+        pendingShutdowns[self.name]['shutdownMessage'] = shutdownMessage
 
-      conn.close()
+      reapShutdowns()
+      return self.name not in pendingShutdowns
 
    def createDC(self):
       # Create a Docker Container instance in this logical machine slot
@@ -2013,13 +2766,15 @@ class VacSlot:
         except Exception as e:
           raise VacError('Failed to create required logical volume: ' + str(e))
 
-        try:
-          os.system('/usr/sbin/mke2fs -t ext4 /dev/' + volumeGroup + '/' + self.name)
-        except Exception as e:
-          raise VacError('Failed to create filesystem: ' + str(e))
+        if not self.volumeFormatted:
+          try:
+            os.system('/usr/sbin/mke2fs -t ext4 /dev/' + volumeGroup + '/' + self.name)
+          except Exception as e:
+            raise VacError('Failed to create filesystem: ' + str(e))
           
         try:
-          os.system('/usr/bin/mount /dev/' + volumeGroup + '/' + self.name + ' ' + self.machinesDir() + '/mnt')
+          os.system('/usr/bin/mount ' + ('-o discard ' if volumeGroupMode == 'thin' else '') +
+                    '/dev/' + volumeGroup + '/' + self.name + ' ' + self.machinesDir() + '/mnt')
         except Exception as e:
           raise VacError('Failed to mount filesystem: ' + str(e))
           
@@ -2079,7 +2834,7 @@ class VacSlot:
       
       if machinetypes[self.machinetypeName]['root_image'].startswith('http://') or machinetypes[self.machinetypeName]['root_image'].startswith('https://'):
         try:
-          image = vac.vacutils.getRemoteRootImage(machinetypes[self.machinetypeName]['root_image'], '/var/lib/vac/imagecache', '/var/lib/vac/tmp', 'Vac ' + vacVersion)
+          image = cachedRootImage(machinetypes[self.machinetypeName]['root_image'])
         except Exception as e:
           raise VacError(str(e))
       elif machinetypes[self.machinetypeName]['root_image'][0] == '/':
@@ -2088,6 +2843,8 @@ class VacSlot:
       else:
         image = machinetypes[self.machinetypeName]['machinetype_path'] + '/files/' + machinetypes[self.machinetypeName]['root_image']
 
+      self.recordRootImage(image)
+
       os.makedirs(self.machinesDir() + '/mnt',
                   stat.S_IRUSR|stat.S_IWUSR|stat.S_IXUSR|stat.S_IRGRP|stat.S_IXGRP|stat.S_IROTH|stat.S_IXOTH)
 
@@ -2099,13 +2856,15 @@ class VacSlot:
         except Exception as e:
           raise VacError('Failed to create required logical volume: ' + str(e))
 
-        try:
-          os.system('/usr/sbin/mke2fs -t ext4 /dev/' + volumeGroup + '/' + self.name)
-        except Exception as e:
-          raise VacError('Failed to create filesystem: ' + str(e))
+        if not self.volumeFormatted:
+          try:
+            os.system('/usr/sbin/mke2fs -t ext4 /dev/' + volumeGroup + '/' + self.name)
+          except Exception as e:
+            raise VacError('Failed to create filesystem: ' + str(e))
           
         try:
-          os.system('/usr/bin/mount /dev/' + volumeGroup + '/' + self.name + ' ' + self.machinesDir() + '/mnt')
+          os.system('/usr/bin/mount ' + ('-o discard ' if volumeGroupMode == 'thin' else '') +
+                    '/dev/' + volumeGroup + '/' + self.name + ' ' + self.machinesDir() + '/mnt')
         except Exception as e:
           raise VacError('Failed to mount filesystem: ' + str(e))
 
@@ -2224,186 +2983,807 @@ class VacSlot:
            vac.vacutils.logLine('Kill Singularity Container process %s (%s)' % (pid, name))
            os.kill(int(pid), signal.SIG_KILL)
 
-def measureVolumeGroup(vg):
-      if not vg:
-        return None
-   
-      try:
-        return os.popen('LVM_SUPPRESS_FD_WARNINGS=1 /sbin/vgs --noheadings --options vg_size,extent_size --units b --nosuffix ' + vg, 'r').readline().strip().split()
-      except Exception as e:
-        vac.vacutils.logLine('Failed to measure size of volume group %s (%s)' % (vg, str(e)))
-        return None
+def runDetached(lockFile, function, *args):
+   # Run function(*args) in a detached subprocess which holds lockFile, 
+   # so it can carry on after the cycle which started it has finished
 
-def dockerPsCommand():
-      # Return a dictionary of currently defined Docker containers, filtered
-      # by the pattern of names Vac creates on this host.
-      # We use the docker command rather than the API for portability
+   pid = os.fork()
 
-      if not os.path.isfile(dockerPath) or not os.access(dockerPath, os.X_OK):
-        return {}
-      
-      host,domain = os.uname()[1].split('.',1)
+   if pid == 0:
+     if os.fork() != 0:
+       os._exit(0)
 
-      # Get the output of docker ps
-      pp = subprocess.Popen(dockerPath + ' ps --all --no-trunc --format "{{.Names}} {{.ID}} {{.Image}} {{.Status}} ."', 
-                            shell=True, stdout=subprocess.PIPE).stdout
+     # Close everything else, including the pipe back to vacd-factory
+     os.closerange(3, lockFile.fileno())
+     os.closerange(lockFile.fileno() + 1, os.sysconf('SC_OPEN_MAX'))
 
-      containers = {}
+     try:
+       function(*args)
+     except Exception as e:
+       vac.vacutils.logLine('Detached ' + function.__name__ + ' fails with: ' + str(e))
 
-      for line in pp:
-        try:
-          name, id, image, status, rest = line.split(None, 4)
-        except:
-          continue          
+     os._exit(0)
 
-        if name.startswith(host + '-') and name.endswith('.' + domain):
-          containers[name] = { "id" : id, "image" : image, "status" : status }
-          
-      pp.close()
-      
-      # Merge in values from the output of docker inspect
-      if containers:
-        pp = subprocess.Popen(dockerPath + ' inspect --format "{{.Name}} {{.State.Pid}}" ' + ' '.join([i for i in containers]),
-                            shell=True, stdout=subprocess.PIPE).stdout
+   lockFile.close()
+   os.waitpid(pid, 0)
 
-        for line in pp:
-          try:
-            name, pidStr = line.split()
-          except:
-            continue
+# Logical volumes in the pool are named vacready_SIZE_KIND_ID when wiped and 
+# ready to use, and vacdirty_SIZE_KIND_ID when waiting to be wiped. KIND is
+# ext4 if they have a filesystem for containers, or raw for VMs
+poolVolumeRegex = '^vac(ready|dirty)_([0-9]+)_(ext4|raw)_([0-9a-f]+)$'
 
-          if name[0] == '/':
-            name = name[1:]
+def listPoolVolumes():
+   # Return a list of (lvName, state, sizeBytes, kind) for the volumes in the pool
 
-          if name in containers:
-            # Add pid value to the dictionary entry
-            containers[name]['pid'] = int(pidStr)
-          
-        pp.close()
-      
-      return containers        
+   poolVolumes = []
 
-def dockerRunCommand(rwBindsList, roBindsList, name, image, script, cpuShares, memoryBytes):
-      # Run a Docker container 
-      # We use the docker command rather than the API for portability
-      
-      binds = ''
-      
-      for i in rwBindsList:
-        binds += '-v %s:%s ' % (i[0], i[1])
-            
-      for i in roBindsList:
-        binds += '-v %s:%s:ro ' % (i[0], i[1])
-            
-      cmd = dockerPath + ' run --detach --cpu-shares %d --memory-reservation %d %s --name %s --hostname %s %s %s' % (cpuShares, memoryBytes, binds, name, name, image, script)
-      vac.vacutils.logLine('Creating DC with ' + cmd)
+   if not measureVolumeGroup(volumeGroup):
+     return poolVolumes
 
-      pp = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE).stdout
-                            
-      id = pp.readline().strip()
-      
-      pp.close()
-      return id
+   for lvName in volumeGroupModel['volumes']:
+     match = re.search(poolVolumeRegex, lvName)
 
-def dockerRmCommand(name):
-      # Remove Docker container by name
-      # We use the docker command rather than the API for portability
-      
-      subprocess.call(dockerPath + ' rm --force %s' % name, shell=True)
+     if match:
+       poolVolumes.append((lvName, match.group(1), int(match.group(2)), match.group(3)))
 
-def checkNetwork():
-      # Check and if necessary create network and set its attributes
+   return poolVolumes
 
-      conn = libvirt.open(None)
-      
-      try:
-           # Find the network if already defined
-           vacNetwork = conn.networkLookupByName('vac_' + natNetwork)           
-      except:
-           vacNetwork = None
-      else:
-           if not re.search("<ip[^>]*address='" + factoryAddress + "'", vacNetwork.XMLDesc(1)):
-             # The network does not have the right IP address!
-             vac.vacutils.logLine('vac_' + natNetwork + ' defined with wrong IP address - removing!')
+def claimPoolVolume(name, sizeBytes, kind):
+   # Rename a ready pool volume of this size and kind to name. Returns True if done
 
-             try:
-               vacNetwork.destroy()
-             except:
-               pass
-            
-             try:
-               vacNetwork.undefine()
-             except:
-               pass
+   for (lvName, state, size, lvKind) in listPoolVolumes():
+     if state == 'ready' and size == sizeBytes and lvKind == kind:
+       if os.system('LVM_SUPPRESS_FD_WARNINGS=1 /sbin/lvrename ' + volumeGroup + ' ' + lvName + ' ' + name + ' >/dev/null 2>&1') == 0:
+         vac.vacutils.logLine('Claimed pool volume ' + lvName + ' as ' + name)
+         renameModelVolume(lvName, name)
+         return True
 
-             # Probably need to do this too:                            
-             fixNetworkingCommands()
-             
-             # Remember we removed it
-             vacNetwork = None
-           
-      if not vacNetwork:
-           # Doesn't exist so we define it
-           vac.vacutils.logLine('No libvirt network vac_' + natNetwork + ' defined for NAT') 
-           
-           nameParts = os.uname()[1].split('.',1)
+   return False
 
-           dhcpXML = ""
- 
-           ordinal = 0
-           while ordinal < 100:
-    
-              ip      = natPrefix + str(ordinal)
-              ipBytes = ip.split('.')        
-              mac     = '56:4D:%02X:%02X:%02X:%02X' % (int(ipBytes[0]), int(ipBytes[1]), int(ipBytes[2]), int(ipBytes[3]))
-              vmName  = nameParts[0] + '-%02d' % ordinal + '.' + nameParts[1]
-              hostsLine = ip + ' ' + nameParts[0] + '-%02d' % ordinal + ' ' + vmName + ' # added by Vac'
+def makePoolSpace(sizeBytes):
+   # Remove ready pool volumes until sizeBytes are free in the volume group
 
-              dhcpXML += "   <host mac='" + mac + "' name='" + vmName + "' ip='" + ip + "'/>\n"
-              ordinal += 1
+   for (lvName, state, size, lvKind) in sorted(listPoolVolumes(), key = lambda v: -v[2]):
+     if volumeGroupModel['freeBytes'] >= sizeBytes:
+       return
 
-              # append a line for this VM to /etc/hosts if not already present
-              with open('/etc/hosts', 'r') as f:
-                if not hostsLine in f.read():
-                  f.close()
-                  with open('/etc/hosts', 'a') as g:
-                    g.write(hostsLine + '\n')
+     if state == 'ready':
+       vac.vacutils.logLine('Remove pool volume ' + lvName + ' to make space')
+       if os.system('LVM_SUPPRESS_FD_WARNINGS=1 /sbin/lvremove -f ' + volumeGroup + '/' + lvName + ' >/dev/null 2>&1') == 0:
+         removeModelVolume(lvName)
 
-           netXML = "<network>\n <name>vac_" + natNetwork + "</name>\n <forward mode='nat'"
-           
-           if forwardDev:
-             netXML += " dev='" + forwardDev + "'"
-           
-           netXML += "/>\n <ip address='" + factoryAddress + "' netmask='" + natNetmask + "'>\n"
-           netXML += "  <dhcp>\n" + dhcpXML + "</dhcp>\n </ip>\n</network>\n"
-      
-           try:
-             vacNetwork = conn.networkDefineXML(netXML)
-           except Exception as e:  
-             vac.vacutils.logLine('Failed to define network vac_' + natNetwork + ' due to "' + str(e) + '"')
-             return False
-           else:
-             vac.vacutils.logLine('Defined network vac_' + natNetwork)
+def returnPoolVolume(name, kind):
+   # Rename the volume of slot name to a dirty pool volume, and start wiping 
+   # it in the background. Returns False if it could not be added to the pool
 
-      # Check the network is actually running, not just defined    
-      if not vacNetwork.isActive():    
-           try:  
-             # Try starting it if not running
-             vacNetwork.create()
-           except Exception as e:  
-             vac.vacutils.logLine('Starting defined network vac_' + natNetwork + ' fails with "' + str(e) + '"')
-             vac.vacutils.logLine('Do you need to install dnsmasq RPM >= 2.48-13? Old "dnsmasq --listen-address ' + factoryAddress + '" process still running? Did you disable Zeroconf? Does virbr1 already exist?)')
+   if not measureVolumeGroup(volumeGroup) or name not in volumeGroupModel['volumes']:
+     vac.vacutils.logLine('Failed to get size of ' + volumeGroup + '/' + name)
+     return False
 
-             if fixNetworking:
-               fixNetworkingCommands()
+   size = volumeGroupModel['volumes'][name]
 
-             return False
-           else:  
-             vac.vacutils.logLine('Started previously defined network vac_' + natNetwork)
+   dirtyName = 'vacdirty_%d_%s_%s' % (size, kind, uuid.uuid4().hex[:12])
 
-      # Check the network is set to auto-start
-      if not vacNetwork.autostart():
-           try:
+   if os.system('LVM_SUPPRESS_FD_WARNINGS=1 /sbin/lvrename ' + volumeGroup + ' ' + name + ' ' + dirtyName + ' >/dev/null 2>&1') != 0:
+     vac.vacutils.logLine('Failed to return ' + volumeGroup + '/' + name + ' to the pool')
+     return False
+
+   vac.vacutils.logLine('Returned ' + volumeGroup + '/' + name + ' to the pool as ' + dirtyName)
+   renameModelVolume(name, dirtyName)
+   startPoolWipe(dirtyName)
+   return True
+
+def lockPoolVolume(lvName):
+   # Return an open file holding the lock on wiping pool volume lvName, or None
+
+   try:
+     os.makedirs('/var/lib/vac/lvpool', stat.S_IRUSR|stat.S_IWUSR|stat.S_IXUSR)
+   except:
+     pass
+
+   try:
+     lockFile = open('/var/lib/vac/lvpool/' + lvName.split('_')[-1] + '.lock', 'a')
+     fcntl.flock(lockFile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+   except:
+     return None
+
+   return lockFile
+
+def startPoolWipe(dirtyName):
+   lockFile = lockPoolVolume(dirtyName)
+
+   if lockFile:
+     runDetached(lockFile, wipePoolVolume, dirtyName)
+
+def restartPoolWipes():
+   # Start wiping any dirty pool volumes which nothing is wiping, for
+   # example if vacd was restarted while they were being wiped
+   dirtyIDs = set()
+
+   for (lvName, state, size, kind) in listPoolVolumes():
+     if state == 'dirty':
+       dirtyIDs.add(lvName.split('_')[-1])
+       startPoolWipe(lvName)
+
+   # Remove lock files left by wipes which did not finish cleanly. Old 
+   # ones only, in case a volume has been returned since the model was loaded
+   for lockFileName in glob.glob('/var/lib/vac/lvpool/*.lock'):
+     if os.path.basename(lockFileName)[:-5] in dirtyIDs:
+       continue
+
+     try:
+       if os.stat(lockFileName).st_mtime > time.time() - 86400:
+         continue
+
+       lockFile = open(lockFileName, 'a')
+       fcntl.flock(lockFile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+     except:
+       continue
+
+     try:
+       os.remove(lockFileName)
+     except:
+       pass
+
+     lockFile.close()
+
+def wipePoolVolume(dirtyName):
+   # Discard the contents of a dirty pool volume, make a new filesystem
+   # if it is for containers, and then rename it as ready
+
+   (state, sizeStr, kind, volumeID) = dirtyName.split('_')[0:4]
+   device = '/dev/' + volumeGroup + '/' + dirtyName
+
+   if not os.path.exists(device):
+     # Already wiped since the volume group model was loaded
+     return
+
+   # Discarding is quick on SSDs and thin volumes, and we carry on if not supported
+   os.system('/usr/sbin/blkdiscard ' + device + ' >/dev/null 2>&1')
+
+   if os.system('/usr/sbin/wipefs --all ' + device + ' >/dev/null 2>&1') != 0:
+     raise VacError('wipefs of ' + device + ' fails')
+
+   if kind == 'ext4' and \
+      os.system('/usr/sbin/mke2fs -q -t ext4 -E lazy_itable_init=1,lazy_journal_init=1 ' + device + ' >/dev/null 2>&1') != 0:
+     raise VacError('mke2fs of ' + device + ' fails')
+
+   readyName = 'vacready_%s_%s_%s' % (sizeStr, kind, volumeID)
+
+   if os.system('LVM_SUPPRESS_FD_WARNINGS=1 /sbin/lvrename ' + volumeGroup + ' ' + dirtyName + ' ' + readyName + ' >/dev/null 2>&1') != 0:
+     raise VacError('Renaming ' + dirtyName + ' to ' + readyName + ' fails')
+
+   vac.vacutils.logLine('Pool volume ' + readyName + ' is ready')
+   renameModelVolume(dirtyName, readyName)
+
+   # Each returned volume has a new ID, so its lock file is not needed again
+   try:
+     os.remove('/var/lib/vac/lvpool/' + volumeID + '.lock')
+   except:
+     pass
+
+# How long a successful verification of a CernVM image is trusted for, so
+# that a signer whose certificate is later revoked is noticed
+cernvmImageDataSeconds = 86400
+
+def cernvmImageData(fileName):
+   # Return the result of vac.vacutils.getCernvmImageData() for this image.
+   # Successful verifications are cached in /var/lib/vac/cernvm-image-data 
+   # with the inode, mtime and size of the file and of the CA directory, so
+   # each image version is only hashed and verified once a day unless the CAs
+   # or CRLs change. Failures are not cached, in case they are temporary
+
+   caSignature = list(pathSignature('/etc/grid-security/certificates') or [])
+   signature   = [ list(pathSignature(fileName) or []), caSignature ]
+   timeNow     = int(time.time())
+
+   try:
+     cache = json.load(open('/var/lib/vac/cernvm-image-data', 'r'))
+   except:
+     cache = {}
+
+   if fileName in cache and signature[0] and cache[fileName]['signature'] == signature and \
+      cache[fileName].get('verifiedTime', 0) > timeNow - cernvmImageDataSeconds:
+     return cache[fileName]['data']
+
+   data = vac.vacutils.getCernvmImageData(fileName)
+
+   # Keep only entries for images which are still there and unchanged
+   cache = dict([ (name, cache[name]) for name in cache 
+                  if name != fileName and
+                     cache[name]['signature'] == [ list(pathSignature(name) or []), caSignature ] ])
+
+   if signature[0] and data.get('verified'):
+     cache[fileName] = { 'signature' : signature, 'data' : data, 'verifiedTime' : timeNow }
+
+   try:
+     vac.vacutils.createFile('/var/lib/vac/cernvm-image-data', json.dumps(cache), 
+                             stat.S_IRUSR|stat.S_IWUSR|stat.S_IRGRP|stat.S_IROTH, '/var/lib/vac/tmp')
+   except Exception as e:
+     vac.vacutils.logLine('Failed to save CernVM image verification cache (' + str(e) + ')')
+
+   return data
+
+def cachedRootImage(url):
+   # Return the file name of the cached copy of a remote root_image. This is 
+   # kept up to date by revalidateRootImages() in the background, so the 
+   # network is only used here if this is the first time we have needed it
+
+   fileName = '/var/lib/vac/imagecache/' + urllib.quote(url,'')
+
+   try:
+     # We record the last use as the access time, keeping the modification
+     # time which getRemoteRootImage() sets to the Last-Modified: time
+     os.utime(fileName, (time.time(), os.stat(fileName).st_mtime))
+   except:
+     pass
+   else:
+     return fileName
+
+   return vac.vacutils.getRemoteRootImage(url, '/var/lib/vac/imagecache', '/var/lib/vac/tmp', 'Vac ' + vacVersion)
+
+def compileUserData(machinetypeName):
+   # Compile the user_data template of this machinetype now, so LM creation
+   # subprocesses forked afterwards do not need to read and compile it again
+   try:
+     vac.vacutils.getCompiledUserDataTemplate(machinetypes[machinetypeName]['user_data'],
+                                              machinetypes[machinetypeName]['machinetype_path'],
+                                              'Vac ' + vacVersion,
+                                              userDataCache = '/var/lib/vac/userdatacache',
+                                              tmpDir = '/var/lib/vac/tmp')
+   except Exception as e:
+     vac.vacutils.logLine('Failed to compile user_data of ' + machinetypeName + ' (' + str(e) + ')')
+
+def fetchRootImage(machinetypeName):
+   # Make sure a remote root_image is in the image cache before forking LM
+   # creation subprocesses, so they do not each download it the first time
+   rootImage = str(machinetypes[machinetypeName].get('root_image', ''))
+
+   if rootImage[0:7] != 'http://' and rootImage[0:8] != 'https://':
+     return
+
+   try:
+     cachedRootImage(rootImage)
+   except Exception as e:
+     vac.vacutils.logLine('Failed fetching root_image ' + rootImage + ' (' + str(e) + ')')
+
+def startKeyPoolTopUp():
+   # Keep enough RSA keys ready for the proxies of the LMs which can be 
+   # created in the next minute, generating them in a detached subprocess
+
+   if not [ machinetypeName for machinetypeName in machinetypes if machinetypes[machinetypeName]['user_data_proxy'] ]:
+     return
+
+   try:
+     if len([ fileName for fileName in os.listdir('/var/lib/vac/keypool/' + str(proxyKeyBits)) 
+              if fileName.endswith('.pem') ]) >= max(creationsPerCycle, creationsPerMinute):
+       return
+   except:
+     pass
+
+   try:
+     lockFile = open('/var/lib/vac/keypool.lock', 'a')
+     fcntl.flock(lockFile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+   except:
+     # Still running from last time
+     return
+
+   runDetached(lockFile, vac.vacutils.topUpRsaKeyPool, '/var/lib/vac/keypool', proxyKeyBits, 
+               max(creationsPerCycle, creationsPerMinute), '/var/lib/vac/tmp')
+
+def remoteUserDataURLs():
+   # Return the remote user_data URLs of all the current machinetypes
+   urls = set()
+
+   for machinetypeName in machinetypes:
+     userData = machinetypes[machinetypeName].get('user_data', '')
+
+     if userData.startswith('http://') or userData.startswith('https://'):
+       urls.add(userData)
+
+   return sorted(urls)
+
+def remoteRootImageURLs():
+   # Return the remote root_image URLs of all the current machinetypes
+   urls = set()
+
+   for machinetypeName in machinetypes:
+     rootImage = machinetypes[machinetypeName].get('root_image', '')
+
+     if rootImage.startswith('http://') or rootImage.startswith('https://'):
+       urls.add(rootImage)
+
+   return sorted(urls)
+
+def revalidateRootImages(urls, userDataURLs = []):
+   # Conditional GET of each URL, replacing the cached copy atomically if changed,
+   # and then trim the image cache
+   for url in userDataURLs:
+     try:
+       vac.vacutils.getRemoteFile(url, '/var/lib/vac/userdatacache', '/var/lib/vac/tmp', 'Vac ' + vacVersion, 
+                                  requireLastModified = False, timeout = 30)
+     except Exception as e:
+       vac.vacutils.logLine('Revalidating ' + url + ' fails with: ' + str(e))
+
+   for url in urls:
+     try:
+       vac.vacutils.getRemoteRootImage(url, '/var/lib/vac/imagecache', '/var/lib/vac/tmp', 'Vac ' + vacVersion)
+     except Exception as e:
+       vac.vacutils.logLine('Revalidating ' + url + ' fails with: ' + str(e))
+
+   # Verify new versions of signed CernVM images now, rather than when LMs are created
+   for machinetypeName in machinetypes:
+     if 'cernvm_signing_dn' in machinetypes[machinetypeName] and machinetypes[machinetypeName]['root_image'] in urls:
+       fileName = '/var/lib/vac/imagecache/' + urllib.quote(machinetypes[machinetypeName]['root_image'],'')
+
+       if os.path.isfile(fileName):
+         cernvmImageData(fileName)
+
+   trimImageCache(urls)
+
+def pinnedImageFiles(urls):
+   # Return the set of image cache files which must not be removed: those
+   # of the given URLs, and those used by the current LMs or prestaged
+   # root disks, including qcow2 backing files
+   pinned = set([ '/var/lib/vac/imagecache/' + urllib.quote(url,'') for url in urls ])
+
+   for slotFile in glob.glob('/var/lib/vac/slots/*'):
+     slotValues = readSlotFile(slotFile)
+
+     if slotValues:
+       try:
+         pinned.add(open('/var/lib/vac/machines/' + str(slotValues['created']) + '_' + slotValues['machinetypeName'] + '_' 
+                         + os.path.basename(slotFile) + '/root_image_file', 'r').read().strip())
+       except:
+         pass
+
+   for prestagedFile in glob.glob('/var/lib/vac/prestaged/*'):
+     if prestagedFile.endswith('.lock') or prestagedFile.endswith('.qcow2'):
+       continue
+
+     prestaged = readPrestaged(os.path.basename(prestagedFile))
+
+     if prestaged and prestaged.get('rootImage'):
+       pinned.add(prestaged['rootImage'][0])
+
+   return pinned
+
+def trimImageCache(urls):
+   # Remove unpinned images, least recently used first, until the image
+   # cache is no bigger than image_cache_gb, if that is set
+
+   if imageCacheGB is None:
+     return
+
+   pinned = pinnedImageFiles(urls)
+   images = []
+   totalBytes = 0
+
+   for fileName in glob.glob('/var/lib/vac/imagecache/*'):
+     if fileName.endswith('.etag'):
+       continue
+
+     try:
+       st = os.stat(fileName)
+     except:
+       continue
+
+     totalBytes += st.st_size
+
+     if fileName not in pinned:
+       images.append((st.st_atime, st.st_size, fileName))
+
+   images.sort()
+
+   for (lastUsed, size, fileName) in images:
+     if totalBytes <= imageCacheGB * 1000000000:
+       break
+
+     vac.vacutils.logLine('Removing %s from image cache, last used %s' % (fileName, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(lastUsed))))
+
+     try:
+       os.remove(fileName)
+       totalBytes -= size
+     except Exception as e:
+       vac.vacutils.logLine('Failed to remove %s (%s)' % (fileName, str(e)))
+
+     try:
+       os.remove(fileName + '.etag')
+     except:
+       pass
+
+def startImageRevalidation():
+   # Start revalidating the cached root images and user_data templates in a detached subprocess, 
+   # if not done within the last image_revalidate_seconds
+
+   try:
+     if time.time() < os.stat('/var/lib/vac/imagecache-revalidated').st_mtime + imageRevalidateSeconds:
+       return
+   except:
+     pass
+
+   urls         = remoteRootImageURLs()
+   userDataURLs = remoteUserDataURLs()
+
+   # Even with no remote URLs, images left from earlier configurations may need trimming
+   if not urls and not userDataURLs and imageCacheGB is None:
+     return
+
+   try:
+     lockFile = open('/var/lib/vac/imagecache.lock', 'a')
+     fcntl.flock(lockFile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+   except:
+     # Still running from last time
+     return
+
+   vac.vacutils.createFile('/var/lib/vac/imagecache-revalidated', '', stat.S_IWUSR + stat.S_IRUSR + stat.S_IRGRP + stat.S_IROTH, '/var/lib/vac/tmp')
+   runDetached(lockFile, revalidateRootImages, urls, userDataURLs)
+
+def makeThinTemplate(sizeBytes, kind):
+   # Return the name of the template thin volume of this size and kind, 
+   # creating it if necessary. Templates for containers have an ext4 filesystem
+   # which is fully initialised, so snapshots of it need no formatting I/O
+
+   templateName = 'vactemplate_%d_%s' % (sizeBytes, kind)
+
+   if measureVolumeGroup(volumeGroup) and templateName in volumeGroupModel['volumes']:
+     return templateName
+
+   # Only one subprocess makes each template, and the others wait for it
+   try:
+     os.makedirs('/var/lib/vac/lvpool', stat.S_IRUSR|stat.S_IWUSR|stat.S_IXUSR)
+   except:
+     pass
+
+   lockFile = open('/var/lib/vac/lvpool/' + templateName + '.lock', 'a')
+   fcntl.flock(lockFile.fileno(), fcntl.LOCK_EX)
+
+   try:
+     # Another subprocess may have made it while we waited for the lock
+     if os.system('LVM_SUPPRESS_FD_WARNINGS=1 /sbin/lvs ' + volumeGroup + '/' + templateName + ' >/dev/null 2>&1') == 0:
+       addModelVolume(templateName, sizeBytes, thin = True)
+       return templateName
+
+     vac.vacutils.logLine('Create thin template ' + volumeGroup + '/' + templateName + ' in ' + thinPool)
+
+     # The template is made under a temporary name, so a half-made one is never used
+     os.system('LVM_SUPPRESS_FD_WARNINGS=1 /sbin/lvremove -f ' + volumeGroup + '/' + templateName + '_new >/dev/null 2>&1')
+
+     if os.system('LVM_SUPPRESS_FD_WARNINGS=1 /sbin/lvcreate --yes --thin --virtualsize ' + str(sizeBytes) + 'B --name ' 
+                  + templateName + '_new ' + volumeGroup + '/' + thinPool + ' 2>&1') != 0:
+       raise VacError('Failed to create thin volume ' + templateName + '_new in ' + volumeGroup + '/' + thinPool)
+
+     if kind == 'ext4' and \
+        os.system('/usr/sbin/mke2fs -q -t ext4 -E nodiscard,lazy_itable_init=0,lazy_journal_init=0 /dev/' 
+                  + volumeGroup + '/' + templateName + '_new') != 0:
+       os.system('LVM_SUPPRESS_FD_WARNINGS=1 /sbin/lvremove -f ' + volumeGroup + '/' + templateName + '_new 2>&1')
+       raise VacError('Failed to create filesystem on ' + volumeGroup + '/' + templateName + '_new')
+
+     if os.system('LVM_SUPPRESS_FD_WARNINGS=1 /sbin/lvrename ' + volumeGroup + ' ' + templateName + '_new ' + templateName + ' 2>&1') != 0:
+       raise VacError('Failed to rename ' + templateName + '_new to ' + templateName)
+
+     # Templates are only used as the origins of snapshots
+     os.system('LVM_SUPPRESS_FD_WARNINGS=1 /sbin/lvchange --activate n ' + volumeGroup + '/' + templateName + ' 2>&1')
+     addModelVolume(templateName, sizeBytes, thin = True)
+
+   finally:
+     lockFile.close()
+
+   return templateName
+
+def measureVolumeGroup(vg):
+      # Returns [ size, extent size ] of the volume group in bytes, loading
+      # the model of the volume group if not already done this cycle
+      global volumeGroupModel
+
+      if not vg:
+        return None
+
+      if volumeGroupModel is None or volumeGroupModel['name'] != vg:
+        volumeGroupModel = loadVolumeGroupModel(vg)
+
+        if volumeGroupModel is None:
+          return None
+
+      return [ volumeGroupModel['sizeBytes'], volumeGroupModel['extentBytes'] ]
+
+def loadVolumeGroupModel(vg):
+      # Make a model of the volume group and its logical volumes from one
+      # LVM report, since LVM commands take a global lock and can be slow
+
+      try:
+        report = json.loads(os.popen('LVM_SUPPRESS_FD_WARNINGS=1 /sbin/vgs --reportformat json --units b --nosuffix '
+                                     '--options vg_name,vg_size,vg_free,vg_extent_size,lv_name,lv_size ' + vg + ' 2>/dev/null', 'r').read())
+        rows = report['report'][0]['vg']
+      except Exception as e:
+        vac.vacutils.logLine('Failed to measure size of volume group %s (%s)' % (vg, str(e)))
+        return None
+
+      if not rows:
+        return None
+
+      model = { 'name'        : vg,
+                'sizeBytes'   : int(rows[0]['vg_size']),
+                'freeBytes'   : int(rows[0]['vg_free']),
+                'extentBytes' : int(rows[0]['vg_extent_size']),
+                'volumes'     : {} }
+
+      # vgs gives one row for each logical volume, or one row with no lv_name
+      for row in rows:
+        if row.get('lv_name'):
+          model['volumes'][row['lv_name']] = int(row['lv_size'])
+
+      return model
+
+def addModelVolume(name, sizeBytes, thin = False):
+      # Record a logical volume Vac has created. Thin volumes use space in 
+      # the thin pool rather than in the volume group itself
+      if volumeGroupModel:
+        volumeGroupModel['volumes'][name] = sizeBytes
+
+        if not thin:
+          volumeGroupModel['freeBytes'] -= sizeBytes
+
+def removeModelVolume(name):
+      if volumeGroupModel and name in volumeGroupModel['volumes']:
+        sizeBytes = volumeGroupModel['volumes'].pop(name)
+
+        if volumeGroupMode != 'thin':
+          volumeGroupModel['freeBytes'] += sizeBytes
+
+def renameModelVolume(oldName, newName):
+      if volumeGroupModel and oldName in volumeGroupModel['volumes']:
+        volumeGroupModel['volumes'][newName] = volumeGroupModel['volumes'].pop(oldName)
+
+def volumeGroupUsage():
+      # Returns [ size, extent size, bytes used by Vac, bytes used by others ]
+      # for the volume group, from the model
+      try:
+        vgsResult = measureVolumeGroup(volumeGroup)
+        vgTotalBytes = int(vgsResult[0])
+        vgExtentBytes = int(vgsResult[1])
+      except Exception as e:
+        raise VacError('Failed to measure size of volume group ' + str(volumeGroup) + ' - missing?')
+
+      vgVacBytes = 0
+      vgNonVacBytes = 0
+      nameParts = os.uname()[1].split('.',1)
+      domainRegex = nameParts[1].replace('.','\.')
+
+      for (name, size) in volumeGroupModel['volumes'].items():
+        if re.search('^' + nameParts[0] + '-[0-9][0-9]\.' + domainRegex + '$', name) is None and \
+           re.search(poolVolumeRegex, name) is None:
+         vgNonVacBytes += size
+        else:
+         vgVacBytes += size
+
+      return [ vgTotalBytes, vgExtentBytes, vgVacBytes, vgNonVacBytes ]
+
+def machinetypeGbDiskPerProcessor(machinetypeName):
+      # The machinetype's disk_gb_per_processor if no more than the global
+      # setting, otherwise the global setting which may be None
+      if 'disk_gb_per_processor' in machinetypes[machinetypeName] and \
+           ((gbDiskPerProcessor is None) or (machinetypes[machinetypeName]['disk_gb_per_processor'] <= gbDiskPerProcessor)):
+        return machinetypes[machinetypeName]['disk_gb_per_processor']
+
+      return gbDiskPerProcessor
+
+def logicalVolumeBytes(gbPerProcessor, processors, vgTotalBytes, vgExtentBytes, vgNonVacBytes):
+      if gbPerProcessor:
+        # Fixed size has been given in configuration. Round down to match extent size.
+        return ((gbPerProcessor * processors * 1000000000) / vgExtentBytes) * vgExtentBytes
+
+      # Not given, so calculate. Round down to match extent size.
+      return ((processors * (vgTotalBytes - vgNonVacBytes) / numProcessors) / vgExtentBytes) * vgExtentBytes
+
+def dockerPsCommand():
+      # Return a dictionary of currently defined Docker containers, filtered
+      # by the pattern of names Vac creates on this host.
+      # We use the docker command rather than the API for portability
+
+      if not os.path.isfile(dockerPath) or not os.access(dockerPath, os.X_OK):
+        return {}
+      
+      host,domain = os.uname()[1].split('.',1)
+
+      # Get the output of docker ps
+      pp = subprocess.Popen(dockerPath + ' ps --all --no-trunc --format "{{.Names}} {{.ID}} {{.Image}} {{.Status}} ."', 
+                            shell=True, stdout=subprocess.PIPE).stdout
+
+      containers = {}
+
+      for line in pp:
+        try:
+          name, id, image, status, rest = line.split(None, 4)
+        except:
+          continue          
+
+        if name.startswith(host + '-') and name.endswith('.' + domain):
+          containers[name] = { "id" : id, "image" : image, "status" : status }
+          
+      pp.close()
+      
+      # Merge in values from the output of docker inspect
+      if containers:
+        pp = subprocess.Popen(dockerPath + ' inspect --format "{{.Name}} {{.State.Pid}}" ' + ' '.join([i for i in containers]),
+                            shell=True, stdout=subprocess.PIPE).stdout
+
+        for line in pp:
+          try:
+            name, pidStr = line.split()
+          except:
+            continue
+
+          if name[0] == '/':
+            name = name[1:]
+
+          if name in containers:
+            # Add pid value to the dictionary entry
+            containers[name]['pid'] = int(pidStr)
+          
+        pp.close()
+      
+      return containers        
+
+# Snapshot of our Docker containers shared by everything in a cycle
+dockerContainers = None
+
+def getDockerContainers():
+      # Return the dictionary from dockerPsCommand() with the CPU seconds
+      # of each running container added, only running docker the first 
+      # time this is called in the cycle
+      global dockerContainers
+
+      if dockerContainers is not None:
+        return dockerContainers
+
+      # Exceptions are passed up, and docker is tried again next time
+      containers = dockerPsCommand()
+
+      for name in containers:
+        containers[name]['cpuSeconds'] = 0
+
+        if containers[name]['status'] == 'Up' and containers[name].get('pid'):
+          try:
+            containers[name]['cpuSeconds'] = int(open(getProcessCpuCgroupPath(containers[name]['pid']) + '/cpuacct.usage', 'r').read()) / 1000000000
+          except:
+            pass
+
+      dockerContainers = containers
+      return dockerContainers
+
+def dockerRunCommand(rwBindsList, roBindsList, name, image, script, cpuShares, memoryBytes):
+      # Run a Docker container 
+      # We use the docker command rather than the API for portability
+      
+      binds = ''
+      
+      for i in rwBindsList:
+        binds += '-v %s:%s ' % (i[0], i[1])
+            
+      for i in roBindsList:
+        binds += '-v %s:%s:ro ' % (i[0], i[1])
+            
+      cmd = dockerPath + ' run --detach --cpu-shares %d --memory-reservation %d %s --name %s --hostname %s %s %s' % (cpuShares, memoryBytes, binds, name, name, image, script)
+      vac.vacutils.logLine('Creating DC with ' + cmd)
+
+      pp = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE).stdout
+                            
+      id = pp.readline().strip()
+      
+      pp.close()
+
+      if id and dockerContainers is not None:
+        dockerContainers[name] = { "id" : id, "image" : image, "status" : "Up", "cpuSeconds" : 0 }
+
+      return id
+
+def dockerRmCommand(name):
+      # Remove Docker container by name
+      # We use the docker command rather than the API for portability
+      
+      subprocess.call(dockerPath + ' rm --force %s' % name, shell=True)
+
+      if dockerContainers is not None:
+        dockerContainers.pop(name, None)
+
+def checkNetwork():
+      # Check and if necessary create network and set its attributes
+
+      try:
+        conn = getLibvirtConn()
+      except Exception as e:
+        vac.vacutils.logLine(str(e))
+        return False
+      
+      try:
+           # Find the network if already defined
+           vacNetwork = conn.networkLookupByName('vac_' + natNetwork)           
+      except:
+           vacNetwork = None
+      else:
+           if not re.search("<ip[^>]*address='" + factoryAddress + "'", vacNetwork.XMLDesc(1)):
+             # The network does not have the right IP address!
+             vac.vacutils.logLine('vac_' + natNetwork + ' defined with wrong IP address - removing!')
+
+             try:
+               vacNetwork.destroy()
+             except:
+               pass
+            
+             try:
+               vacNetwork.undefine()
+             except:
+               pass
+
+             # Probably need to do this too:                            
+             fixNetworkingCommands()
+             
+             # Remember we removed it
+             vacNetwork = None
+           
+      if not vacNetwork:
+           # Doesn't exist so we define it
+           vac.vacutils.logLine('No libvirt network vac_' + natNetwork + ' defined for NAT') 
+           
+           nameParts = os.uname()[1].split('.',1)
+
+           dhcpXML = ""
+ 
+           ordinal = 0
+           while ordinal < 100:
+    
+              ip      = natPrefix + str(ordinal)
+              ipBytes = ip.split('.')        
+              mac     = '56:4D:%02X:%02X:%02X:%02X' % (int(ipBytes[0]), int(ipBytes[1]), int(ipBytes[2]), int(ipBytes[3]))
+              vmName  = nameParts[0] + '-%02d' % ordinal + '.' + nameParts[1]
+              hostsLine = ip + ' ' + nameParts[0] + '-%02d' % ordinal + ' ' + vmName + ' # added by Vac'
+
+              dhcpXML += "   <host mac='" + mac + "' name='" + vmName + "' ip='" + ip + "'/>\n"
+              ordinal += 1
+
+              # append a line for this VM to /etc/hosts if not already present
+              with open('/etc/hosts', 'r') as f:
+                if not hostsLine in f.read():
+                  f.close()
+                  with open('/etc/hosts', 'a') as g:
+                    g.write(hostsLine + '\n')
+
+           netXML = "<network>\n <name>vac_" + natNetwork + "</name>\n <forward mode='nat'"
+           
+           if forwardDev:
+             netXML += " dev='" + forwardDev + "'"
+           
+           netXML += "/>\n <ip address='" + factoryAddress + "' netmask='" + natNetmask + "'>\n"
+           netXML += "  <dhcp>\n" + dhcpXML + "</dhcp>\n </ip>\n</network>\n"
+      
+           try:
+             vacNetwork = conn.networkDefineXML(netXML)
+           except Exception as e:  
+             vac.vacutils.logLine('Failed to define network vac_' + natNetwork + ' due to "' + str(e) + '"')
+             return False
+           else:
+             vac.vacutils.logLine('Defined network vac_' + natNetwork)
+
+      # Check the network is actually running, not just defined    
+      if not vacNetwork.isActive():    
+           try:  
+             # Try starting it if not running
+             vacNetwork.create()
+           except Exception as e:  
+             vac.vacutils.logLine('Starting defined network vac_' + natNetwork + ' fails with "' + str(e) + '"')
+             vac.vacutils.logLine('Do you need to install dnsmasq RPM >= 2.48-13? Old "dnsmasq --listen-address ' + factoryAddress + '" process still running? Did you disable Zeroconf? Does virbr1 already exist?)')
+
+             if fixNetworking:
+               fixNetworkingCommands()
+
+             return False
+           else:  
+             vac.vacutils.logLine('Started previously defined network vac_' + natNetwork)
+
+      # Check the network is set to auto-start
+      if not vacNetwork.autostart():
+           try:
              # Try setting autostart
              vacNetwork.setAutostart(True)
            except Exception as e:
@@ -2531,6 +3911,97 @@ def cleanupOldMachines():
         # Skip if no heartbeat yet
         continue
 
+# Bodies of MJF and metadata responses for each slot, kept in memory by the
+# threaded httpd processes. Each slot's entry is checked against the LM's 
+# directories at most once every httpBodyCacheSeconds, and emptied if any 
+# have changed. Files in them are always replaced by renaming
+httpBodyCache        = {}
+httpBodyCacheLock    = threading.Lock()
+httpBodyCacheSeconds = 1.0
+httpBodyCacheMaxPaths = 100
+
+# Map of NAT addresses to (machineName, slot values) for the httpd processes,
+# rebuilt when the slots directory changes since slot files are replaced by renaming
+slotsByAddress          = {}
+slotsByAddressSignature = None
+slotsByAddressChecked   = 0.0
+
+def slotForAddress(address):
+   # Return (machineName, slotValues) of the slot using this NAT address, or (None, None)
+   global slotsByAddress, slotsByAddressSignature, slotsByAddressChecked
+
+   now = time.time()
+
+   with httpBodyCacheLock:
+     if now > slotsByAddressChecked + httpBodyCacheSeconds:
+       signature = pathSignature('/var/lib/vac/slots')
+
+       if signature != slotsByAddressSignature:
+         newSlotsByAddress = {}
+         host = os.uname()[1].split('.',1)[0]
+
+         try:
+           names = os.listdir('/var/lib/vac/slots')
+         except:
+           names = []
+
+         for name in names:
+           match = re.search('^' + re.escape(host) + '-([0-9]+)\.', name)
+
+           if match:
+             slotValues = readSlotFile('/var/lib/vac/slots/' + name)
+
+             if slotValues:
+               newSlotsByAddress[ipFromOrdinal(int(match.group(1)))] = (name, slotValues)
+
+         slotsByAddress          = newSlotsByAddress
+         slotsByAddressSignature = signature
+
+       slotsByAddressChecked = now
+
+     return slotsByAddress.get(address, (None, None))
+
+def cachedHttpBody(machineName, slotValues, path, makeBodyFunction):
+   # Return the body for path in slot machineName, from the cache or made with
+   # makeBodyFunction(created, machinetypeName, machineName, path). None means 404
+   now = time.time()
+
+   with httpBodyCacheLock:
+     entry = httpBodyCache.get(machineName)
+
+     if entry is None or \
+        entry['created'] != slotValues['created'] or \
+        entry['machinetypeName'] != slotValues['machinetypeName']:
+       # A new LM in this slot
+       entry = { 'created'         : slotValues['created'],
+                 'machinetypeName' : slotValues['machinetypeName'],
+                 'dirsSignature'   : None,
+                 'checked'         : 0.0,
+                 'bodies'          : {} }
+       httpBodyCache[machineName] = entry
+
+     if now > entry['checked'] + httpBodyCacheSeconds:
+       machinesDir   = '/var/lib/vac/machines/' + str(entry['created']) + '_' + entry['machinetypeName'] + '_' + machineName
+       dirsSignature = (pathSignature(machinesDir), 
+                        pathSignature(machinesDir + '/machinefeatures'), 
+                        pathSignature(machinesDir + '/jobfeatures'))
+
+       if dirsSignature != entry['dirsSignature'] or len(entry['bodies']) >= httpBodyCacheMaxPaths:
+         entry['dirsSignature'] = dirsSignature
+         entry['bodies']        = {}
+
+       entry['checked'] = now
+
+     if path in entry['bodies']:
+       return entry['bodies'][path]
+
+   body = makeBodyFunction(entry['created'], entry['machinetypeName'], machineName, path)
+
+   with httpBodyCacheLock:
+     entry['bodies'][path] = body
+
+   return body
+
 def makeMjfBody(created, machinetypeName, machineName, path):
 
    if '/../' in path:
@@ -2575,6 +4046,83 @@ def makeMjfBody(created, machinetypeName, machineName, path):
 
    return None
 
+def metadataUserData(machinesDir, machinetypeName, machineName):
+   # EC2 or OpenStack user-data
+   try:
+     return open(machinesDir + '/user_data', 'r').read()
+   except Exception as e:
+     return None
+
+def metadataMetaDataJson(machinesDir, machinetypeName, machineName):
+   # EC2 or OpenStack meta-data.json
+   metaData = { 'availability_zone': os.uname()[1] }
+
+   try:
+     publicKey = open(machinesDir + '/root_public_key', 'r').read()
+   except:
+     pass
+   else:
+     metaData['public_keys'] = { "0" : publicKey }
+
+   try:
+    uuidStr = open(machinesDir + '/jobfeatures/job_id', 'r').read()
+   except:
+    pass
+   else:
+    metaData['uuid'] = uuidStr
+
+   metaData['hostname'] = machineName
+   metaData['name']     = machineName
+
+   metaData['meta'] = {
+                         'machinefeatures' : 'http://' + mjfAddress + '/machinefeatures',
+                         'jobfeatures'     : 'http://' + mjfAddress + '/jobfeatures',
+                         'joboutputs'      : 'http://' + mjfAddress + '/joboutputs',
+                         'machinetype'     : machinetypeName
+                       }      
+   try:
+     return json.dumps(metaData)
+   except Exception as e:
+     return None
+
+def metadataListing(machinesDir, machinetypeName, machineName):
+   # meta-data directory listing
+   body = ''
+
+   for fileName in ['public-keys/0/openssh-key', 'ami-id', 'instance-id']:
+     body += fileName + '\n'
+       
+   return body
+
+def metadataSshKey(machinesDir, machinetypeName, machineName):
+   # EC2 SSH key
+   try:
+     return open(machinesDir + '/root_public_key', 'r').read()
+   except:
+     return None
+
+def metadataInstanceId(machinesDir, machinetypeName, machineName):
+   # Return UUID for EC2 instance-id, and for ami-id (at least it's something unique)
+   try:
+     return open(machinesDir + '/jobfeatures/job_id', 'r').read()
+   except:
+     return None
+
+# Table of compiled patterns of metadata paths and the functions which make 
+# their bodies, tried in order. /latest/ is already changed to /0000-00-00/
+metadataRoutes = [
+   (re.compile('^/[0-9]{4}-[0-9]{2}-[0-9]{2}/user-data$|^/openstack/[0-9]{4}-[0-9]{2}-[0-9]{2}/user-data$'), 
+    metadataUserData),
+   (re.compile('^/[0-9]{4}-[0-9]{2}-[0-9]{2}/meta-data\.json$|^/openstack/[0-9]{4}-[0-9]{2}-[0-9]{2}/meta-data\.json$'),
+    metadataMetaDataJson),
+   (re.compile('^/[0-9]{4}-[0-9]{2}-[0-9]{2}/meta-data/?$|^/openstack/[0-9]{4}-[0-9]{2}-[0-9]{2}/meta-data/?$'),
+    metadataListing),
+   (re.compile('^/[0-9]{4}-[0-9]{2}-[0-9]{2}/meta-data/public-keys/0/openssh-key$'),
+    metadataSshKey),
+   (re.compile('^/[0-9]{4}-[0-9]{2}-[0-9]{2}/meta-data/ami-id$|^/[0-9]{4}-[0-9]{2}-[0-9]{2}/meta-data/instance-id$'),
+    metadataInstanceId)
+  ]
+
 def makeMetadataBody(created, machinetypeName, machineName, path):
 
    machinesDir = '/var/lib/vac/machines/' + str(created) + '_' + machinetypeName + '_' + machineName
@@ -2582,365 +4130,656 @@ def makeMetadataBody(created, machinetypeName, machineName, path):
    # Fold // to /, and /latest/ to something that will match a dated version
    requestURI = path.replace('//','/').replace('/latest/','/0000-00-00/')
 
-   # EC2 or OpenStack user-data
-   if re.search('^/[0-9]{4}-[0-9]{2}-[0-9]{2}/user-data$|^/openstack/[0-9]{4}-[0-9]{2}-[0-9]{2}/user-data$', requestURI):
-     try:
-       return open(machinesDir + '/user_data', 'r').read()
-     except Exception as e:
-       return None
+   for (pattern, bodyFunction) in metadataRoutes:
+     if pattern.match(requestURI):
+       return bodyFunction(machinesDir, machinetypeName, machineName)
 
-   # EC2 or OpenStack meta-data.json
-   if re.search('^/[0-9]{4}-[0-9]{2}-[0-9]{2}/meta-data\.json$|^/openstack/[0-9]{4}-[0-9]{2}-[0-9]{2}/meta-data\.json$', requestURI):
-     metaData = { 'availability_zone': os.uname()[1] }
+   # No body (and therefore 404) if we don't recognise the request
+   return None
 
-     try:
-       publicKey = open(machinesDir + '/root_public_key', 'r').read()
-     except:
-       pass
-     else:
-       metaData['public_keys'] = { "0" : publicKey }
+def writePutBody(created, machinetypeName, machineName, path, body):
 
-     try:
-      uuidStr = open(machinesDir + '/jobfeatures/job_id', 'r').read()
-     except:
-      pass
+   # Fold // to /
+   requestURI = path.replace('//','/')
+   
+   splitRequestURI = requestURI.split('/')
+   
+   if len(splitRequestURI) != 3 or splitRequestURI[1] != 'joboutputs' or not splitRequestURI[2]:
+     return False
+
+   machinesDir = '/var/lib/vac/machines/' + str(created) + '_' + machinetypeName + '_' + machineName
+   
+   try:
+     vac.vacutils.createFile(machinesDir + '/joboutputs/' + splitRequestURI[2],
+                             body,
+                             stat.S_IWUSR + stat.S_IRUSR + stat.S_IRGRP + stat.S_IROTH, '/var/lib/vac/tmp')
+   except Exception as e:
+     vac.vacutils.logLine('Failed to write ' + machinesDir + '/joboutputs/' + splitRequestURI[2] + ' (' + str(e) + ')')
+     return False
+
+   vac.vacutils.logLine('Wrote ' + machinesDir + '/joboutputs/' + splitRequestURI[2])
+   return True
+
+# Smoothed round trip time and its variation for each factory we have queried,
+# in seconds, used to decide when to send queries again
+factoryRoundTrips = {}
+
+def vacQueryTimeout(factoryName):
+   # How long to wait for the first reply from a factory before asking again, 
+   # as for TCP in RFC 6298, but limited to what we waited before we kept 
+   # estimates of the round trip time
+   try:
+     (smoothedRtt, rttVariation) = factoryRoundTrips[factoryName]
+   except:
+     return udpTimeoutSeconds / vacqueryTries
+
+   return min(max(smoothedRtt + 4 * rttVariation, 0.2), udpTimeoutSeconds / vacqueryTries)
+
+def updateRoundTrip(factoryName, rttSample):
+   try:
+     (smoothedRtt, rttVariation) = factoryRoundTrips[factoryName]
+   except:
+     factoryRoundTrips[factoryName] = (rttSample, rttSample / 2)
+   else:
+     rttVariation = 0.75 * rttVariation + 0.25 * abs(smoothedRtt - rttSample)
+     smoothedRtt  = 0.875 * smoothedRtt + 0.125 * rttSample
+     factoryRoundTrips[factoryName] = (smoothedRtt, rttVariation)
+
+def sendVacQueries(factoryList, queryValues, handleResponse, isComplete):
+   # Send the VacQuery query given by the dictionary queryValues to each of
+   # the factories, and call handleResponse(factoryName, response) for each 
+   # reply with the right space and cookie. Queries are sent again only to 
+   # factories for which isComplete(factoryName) is False, after a timeout 
+   # based on the round trip time to that factory. This returns when all the
+   # factories are complete, or after udpTimeoutSeconds, whichever is first.
+
+   salt = base64.b64encode(os.urandom(32))
+   sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+   setSockBufferSize(sock)
+
+   startTime = monotonicTime()
+   deadline  = startTime + udpTimeoutSeconds
+   pending   = {}
+   cookies   = {}
+
+   for rawFactoryName in factoryList:
+     factoryName = canonicalFQDN(rawFactoryName)
+     cookies[hashlib.sha256(salt + factoryName).hexdigest()] = factoryName
+
+     # When we last sent or received something, the timeout, and queries sent
+     pending[factoryName] = { 'lastActivity' : startTime, 
+                              'lastSent'     : None,
+                              'timeout'      : 0.0,
+                              'sentCount'    : 0 }
+
+   while pending:
+     timeNow = monotonicTime()
+
+     if timeNow >= deadline:
+       break
+
+     # Send queries to factories whose timeout has passed
+     for factoryName in pending.keys():
+       if timeNow < pending[factoryName]['lastActivity'] + pending[factoryName]['timeout']:
+         continue
+
+       if pending[factoryName]['sentCount'] > vacqueryTries:
+         # Give up on this one
+         del pending[factoryName]
+         continue
+
+       queryValues['cookie'] = hashlib.sha256(salt + factoryName).hexdigest()
+
+       try:
+         sock.sendto(json.dumps(queryValues), (factoryName, 995))
+       except socket.error:
+         pass
+
+       if pending[factoryName]['sentCount'] == 0:
+         pending[factoryName]['timeout'] = vacQueryTimeout(factoryName)
+       else:
+         # Back off, in case the factory or the network is overloaded
+         pending[factoryName]['timeout'] *= 2
+
+       pending[factoryName]['sentCount']   += 1
+       pending[factoryName]['lastSent']     = timeNow
+       pending[factoryName]['lastActivity'] = timeNow
+
+     if not pending:
+       break
+
+     # Wait for replies until the next timeout or the deadline
+     waitUntil = min([ pending[factoryName]['lastActivity'] + pending[factoryName]['timeout'] for factoryName in pending ] + [ deadline ])
+
+     while True:
+       timeNow = monotonicTime()
+       
+       if timeNow >= waitUntil:
+         break
+
+       sock.settimeout(waitUntil - timeNow)
+
+       try:
+         data, addr = sock.recvfrom(10240)
+       except socket.error:
+         # timed-out so see what needs to be sent again
+         break
+
+       try:
+         response = json.loads(data)
+       except:
+         vac.vacutils.logLine('json.loads failed for ' + data)
+         continue
+
+       try:
+         factoryName = cookies[response['cookie']]
+       except:
+         continue
+
+       if 'space' not in response or response['space'] != spaceName or \
+          'factory' not in response or response['factory'] != factoryName:
+         continue
+
+       if factoryName in pending:
+         timeNow = monotonicTime()
+
+         if pending[factoryName]['sentCount'] == 1 and pending[factoryName]['lastSent'] is not None:
+           # As in Karn's algorithm, only time replies to queries sent once
+           updateRoundTrip(factoryName, timeNow - pending[factoryName]['lastSent'])
+           pending[factoryName]['lastSent'] = None
+
+         pending[factoryName]['lastActivity'] = timeNow
+
+       handleResponse(factoryName, response)
+
+       if factoryName in pending and isComplete(factoryName):
+         del pending[factoryName]
+
+         if not pending:
+           break
+
+   sock.close()
+
+def sendMachinetypesRequests(factoryList = None, clientName = '-'):
+
+   if factoryList is None:
+     factoryList = factories
+
+   # Initialise dictionary of per-factory, per-machinetype responses
+   responses = {}
+
+   for rawFactoryName in factoryList:
+     responses[canonicalFQDN(rawFactoryName)] = { 'machinetypes' : {} }
+
+   def handleResponse(factoryName, response):
+# should check types as well as presence!
+     if 'message_type' in response and response['message_type'] == 'machinetype_status' and \
+        'num_machinetypes'	in response and \
+        'machinetype'		in response and \
+        'running_hs06'		in response and \
+        'num_before_fizzle'	in response and \
+        'shutdown_message'	in response and \
+        'shutdown_time'		in response and \
+        'shutdown_machine'	in response:
+              
+       responses[factoryName]['num_machinetypes'] = response['num_machinetypes']
+
+       responses[factoryName]['machinetypes'][response['machinetype']] = response
+
+   def isComplete(factoryName):
+     # We initially expect every factory to tell us about at least 1 machinetype
+     return len(responses[factoryName]['machinetypes']) >= responses[factoryName].get('num_machinetypes', 1)
+
+   sendVacQueries(factoryList,
+                  { 'vac_version'      : 'Vac ' + vacVersion + ' ' + clientName,
+                    'vacquery_version' : 'VacQuery ' + vacQueryVersion,
+                    'space'            : spaceName,
+                    'message_type'     : 'machinetypes_query' },
+                  handleResponse, isComplete)
+
+   return responses
+
+def sendMachinesRequests(factoryList = None, clientName = '-'):
+
+   if factoryList is None:
+     factoryList = factories
+
+   # Initialise dictionary of per-factory, per-machine responses
+   responses = {}
+
+   for rawFactoryName in factoryList:   
+     responses[canonicalFQDN(rawFactoryName)] = { 'machines' : {} }
+
+   def handleResponse(factoryName, response):
+     if 'message_type' in response and response['message_type'] == 'machine_status_list' and \
+        'records' in response and isinstance(response['records'], list):
+       # Several machine_status records sharing the values in the rest of the message
+       unpackedResponses = []
+
+       for record in response.pop('records'):
+         if isinstance(record, dict):
+           unpackedResponse = response.copy()
+           unpackedResponse.update(record)
+           unpackedResponse['message_type'] = 'machine_status'
+           unpackedResponses.append(unpackedResponse)
      else:
-      metaData['uuid'] = uuidStr
+       unpackedResponses = [ response ]
+
+     for response in unpackedResponses:
+# should check types as well as presence!
+       if 'message_type' in response and response['message_type'] == 'machine_status' and \
+          'num_machines'	in response and \
+          'machine'		in response and \
+          'state'		in response and \
+          'uuid'		in response and \
+          'created_time'	in response and \
+          'started_time'	in response and \
+          'heartbeat_time'	in response and \
+          'cpu_seconds'		in response and \
+          'cpu_percentage'	in response and \
+          'hs06'		in response and \
+          'machinetype'		in response and \
+          'shutdown_message'	in response and \
+          'shutdown_time'	in response:
+              
+         responses[factoryName]['num_machines'] = response['num_machines']
+             
+         responses[factoryName]['machines'][response['machine']] = response
 
-     metaData['hostname'] = machineName
-     metaData['name']     = machineName
+   def isComplete(factoryName):
+     # We initially expect every factory to tell us about at least 1 machine
+     return len(responses[factoryName]['machines']) >= responses[factoryName].get('num_machines', 1)
 
-     metaData['meta'] = {
-                           'machinefeatures' : 'http://' + mjfAddress + '/machinefeatures',
-                           'jobfeatures'     : 'http://' + mjfAddress + '/jobfeatures',
-                           'joboutputs'      : 'http://' + mjfAddress + '/joboutputs',
-                           'machinetype'     : machinetypeName
-                         }      
-     try:
-       return json.dumps(metaData)
-     except Exception as e:
-       return None
+   sendVacQueries(factoryList,
+                  { 'vac_version'       : 'Vac ' + vacVersion + ' ' + clientName,
+                    'vacquery_version'  : 'VacQuery ' + vacQueryVersion,
+                    'space'             : spaceName,
+                    'method'            : 'machines', # will be deprecated
+                    'message_type'      : 'machines_query',
+                    'max_payload_bytes' : maxPayloadBytes },
+                  handleResponse, isComplete)
 
-   # meta-data directory listing
-   if re.search('^/[0-9]{4}-[0-9]{2}-[0-9]{2}/meta-data/?$|^/openstack/[0-9]{4}-[0-9]{2}-[0-9]{2}/meta-data/?$', requestURI):
-     body = ''
+   return responses
 
-     for fileName in ['public-keys/0/openssh-key', 'ami-id', 'instance-id']:
-       body += fileName + '\n'
-         
-     return body
+def sendFactoriesRequests(factoryList = None, clientName = '-'):
+
+   if factoryList is None:
+     factoryList = factories
+
+   # Initialise dictionary of per-factory responses
+   responses = {}
+
+   def handleResponse(factoryName, response):
+     if 'message_type' in response and response['message_type'] == 'factory_status':
+       responses[factoryName] = response
+
+   def isComplete(factoryName):
+     return factoryName in responses
+
+   sendVacQueries(factoryList,
+                  { 'vac_version'      : 'Vac ' + vacVersion,
+                    'vacquery_version' : 'VacQuery ' + vacQueryVersion,
+                    'space'            : spaceName,
+                    'method'           : 'factories',
+                    'message_type'     : 'factory_query' },
+                  handleResponse, isComplete)
+
+   return responses
+
+# The status table is a file vacd-factory keeps up to date with the state of
+# each slot, each machinetype, and the factory as a whole. The responder and 
+# the vac command map it into memory, so that answering a query does not 
+# involve reading the files of every slot. It begins with a header of magic
+# string, generation, number of slot records, number of machinetype records,
+# and record size. Then come the factory record, the slot records in order of
+# ordinal, and the machinetype records. Each record is a 4 byte length then
+# that many bytes of JSON, padded to the record size. Writers hold a flock() 
+# on status-table.lock and make the generation odd while they are writing, so readers
+# can see if they need to try again, as with a Linux kernel seqlock.
+statusTableFile         = '/var/lib/vac/status-table'
+statusTableMagic        = 'VACSTAT1'
+statusTableHeaderFormat = '<8sQIII4x'
+statusTableHeaderBytes  = struct.calcsize(statusTableHeaderFormat)
+statusTableRecordBytes  = 4096
+
+# Used by readers to keep the table mapped between queries, along with
+# the last copy they read from it
+statusTableInode = None
+statusTableMap   = None
+statusTableCopy  = None
+
+# The last result of machinetypeAggregates() with its generation, time
+# and the machinetypes dictionary it was made for
+machinetypeAggregatesCache = None
+
+def slotStatusValues(lmSlot):
+   # The values from one VacSlot that go into its status table record
+   return { 'state'               : lmSlot.state,
+            'machinetypeName'     : lmSlot.machinetypeName,
+            'machineModel'        : lmSlot.machineModel,
+            'uuidStr'             : lmSlot.uuidStr,
+            'created'             : lmSlot.created,
+            'started'             : lmSlot.started,
+            'heartbeat'           : lmSlot.heartbeat,
+            'finished'            : lmSlot.finished,
+            'processors'          : lmSlot.processors,
+            'cpuSeconds'          : lmSlot.cpuSeconds,
+            'cpuPercentage'       : lmSlot.cpuPercentage,
+            'hs06'                : lmSlot.hs06,
+            'accountingFqan'      : lmSlot.accountingFqan,
+            'shutdownMessage'     : lmSlot.shutdownMessage,
+            'shutdownMessageTime' : lmSlot.shutdownMessageTime }
+
+def machinetypeShutdownValues(machinetypeName):
+   # Outcome of the most recently created instance of this machinetype that has already finished
+
+   shutdownMessage     = None
+   shutdownMessageTime = None
+   shutdownMachineName = None
+
+   try:
+     # Updated by createFinishedFile()
+     shutdownCreated, shutdownMachinetypeName, shutdownMachineName = open('/var/lib/vac/finishes/' + machinetypeName, 'r').readline().strip().split()
+       
+   except:
+     pass
+   else:
+     machineDir = '/var/lib/vac/machines/%s_%s_%s' % (shutdownCreated, shutdownMachinetypeName, shutdownMachineName)
 
-   # EC2 SSH key
-   if re.search('^/[0-9]{4}-[0-9]{2}-[0-9]{2}/meta-data/public-keys/0/openssh-key$', requestURI):
-     try:
-       return open(machinesDir + '/root_public_key', 'r').read()
-     except:
-       return None
-   
-   # Return UUID for EC2 instance-id, and for ami-id (at least it's something unique)
-   if re.search('^/[0-9]{4}-[0-9]{2}-[0-9]{2}/meta-data/ami-id$|^/[0-9]{4}-[0-9]{2}-[0-9]{2}/meta-data/instance-id$', requestURI):
      try:
-       return open(machinesDir + '/jobfeatures/job_id', 'r').read()
+       shutdownMessage = open(machineDir + '/joboutputs/shutdown_message','r').readline().strip()
+       messageCode = int(shutdownMessage[0:3])
+       shutdownMessageTime = int(os.stat(machineDir + '/joboutputs/shutdown_message').st_ctime)
      except:
-       return None
+       # No explicit shutdown message with a message code, so we make one up if necessary
+         
+       try:
+         timeStarted   = int(os.stat(machineDir + '/started').st_ctime)
+         timeHeartbeat = int(os.stat(machineDir + '/heartbeat').st_ctime)
+       except:
+         pass
+       else:
+         if (timeHeartbeat - timeStarted) < machinetypes[machinetypeName]['fizzle_seconds']:
+           shutdownMessageTime = timeHeartbeat
+           shutdownMessage = '300 Vac detects fizzle after ' + str(timeHeartbeat - timeStarted) + ' seconds'
 
-   # No body (and therefore 404) if we don't recognise the request
-   return None
+   return { 'machinetypeName'     : machinetypeName,
+            'shutdownMessage'     : shutdownMessage,
+            'shutdownMessageTime' : shutdownMessageTime,
+            'shutdownMachineName' : shutdownMachineName }
 
-def writePutBody(created, machinetypeName, machineName, path, body):
+def factoryStatusValues(runningMachines, runningProcessors, runningHS06):
+   # The measured rather than configured values for factory status messages
 
-   # Fold // to /
-   requestURI = path.replace('//','/')
-   
-   splitRequestURI = requestURI.split('/')
+   vacDiskStatFS  = os.statvfs('/var/lib/vac')
+   rootDiskStatFS = os.statvfs('/tmp')
    
-   if len(splitRequestURI) != 3 or splitRequestURI[1] != 'joboutputs' or not splitRequestURI[2]:
-     return False
+   memory = vac.vacutils.memInfo()
 
-   machinesDir = '/var/lib/vac/machines/' + str(created) + '_' + machinetypeName + '_' + machineName
-   
    try:
-     vac.vacutils.createFile(machinesDir + '/joboutputs/' + splitRequestURI[2],
-                             body,
-                             stat.S_IWUSR + stat.S_IRUSR + stat.S_IRGRP + stat.S_IROTH, '/var/lib/vac/tmp')
-   except Exception as e:
-     vac.vacutils.logLine('Failed to write ' + machinesDir + '/joboutputs/' + splitRequestURI[2] + ' (' + str(e) + ')')
-     return False
+     factoryHeartbeatTime = int(os.stat('/var/lib/vac/factory-heartbeat').st_ctime)
+   except:
+     factoryHeartbeatTime = 0
 
-   vac.vacutils.logLine('Wrote ' + machinesDir + '/joboutputs/' + splitRequestURI[2])
-   return True
+   try:
+     responderHeartbeatTime = int(os.stat('/var/lib/vac/responder-heartbeat').st_ctime)
+   except:
+     responderHeartbeatTime = 0
 
-def sendMachinetypesRequests(factoryList = None, clientName = '-'):
+   try:
+     mjfHeartbeatTime = int(os.stat('/var/lib/vac/mjf-heartbeat').st_ctime)
+   except:
+     mjfHeartbeatTime = 0
 
-   salt = base64.b64encode(os.urandom(32))
-   sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-   sock.settimeout(udpTimeoutSeconds / vacqueryTries)
-   setSockBufferSize(sock)
+   try:
+     metadataHeartbeatTime = int(os.stat('/var/lib/vac/metadata-heartbeat').st_ctime)
+   except:
+     metadataHeartbeatTime = 0
 
-   # Initialise dictionary of per-factory, per-machinetype responses
-   responses = {}
+   try:
+     osIssue = open('/etc/redhat-release.vac','r').readline().strip()
+   except:
+     try:
+       osIssue = open('/etc/redhat-release','r').readline().strip()
+     except:
+       osIssue = os.uname()[2]
 
-   if factoryList is None:
-     factoryList = factories
+   try:
+     bootTime = int(time.time() - float(open('/proc/uptime','r').readline().split()[0]))
+   except:
+     bootTime = 0
 
-   for rawFactoryName in factoryList:
-     responses[canonicalFQDN(rawFactoryName)] = { 'machinetypes' : {} }
+   return { 'running_processors'       : runningProcessors,
+            'running_machines'         : runningMachines,
+            'running_hs06'             : runningHS06,
+            'root_disk_avail_kb'       : (rootDiskStatFS.f_bavail * rootDiskStatFS.f_frsize) / 1024,
+            'root_disk_avail_inodes'   : rootDiskStatFS.f_favail,
+            'daemon_disk_avail_kb'     : ( vacDiskStatFS.f_bavail *  vacDiskStatFS.f_frsize) / 1024,
+            'daemon_disk_avail_inodes' :  vacDiskStatFS.f_favail,
+            'load_average'             : vac.vacutils.loadAvg(2),
+            'kernel_version'           : os.uname()[2],
+            'os_issue'                 : osIssue,
+            'boot_time'                : bootTime,
+            'factory_heartbeat_time'   : factoryHeartbeatTime,
+            'responder_heartbeat_time' : responderHeartbeatTime,
+            'mjf_heartbeat_time'       : mjfHeartbeatTime,
+            'metadata_heartbeat_time'  : metadataHeartbeatTime,
+            'swap_used_kb'             : memory['SwapTotal'] - memory['SwapFree'],
+            'swap_free_kb'             : memory['SwapFree'],
+            'mem_used_kb'              : memory['MemTotal'] - memory['MemFree'],
+            'mem_total_kb'             : memory['MemTotal'],
+            'cycle_timings'            : readCycleTimings() }
+
+def makeStatusTable(numSlots, numMachinetypes):
+   # Replace the status table with an empty one of the given size. Readers 
+   # with the old one mapped see the new inode at their next query
+   vac.vacutils.createFile(statusTableFile,
+                           struct.pack(statusTableHeaderFormat, statusTableMagic, 0, numSlots, numMachinetypes, statusTableRecordBytes) +
+                           '\0' * ((1 + numSlots + numMachinetypes) * statusTableRecordBytes),
+                           stat.S_IWUSR + stat.S_IRUSR + stat.S_IRGRP + stat.S_IROTH, '/var/lib/vac/tmp')
+
+def writeStatusTable(factoryValues = None, slotValues = {}, machinetypeValues = {}):
+   # Update some or all of the records in the status table. slotValues is a
+   # dictionary of values from slotStatusValues() keyed by ordinal and
+   # machinetypeValues is keyed by machinetype name. The table is recreated 
+   # if the number of slots or the configured machinetypes have changed
+   machinetypeNames = sorted(machinetypes)
+
+   # Writers hold a separate lock file across the whole update, since the
+   # table itself may be replaced by a new inode if it has to be recreated
+   try:
+     lockFile = open(statusTableFile + '.lock', 'a')
+     fcntl.flock(lockFile.fileno(), fcntl.LOCK_EX)
+   except Exception as e:
+     vac.vacutils.logLine('Failed to lock status table (' + str(e) + ')')
+     return
 
-   queryCount = 0
-   
-   # We just use integer second counting for now, despite the config file
-   while queryCount <= vacqueryTries:
-     queryCount += 1
+   try:
+     updateStatusTable(machinetypeNames, factoryValues, slotValues, machinetypeValues)
+   finally:
+     lockFile.close()
 
-     requestsSent = 0
-     for rawFactoryName in factoryList:
-     
-       factoryName = canonicalFQDN(rawFactoryName)
+def updateStatusTable(machinetypeNames, factoryValues, slotValues, machinetypeValues):
+   # Called by writeStatusTable() while holding the writers' lock
+   try:
+     f = open(statusTableFile, 'r+b')
+   except:
+     f = None
+   else:
+     try:
+       tableMap = mmap.mmap(f.fileno(), 0)
+       (magic, generation, numSlots, numMachinetypes, recordBytes) = struct.unpack_from(statusTableHeaderFormat, tableMap)
+     except:
+       magic = None
 
-       try:
-         numMachinetypes = responses[factoryName]['num_machinetypes']
-       except:
-         # We initially expect every factory to tell us about at least 1 machinetype
-         numMachinetypes = 1
-     
-       # Send out requests to all factories with insufficient replies so far
-       if len(responses[factoryName]['machinetypes']) < numMachinetypes:
-
-         requestsSent += 1
-         try:          
-           sock.sendto(json.dumps({'vac_version'      : 'Vac ' + vacVersion + ' ' + clientName,
-                                   'vacquery_version' : 'VacQuery ' + vac.shared.vacQueryVersion,
-                                   'space'            : spaceName,
-                                   'cookie'           : hashlib.sha256(salt + factoryName).hexdigest(),
-                                   'message_type'     : 'machinetypes_query'}),
-                       (factoryName,995))
-
-         except socket.error:
-           pass
+     if magic != statusTableMagic or numSlots != numMachineSlots or \
+        numMachinetypes != len(machinetypeNames) or recordBytes != statusTableRecordBytes:
+       f.close()
+       f = None
 
-     if requestsSent == 0:
-       # We can stop early since we have received all the expected responses already
-       break
+   if f is None:
+     makeStatusTable(numMachineSlots, len(machinetypeNames))
 
-     # Gather responses from all factories until none for 1.0 second
-#NEED A LIMIT ON HOW LONG IN TOTAL TOO!?
-#IF WE KEEP GETTING REPLIES THEN WE GO ROUND FOREVER
-     while True:
-   
-         try:
-           data, addr = sock.recvfrom(10240)
-                      
-           try:
-             response = json.loads(data)
-           except:
-             vac.vacutils.logLine('json.loads failed for ' + data)
-             continue
+     try:
+       f = open(statusTableFile, 'r+b')
+       tableMap = mmap.mmap(f.fileno(), 0)
+       generation = 0
+     except Exception as e:
+       vac.vacutils.logLine('Failed to open status table (' + str(e) + ')')
+       return
 
-# should check types as well as presence!
-           if 'message_type' in response and response['message_type'] == 'machinetype_status' and \
-              'cookie' 			in response and \
-              'space' 			in response and \
-              response['space']  == spaceName and \
-              'factory' 		in response and \
-              response['cookie'] == hashlib.sha256(salt + response['factory']).hexdigest() and \
-              'num_machinetypes'	in response and \
-              'machinetype'		in response and \
-              'running_hs06'		in response and \
-              'num_before_fizzle'	in response and \
-              'shutdown_message'	in response and \
-              'shutdown_time'		in response and \
-              'shutdown_machine'	in response:
-              
-             responses[response['factory']]['num_machinetypes'] = response['num_machinetypes']
+   records = {}
 
-             responses[response['factory']]['machinetypes'][response['machinetype']] = response
+   if factoryValues is not None:
+     records[0] = factoryValues
 
-         except socket.error:
-           # timed-out so stop gathering responses for now
-           break
+   for ordinal in slotValues:
+     if ordinal < numMachineSlots:
+       records[1 + ordinal] = slotValues[ordinal]
 
-   return responses
+   for machinetypeName in machinetypeValues:
+     if machinetypeName in machinetypeNames:
+       records[1 + numMachineSlots + machinetypeNames.index(machinetypeName)] = machinetypeValues[machinetypeName]
 
-def sendMachinesRequests(factoryList = None, clientName = '-'):
+   # Odd generation while we are writing
+   tableMap[8:16] = struct.pack('<Q', generation + 1)
 
-   salt = base64.b64encode(os.urandom(32))
-   sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-   sock.settimeout(udpTimeoutSeconds / vacqueryTries)
-   setSockBufferSize(sock)
+   for index in records:
+     recordJSON = json.dumps(records[index])
 
-   # Initialise dictionary of per-factory, per-machine responses
-   responses = {}
+     if len(recordJSON) > statusTableRecordBytes - 4:
+       # Readers treat an empty record as missing and look at the files instead
+       vac.vacutils.logLine('Status table record %d is too long (%d bytes)' % (index, len(recordJSON)))
+       recordJSON = ''
 
-   if factoryList is None:
-     factoryList = factories
+     offset = statusTableHeaderBytes + index * statusTableRecordBytes
+     tableMap[offset:offset + 4 + len(recordJSON)] = struct.pack('<I', len(recordJSON)) + recordJSON
 
-   for rawFactoryName in factoryList:   
-     responses[vac.shared.canonicalFQDN(rawFactoryName)] = { 'machines' : {} }
+   tableMap[8:16] = struct.pack('<Q', generation + 2)
 
-   queryCount = 0
-   
-   # We just use integer second counting for now, despite the config file
-   while queryCount <= vacqueryTries:
-     queryCount += 1
+   tableMap.close()
+   f.close()
 
-     requestsSent = 0
-     for rawFactoryName in factoryList:
+def publishFactoryStatus(slots, runningMachines, runningProcessors, runningHS06):
+   # Called by vacd-factory at the end of each scan of the slots, with the
+   # dictionary of VacSlot objects keyed by ordinal
+   # Only the totals from the slots are kept for the factory, as the heartbeats,
+   # load, memory and disk space are cheap to measure when answering a query
+   writeStatusTable(factoryValues     = { 'running_machines'   : runningMachines,
+                                          'running_processors' : runningProcessors,
+                                          'running_hs06'       : runningHS06,
+                                          'status_time'        : int(time.time()) },
+                    slotValues        = dict([ (ordinal, slotStatusValues(slots[ordinal])) for ordinal in slots ]),
+                    machinetypeValues = dict([ (machinetypeName, machinetypeShutdownValues(machinetypeName)) for machinetypeName in machinetypes ]))
 
-       factoryName = canonicalFQDN(rawFactoryName)
+def publishSlotStatus(ordinal):
+   # Called after changing the state of one slot outside the scan of the slots
+   writeStatusTable(slotValues = { ordinal : slotStatusValues(VacSlot(ordinal, forResponder = True)) })
 
-       try:
-         numMachines = responses[factoryName]['num_machines']
-       except:
-         # We initially expect every factory to tell us about at least 1 machine
-         numMachines = 1
-     
-       # Send out requests to all factories with insufficient replies so far
-       if len(responses[factoryName]['machines']) < numMachines:
+def readStatusTable():
+   # Return a consistent copy of the status table as a dictionary with the 
+   # keys factory, slots, machinetypes and generation, or None if it is not 
+   # available. The copy is only parsed again if the generation has changed
+   global statusTableInode, statusTableMap, statusTableCopy
 
-         requestsSent += 1
-         try:
-           sock.sendto(json.dumps({'vac_version'      : 'Vac ' + vacVersion + ' ' + clientName,
-                                   'vacquery_version' : 'VacQuery ' + vac.shared.vacQueryVersion,
-                                   'space'            : spaceName,
-                                   'cookie'           : hashlib.sha256(salt + factoryName).hexdigest(),
-                                   'method'           : 'machines', # will be deprecated
-                                   'message_type'     : 'machines_query'}),
-                       (factoryName,995))
-
-         except socket.error:
-           pass
+   try:
+     inode = os.stat(statusTableFile).st_ino
+   except:
+     return None
 
-     if requestsSent == 0:
-       # We can stop early since we have received all the expected responses already
-       break
+   if inode != statusTableInode:
+     try:
+       f = open(statusTableFile, 'rb')
+       tableMap = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+       f.close()
+     except:
+       return None
 
-     # Gather responses from all factories until none for 1.0 second
-#NEED A LIMIT ON HOW LONG IN TOTAL TOO!?
-     while True:
-   
-         try:
-           data, addr = sock.recvfrom(10240)
-                      
-           try:
-             response = json.loads(data)
-           except:
-             vac.vacutils.logLine('json.loads failed for ' + data)
-             continue
+     if statusTableMap:
+       statusTableMap.close()
 
-# should check types as well as presence!
-           if 'message_type' in response and response['message_type'] == 'machine_status' and \
-              'cookie' 			in response and \
-              'space' 			in response and \
-              response['space']  == spaceName and \
-              'factory' 		in response and \
-              response['cookie'] == hashlib.sha256(salt + response['factory']).hexdigest() and \
-              'num_machines'		in response and \
-              'machine'			in response and \
-              'state'			in response and \
-              'uuid'			in response and \
-              'created_time'		in response and \
-              'started_time'		in response and \
-              'heartbeat_time'		in response and \
-              'cpu_seconds'		in response and \
-              'cpu_percentage'		in response and \
-              'hs06'			in response and \
-              'machinetype'		in response and \
-              'shutdown_message'	in response and \
-              'shutdown_time'		in response:
-              
-             responses[response['factory']]['num_machines'] = response['num_machines']
-             
-             responses[response['factory']]['machines'][response['machine']] = response
+     statusTableInode = inode
+     statusTableMap   = tableMap
+     statusTableCopy  = None
 
-         except socket.error:
-           # timed-out so stop gathering responses for now
-           break
+   for attempt in range(100):
+     generation = struct.unpack('<Q', statusTableMap[8:16])[0]
 
-   return responses
+     if generation % 2:
+       # A writer is part way through
+       time.sleep(0.001)
+       continue
 
-def sendFactoriesRequests(factoryList = None, clientName = '-'):
+     if statusTableCopy and statusTableCopy['generation'] == (inode, generation):
+       return statusTableCopy
 
-   salt = base64.b64encode(os.urandom(32))
-   sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-   sock.settimeout(udpTimeoutSeconds / vacqueryTries)
-   setSockBufferSize(sock)
+     data = statusTableMap[:]
 
-   # Initialise dictionary of per-factory responses
-   responses = {}
+     if generation == struct.unpack('<Q', statusTableMap[8:16])[0]:
+       break
+   else:
+     return None
 
-   if factoryList is None:
-     factoryList = factories
+   try:
+     (magic, generation, numSlots, numMachinetypes, recordBytes) = struct.unpack_from(statusTableHeaderFormat, data)
+   except:
+     return None
 
-   queryCount = 0
-   
-   # We just use integer second counting for now, despite the config file
-   while queryCount <= vacqueryTries:
-     queryCount += 1
+   if magic != statusTableMagic:
+     return None
 
-     requestsSent = 0
-     for rawFactoryName in factoryList:
+   records = []
 
-       factoryName = canonicalFQDN(rawFactoryName)
-     
-       # Send out requests to all factories with insufficient replies so far
-       if factoryName not in responses:
-
-         requestsSent += 1
-         try:          
-           sock.sendto(json.dumps({'vac_version'      : 'Vac ' + vacVersion,
-                                   'vacquery_version' : 'VacQuery ' + vac.shared.vacQueryVersion,
-                                   'space'            : spaceName,
-                                   'cookie'           : hashlib.sha256(salt + factoryName).hexdigest(),
-                                   'method'           : 'factories',
-                                   'message_type'     : 'factory_query'}),
-                       (factoryName,995))
-
-         except socket.error:
-           pass
+   for index in range(1 + numSlots + numMachinetypes):
+     offset = statusTableHeaderBytes + index * recordBytes
+     length = struct.unpack_from('<I', data, offset)[0]
 
-     if requestsSent == 0:
-       # We can stop early since we have received all the expected responses already
-       break
+     try:
+       records.append(json.loads(data[offset + 4:offset + 4 + length]) if length else {})
+     except:
+       records.append({})
 
-     # Gather responses from all factories until none for 1.0 second
-#NEED A LIMIT ON HOW LONG IN TOTAL TOO!?
-     while True:
-   
-         try:
-           data, addr = sock.recvfrom(10240)
-                      
-           try:
-             response = json.loads(data)
-           except:
-             vac.vacutils.logLine('json.loads failed for ' + data)
-             continue
+   statusTable = { 'factory'      : records[0], 
+                   'slots'        : records[1:1 + numSlots], 
+                   'machinetypes' : {},
+                   'generation'   : (inode, generation) }
 
-           if 'message_type' in response and response['message_type'] == 'factory_status' and \
-              'cookie' 			in response and \
-              'space' 			in response and \
-              response['space']  == spaceName and \
-              'factory' 		in response and \
-              response['cookie'] == hashlib.sha256(salt + response['factory']).hexdigest() :
-              
-             responses[response['factory']] = response
+   for values in records[1 + numSlots:]:
+     if 'machinetypeName' in values:
+       statusTable['machinetypes'][values['machinetypeName']] = values
 
-         except socket.error:
-           # timed-out so stop gathering responses for now
-           break
+   statusTableCopy = statusTable
+   return statusTable
 
-   return responses
+def slotStatus(ordinal, statusTable):
+   # Status values of one slot, from the status table if it has them
+   try:
+     values = statusTable['slots'][ordinal]
+   except:
+     values = None
+
+   if values:
+     return values
+
+   return slotStatusValues(VacSlot(ordinal, forResponder = True))
 
-def makeMachineResponse(cookie, ordinal, clientName = '-', timeNow = None):
+def makeMachineResponse(cookie, ordinal, clientName = '-', timeNow = None, statusTable = None):
+   return json.dumps(machineResponseDict(cookie, ordinal, clientName, timeNow, statusTable))
+
+def machineResponseDict(cookie, ordinal, clientName = '-', timeNow = None, statusTable = None):
 
    if not timeNow:
      timeNow = int(time.time())
 
-   lm = VacSlot(ordinal, forResponder = True)
+   if statusTable is None:
+     statusTable = readStatusTable()
+
+   lm = slotStatus(ordinal, statusTable)
 
-   if lm.hs06:
-     hs06 = lm.hs06
+   if lm['hs06']:
+     hs06 = lm['hs06']
    else:
-     hs06 = 1.0 * lm.processors
+     hs06 = 1.0 * lm['processors']
 
    responseDict = {
                 'message_type'		: 'machine_status',
@@ -2953,21 +4792,21 @@ def makeMachineResponse(cookie, ordinal, clientName = '-', timeNow = None):
                 'num_machines'       	: numMachineSlots,
                 'time_sent'		: timeNow,
 
-                'machine' 		: lm.name,
-                'state'			: lm.state,
-                'machine_model'		: lm.machineModel,
-                'uuid'			: lm.uuidStr,
-                'created_time'		: lm.created,
-                'started_time'		: lm.started,
-                'heartbeat_time'	: lm.heartbeat,
-                'num_cpus'		: lm.processors, # removed in Vacuum Platform 2.0 spec
-                'num_processors'	: lm.processors,
-                'cpu_seconds'		: lm.cpuSeconds,
-                'cpu_percentage'	: lm.cpuPercentage,
+                'machine' 		: nameFromOrdinal(ordinal),
+                'state'			: lm['state'],
+                'machine_model'		: lm['machineModel'],
+                'uuid'			: lm['uuidStr'],
+                'created_time'		: lm['created'],
+                'started_time'		: lm['started'],
+                'heartbeat_time'	: lm['heartbeat'],
+                'num_cpus'		: lm['processors'], # removed in Vacuum Platform 2.0 spec
+                'num_processors'	: lm['processors'],
+                'cpu_seconds'		: lm['cpuSeconds'],
+                'cpu_percentage'	: lm['cpuPercentage'],
                 'hs06' 		       	: hs06,
-                'machinetype'		: lm.machinetypeName,
-                'shutdown_message'  	: lm.shutdownMessage,
-                'shutdown_time'     	: lm.shutdownMessageTime
+                'machinetype'		: lm['machinetypeName'],
+                'shutdown_message'  	: lm['shutdownMessage'],
+                'shutdown_time'     	: lm['shutdownMessageTime']
                   }
 
    if gocdbSitename:
@@ -2975,115 +4814,156 @@ def makeMachineResponse(cookie, ordinal, clientName = '-', timeNow = None):
    else:
      responseDict['site'] = '.'.join(spaceName.split('.')[1:]) if '.' in spaceName else spaceName
 
-   if lm.accountingFqan:
-     responseDict['fqan'] = lm.accountingFqan
+   if lm['accountingFqan']:
+     responseDict['fqan'] = lm['accountingFqan']
 
-   return json.dumps(responseDict)
+   return responseDict
 
-def makeMachinetypeResponses(cookie, clientName = '-'):
-   # Send back machinetype messages to the querying factory or client
-   responses = []
-   timeNow = int(time.time())
+# Values which are the same in every machine_status message from one factory,
+# and so are only given once in each machine_status_list message
+machineStatusListKeys = [ 'vac_version', 'daemon_version', 'vacquery_version', 'cookie', 'space',
+                          'factory', 'site', 'num_machines', 'time_sent' ]
 
-   # Go through the machinetypes
+def makeMachineListResponses(cookie, maxBytes, clientName = '-', timeNow = None, statusTable = None):
+   # The machine_status records of all the slots packed into as few 
+   # machine_status_list messages as possible, each at most maxBytes long 
+   # unless one record by itself is longer than that
+   if not timeNow:
+     timeNow = int(time.time())
+
+   if statusTable is None:
+     statusTable = readStatusTable()
+
+   responses   = []
+   recordsJSON = []
+   listPrefix  = None
+
+   for ordinal in range(numMachineSlots):
+     record = machineResponseDict(cookie, ordinal, clientName, timeNow, statusTable)
+
+     if listPrefix is None:
+       # The same for every message, so made from the first record
+       commonValues = { 'message_type' : 'machine_status_list' }
+
+       for key in machineStatusListKeys:
+         if key in record:
+           commonValues[key] = record[key]
+
+       listPrefix = json.dumps(commonValues, separators = (',', ':'))[:-1] + ',"records":['
+
+     for key in machineStatusListKeys + [ 'message_type' ]:
+       record.pop(key, None)
+
+     # Without spaces, so more records fit in each message
+     recordJSON = json.dumps(record, separators = (',', ':'))
+
+     if recordsJSON and \
+        len(listPrefix) + sum([ len(oneJSON) + 1 for oneJSON in recordsJSON ]) + len(recordJSON) + 2 > maxBytes:
+       responses.append(listPrefix + ','.join(recordsJSON) + ']}')
+       recordsJSON = []
+
+     recordsJSON.append(recordJSON)
+
+   if recordsJSON:
+     responses.append(listPrefix + ','.join(recordsJSON) + ']}')
+
+   return responses
+
+def machinetypeAggregates(statusTable, timeNow):
+   # Running totals for every machinetype, made in one pass over the slots.
+   # The result for the current generation of the status table is kept, 
+   # and reused for later queries in the same second unless the 
+   # configuration has been loaded again in the meantime
+   global machinetypeAggregatesCache
+
+   if statusTable:
+     cacheKey = (statusTable['generation'], timeNow)
+
+     if machinetypeAggregatesCache and \
+        machinetypeAggregatesCache[0] == cacheKey and \
+        machinetypeAggregatesCache[1] is machinetypes:
+       return machinetypeAggregatesCache[2]
+   else:
+     cacheKey = None
+
+   aggregates = {}
+   
    for machinetypeName in machinetypes:
+     aggregates[machinetypeName] = { 'runningHS06'       : 0.0,
+                                     'numBeforeFizzle'   : 0,
+                                     'runningMachines'   : 0,
+                                     'runningProcessors' : 0 }
 
-     runningHS06       = 0.0
-     numBeforeFizzle   = 0
-     runningMachines   = 0
-     runningProcessors = 0
+   # Go through the slots, looking for starting/running instances of each machinetype
+   for ordinal in range(numMachineSlots):
 
-     # Go through the VM slots, looking for starting/running instances of this machinetype
-     for ordinal in range(numMachineSlots):
+     lm = slotStatus(ordinal, statusTable)
 
-       name = nameFromOrdinal(ordinal)
+     if lm['machinetypeName'] not in aggregates or not lm['created']:
+       # Includes slots whose machines directory has been cleaned up
+       continue
 
-       try:
-         (createdStr, machinetypeNameTmp, machineModel) = open('/var/lib/vac/slots/' + name,'r').read().split()
-         created = int(createdStr)
-       except:
-         continue
+     machinetypeName = lm['machinetypeName']
+     created         = lm['created']
+     timeStarted     = lm['started']
+     timeHeartbeat   = lm['heartbeat']
+     numProcessors   = lm['processors'] or 1
 
-       if machinetypeNameTmp != machinetypeName:
-         continue
+     if lm['hs06']:
+       hs06 = lm['hs06']
+     else:
+       hs06 = 1.0 * numProcessors
 
-       machinesDir = '/var/lib/vac/machines/' + str(created) + '_' + machinetypeName + '_' + name
-       if not os.path.isdir(machinesDir):
-         # machines directory has been cleaned up?
-         continue
+     hasFinished = lm['finished'] is not None
 
-       try:
-         timeStarted = int(os.stat(machinesDir + '/started').st_ctime)
-       except:
-         timeStarted = None
+     # some hardcoded timeouts here in case old files are left lying around 
+     # this means that old files are ignored when working out the state
+     if (timeStarted and 
+         timeHeartbeat and 
+         (timeHeartbeat > timeNow - 3600) and
+         not hasFinished):
+       # Running
+       aggregates[machinetypeName]['runningHS06']       += hs06
+       aggregates[machinetypeName]['runningMachines']   += 1
+       aggregates[machinetypeName]['runningProcessors'] += numProcessors
 
-       try:
-         timeHeartbeat = int(os.stat(machinesDir + '/heartbeat').st_ctime)
-       except:
-         timeHeartbeat = None
+       if timeNow < timeStarted + machinetypes[machinetypeName]['fizzle_seconds']:
+         aggregates[machinetypeName]['numBeforeFizzle'] += 1
 
-       try:                  
-         numProcessors = float(open(machinesDir + '/jobfeatures/allocated_cpu', 'r').readline())
-       except:
-         numProcessors = 1
+     elif not timeStarted and (created > timeNow - 3600):
+       # Starting
+       aggregates[machinetypeName]['runningHS06']       += hs06
+       aggregates[machinetypeName]['runningMachines']   += 1
+       aggregates[machinetypeName]['runningProcessors'] += 1
+       aggregates[machinetypeName]['numBeforeFizzle']   += 1
 
-       try:                  
-         hs06 = float(open(machinesDir + '/jobfeatures/hs06_job', 'r').readline())
-       except:
-         hs06 = 1.0 * numProcessors
+   if cacheKey:
+     machinetypeAggregatesCache = (cacheKey, machinetypes, aggregates)
 
-       hasFinished = os.path.exists(machinesDir + '/finished')
+   return aggregates
 
-       # some hardcoded timeouts here in case old files are left lying around 
-       # this means that old files are ignored when working out the state
-       if (timeStarted and 
-           timeHeartbeat and 
-           (timeHeartbeat > int(time.time() - 3600)) and
-           not hasFinished):
-         # Running
-         runningHS06       += hs06
-         runningMachines   += 1
-         runningProcessors += numProcessors
+def makeMachinetypeResponses(cookie, clientName = '-', statusTable = None):
+   # Send back machinetype messages to the querying factory or client
+   responses = []
+   timeNow = int(time.time())
 
-         if int(time.time()) < timeStarted + machinetypes[machinetypeName]['fizzle_seconds']:
-           numBeforeFizzle += 1
+   if statusTable is None:
+     statusTable = readStatusTable()
 
-       elif not timeStarted and (created > int(time.time() - 3600)):
-         # Starting
-         runningHS06       += hs06
-         runningMachines   += 1
-         runningProcessors += 1
-         numBeforeFizzle   += 1         
+   aggregates = machinetypeAggregates(statusTable, timeNow)
 
-     # Outcome of the most recently created instance of this machinetype that has already finished
+   # Go through the machinetypes
+   for machinetypeName in machinetypes:
 
-     shutdownMessage     = None
-     shutdownMessageTime = None
-     shutdownMachineName = None
+     runningHS06       = aggregates[machinetypeName]['runningHS06']
+     numBeforeFizzle   = aggregates[machinetypeName]['numBeforeFizzle']
+     runningMachines   = aggregates[machinetypeName]['runningMachines']
+     runningProcessors = aggregates[machinetypeName]['runningProcessors']
 
      try:
-       # Updated by createFinishedFile()
-       shutdownCreated, shutdownMachinetypeName, shutdownMachineName = open('/var/lib/vac/finishes/' + machinetypeName, 'r').readline().strip().split()
-       
+       shutdownValues = statusTable['machinetypes'][machinetypeName]
      except:
-       pass
-     else:
-       try:
-         shutdownMessage = open('/var/lib/vac/machines/%s_%s_%s/joboutputs/shutdown_message' % (shutdownCreated, shutdownMachinetypeName, shutdownMachineName),'r').readline().strip()
-         messageCode = int(shutdownMessage[0:3])
-         shutdownMessageTime = int(os.stat('/var/lib/vac/machines/%s_%s_%s/joboutputs/shutdown_message' % (shutdownCreated, shutdownMachinetypeName, shutdownMachineName)).st_ctime)
-       except:
-         # No explicit shutdown message with a message code, so we make one up if necessary
-         
-         try:
-           timeStarted   = int(os.stat(dir + '/started').st_ctime)
-           timeHeartbeat = int(os.stat(dir + '/heartbeat').st_ctime)
-         except:
-           pass
-         else:
-           if (timeHeartbeat - timeStarted) < machinetypes[machinetypeName]['fizzle_seconds']:
-             shutdownMessageTime = timeHeartbeat
-             shutdownMessage = '300 Vac detects fizzle after ' + str(timeHeartbeat - timeStarted) + ' seconds'
+       shutdownValues = machinetypeShutdownValues(machinetypeName)
 
      responseDict = {
                 'message_type'		: 'machinetype_status',
@@ -3103,9 +4983,9 @@ def makeMachinetypeResponses(cookie, clientName = '-'):
                 'running_cpus'          : runningProcessors, # removed in Vacuum Platform 2.0 spec
                 'running_processors'    : runningProcessors,
                 'num_before_fizzle' 	: numBeforeFizzle,
-                'shutdown_message'  	: shutdownMessage,
-                'shutdown_time'     	: shutdownMessageTime,
-                'shutdown_machine'  	: shutdownMachineName
+                'shutdown_message'  	: shutdownValues['shutdownMessage'],
+                'shutdown_time'     	: shutdownValues['shutdownMessageTime'],
+                'shutdown_machine'  	: shutdownValues['shutdownMachineName']
                      }
 
      if gocdbSitename:
@@ -3132,56 +5012,29 @@ def makeMachinetypeResponses(cookie, clientName = '-'):
 
    return responses
    
-def makeFactoryResponse(cookie, clientName = '-'):
+def makeFactoryResponse(cookie, clientName = '-', statusTable = None):
    # Send back factory status message to the querying client
 
-   vacDiskStatFS  = os.statvfs('/var/lib/vac')
-   rootDiskStatFS = os.statvfs('/tmp')
-   
-   memory = vac.vacutils.memInfo()
-
-   try:
-     counts = open('/var/lib/vac/counts','r').readline().split()
-     runningMachines   = int(counts[0])
-     runningProcessors = int(counts[2])
-     runningHS06       = float(counts[4])
-   except:
-     runningProcessors = 0
-     runningMachines   = 0
-     runningHS06       = 0
-
-   try:
-     factoryHeartbeatTime = int(os.stat('/var/lib/vac/factory-heartbeat').st_ctime)
-   except:
-     factoryHeartbeatTime = 0
-
-   try:
-     responderHeartbeatTime = int(os.stat('/var/lib/vac/responder-heartbeat').st_ctime)
-   except:
-     responderHeartbeatTime = 0
-
-   try:
-     mjfHeartbeatTime = int(os.stat('/var/lib/vac/mjf-heartbeat').st_ctime)
-   except:
-     mjfHeartbeatTime = 0
-
-   try:
-     metadataHeartbeatTime = int(os.stat('/var/lib/vac/metadata-heartbeat').st_ctime)
-   except:
-     metadataHeartbeatTime = 0
+   if statusTable is None:
+     statusTable = readStatusTable()
 
    try:
-     osIssue = open('/etc/redhat-release.vac','r').readline().strip()
+     runningMachines   = statusTable['factory']['running_machines']
+     runningProcessors = statusTable['factory']['running_processors']
+     runningHS06       = statusTable['factory']['running_hs06']
    except:
      try:
-       osIssue = open('/etc/redhat-release','r').readline().strip()
+       counts = open('/var/lib/vac/counts','r').readline().split()
+       runningMachines   = int(counts[0])
+       runningProcessors = int(counts[2])
+       runningHS06       = float(counts[4])
      except:
-       osIssue = os.uname()[2]
+       runningProcessors = 0
+       runningMachines   = 0
+       runningHS06       = 0
 
-   try:
-     bootTime = int(time.time() - float(open('/proc/uptime','r').readline().split()[0]))
-   except:
-     bootTime = 0
+   # Everything else is measured now, so heartbeats etc are never out of date
+   values = factoryStatusValues(runningMachines, runningProcessors, runningHS06)
      
    if hs06PerProcessor:
      maxHS06 = numProcessors * hs06PerProcessor
@@ -3198,10 +5051,7 @@ def makeFactoryResponse(cookie, clientName = '-'):
                 'factory'       	   : os.uname()[1],
                 'time_sent'		   : int(time.time()),
 
-                'running_cpus'             : runningProcessors, # renamed in Vacuum Platform 2.0 spec
-                'running_processors'       : runningProcessors,
-                'running_machines'         : runningMachines,
-                'running_hs06'             : runningHS06,
+                'running_cpus'             : values['running_processors'], # renamed in Vacuum Platform 2.0 spec
                 'max_cpus'		   : numProcessors,	# renamed in Vacuum Platform 2.0 spec
                 'max_processors'	   : numProcessors,
                 'max_machines'             : numProcessors,
@@ -3211,28 +5061,12 @@ def makeFactoryResponse(cookie, clientName = '-'):
                 'total_machines'           : numProcessors,	# deprecated
                 'total_hs06'		   : maxHS06,		# deprecated
 
-                'root_disk_avail_kb'       : (rootDiskStatFS.f_bavail * rootDiskStatFS.f_frsize) / 1024,
-                'root_disk_avail_inodes'   : rootDiskStatFS.f_favail,
-
-                'vac_disk_avail_kb'        : ( vacDiskStatFS.f_bavail *  vacDiskStatFS.f_frsize) / 1024, # renamed in Vacuum Platform 2.0 spec
-                'daemon_disk_avail_kb'      : ( vacDiskStatFS.f_bavail *  vacDiskStatFS.f_frsize) / 1024,
-                'vac_disk_avail_inodes'    :  vacDiskStatFS.f_favail,                                    # renamed in Vacuum Platform 2.0 spec
-                'daemon_disk_avail_inodes'  :  vacDiskStatFS.f_favail,
-
-                'load_average'		   : vac.vacutils.loadAvg(2),
-                'kernel_version'	   : os.uname()[2],
-                'os_issue'		   : osIssue,
-                'boot_time'		   : bootTime,
-                'factory_heartbeat_time'   : factoryHeartbeatTime,
-                'responder_heartbeat_time' : responderHeartbeatTime,
-                'mjf_heartbeat_time'       : mjfHeartbeatTime,
-                'metadata_heartbeat_time'  : metadataHeartbeatTime,
-                'swap_used_kb'		   : memory['SwapTotal'] - memory['SwapFree'],
-                'swap_free_kb'		   : memory['SwapFree'],
-                'mem_used_kb'		   : memory['MemTotal'] - memory['MemFree'],
-                'mem_total_kb'		   : memory['MemTotal']
+                'vac_disk_avail_kb'        : values['daemon_disk_avail_kb'],     # renamed in Vacuum Platform 2.0 spec
+                'vac_disk_avail_inodes'    : values['daemon_disk_avail_inodes']  # renamed in Vacuum Platform 2.0 spec
                   }
 
+   responseDict.update(values)
+
    if gocdbSitename:
      responseDict['site'] = gocdbSitename
    else:
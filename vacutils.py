@@ -47,7 +47,9 @@ import ctypes
 import string
 import urllib
 import StringIO
+import shutil
 import tempfile
+import uuid
 import calendar
 import hashlib
 import xml.etree.cElementTree
@@ -96,6 +98,50 @@ def createFile(targetname, contents, mode=stat.S_IRUSR|stat.S_IWUSR|stat.S_IRGRP
 
      return False
 
+def createFilesDirectory(targetDir, files, mode=stat.S_IRUSR|stat.S_IWUSR|stat.S_IRGRP):
+   # Create the new directory targetDir containing the files given by the
+   # dictionary of names and contents. The directory is built in a staging
+   # directory alongside it and then renamed into place in one operation,
+   # so the files need not be created one by one with createFile()
+
+   stagingDir = tempfile.mkdtemp(prefix = '.' + os.path.basename(targetDir) + '.', dir = os.path.dirname(targetDir))
+
+   try:
+     os.chmod(stagingDir, stat.S_IRUSR|stat.S_IWUSR|stat.S_IXUSR|stat.S_IRGRP|stat.S_IXGRP|stat.S_IROTH|stat.S_IXOTH)
+
+     for (name, contents) in files.iteritems():
+       fd = os.open(stagingDir + '/' + name, os.O_WRONLY | os.O_CREAT | os.O_EXCL, mode)
+       os.write(fd, contents)
+
+       if mode:
+         os.fchmod(fd, mode)
+
+       os.close(fd)
+
+     os.rename(stagingDir, targetDir)
+   except:
+     shutil.rmtree(stagingDir, ignore_errors = True)
+     raise
+
+def updateFilesDirectory(targetDir, files, mode=stat.S_IRUSR|stat.S_IWUSR|stat.S_IRGRP, tmpDir = None):
+   # Update an existing directory of files in place, which must be used if 
+   # it may be bind mounted somewhere. Only files whose contents have 
+   # changed are rewritten. Returns the list of names of the files rewritten
+
+   rewritten = []
+
+   for (name, contents) in files.iteritems():
+     try:
+       if open(targetDir + '/' + name, 'r').read() == contents:
+         continue
+     except:
+       pass
+
+     if createFile(targetDir + '/' + name, contents, mode, tmpDir):
+       rewritten.append(name)
+
+   return rewritten
+
 def secondsToHHMMSS(seconds):
    hh, ss = divmod(seconds, 3600)
    mm, ss = divmod(ss, 60)
@@ -198,11 +244,66 @@ def readPipe(pipeFile, pipeURL, versionString, updatePipes = False):
 
    return pipeDict
 
-def createUserData(shutdownTime, machinetypePath, options, versionString, spaceName, machinetypeName, userDataPath, hostName, uuidStr,
-                   machinefeaturesURL = None, jobfeaturesURL = None, joboutputsURL = None, rootImageURL = None, heartbeatMachinesURL = None):
+# Compiled user_data templates, keyed by file name and (inode, mtime, size)
+compiledTemplates = {}
+
+def compileUserDataTemplate(contents):
+   # Split a template into a list alternating between literal text and 
+   # the names of ##user_data_...## patterns, ready for renderUserDataTemplate()
+   return re.split('##(user_data_[^#\n]*)##', contents)
+
+def renderUserDataTemplate(compiled, substitutions):
+   # Render a compiled template in one pass. Unknown patterns which look like
+   # ##user_data_[a-z,0-9,_]*## are removed, and any others are left as they are
+   parts = []
+
+   for i in range(len(compiled)):
+     if i % 2 == 0:
+       parts.append(compiled[i])
+     elif compiled[i] in substitutions:
+       parts.append(substitutions[compiled[i]])
+     elif re.match('^user_data_[a-z,0-9,_]*$', compiled[i]) is None:
+       parts.append('##' + compiled[i] + '##')
+
+   return ''.join(parts)
+
+def readTemplateFile(fileName):
+   # Return (contents, compiled template) of fileName, only reading and 
+   # compiling it again if the file has changed
+   try:
+     st = os.stat(fileName)
+   except:
+     raise VacutilsError('Failed to read ' + fileName)
+
+   signature = (st.st_ino, st.st_mtime, st.st_size)
+
+   if fileName not in compiledTemplates or compiledTemplates[fileName][0] != signature:
+     try:
+       u = open(fileName, 'r')
+       contents = u.read()
+       u.close()
+     except:
+       raise VacutilsError('Failed to read ' + fileName)
+
+     compiledTemplates[fileName] = (signature, contents, compileUserDataTemplate(contents))
+
+   return compiledTemplates[fileName][1:]
+
+def getCompiledUserDataTemplate(userDataPath, machinetypePath, versionString, userDataCache = None, tmpDir = None):
+   # Return the compiled user_data template. If userDataCache is given, remote 
+   # templates are kept there and only fetched if not cached yet, leaving 
+   # revalidation with getRemoteFile() to the caller
 
    # Get raw user_data template file, either from network ...
    if (userDataPath[0:7] == 'http://') or (userDataPath[0:8] == 'https://'):
+     if userDataCache:
+       fileName = userDataCache + '/' + urllib.quote(userDataPath,'')
+
+       if not os.path.isfile(fileName):
+         fileName = getRemoteFile(userDataPath, userDataCache, tmpDir, versionString, requireLastModified = False, timeout = 30)
+
+       return readTemplateFile(fileName)[1]
+
      buffer = StringIO.StringIO()
      c = pycurl.Curl()
      c.setopt(c.URL, userDataPath)
@@ -224,54 +325,73 @@ def createUserData(shutdownTime, machinetypePath, options, versionString, spaceN
        raise VacutilsError('Failed to read ' + userDataPath + ' (' + str(e) + ')')
 
      c.close()
-
-     # We only do this substitution if it was an HTTP(S) URL
-     userDataContents = buffer.getvalue().replace('##user_data_url##', userDataPath)
+     return compileUserDataTemplate(buffer.getvalue())
 
    # ... or from filesystem
+   elif userDataPath[0] == '/':
+     return readTemplateFile(userDataPath)[1]
    else:
-     if userDataPath[0] == '/':
-       userDataFile = userDataPath
-     else:
-       userDataFile = machinetypePath + '/files/' + userDataPath
+     return readTemplateFile(machinetypePath + '/files/' + userDataPath)[1]
 
-     try:
-       u = open(userDataFile, 'r')
-       userDataContents = u.read()
-       u.close()
-     except:
-       raise VacutilsError('Failed to read ' + userDataFile)
+def createUserData(shutdownTime, machinetypePath, options, versionString, spaceName, machinetypeName, userDataPath, hostName, uuidStr,
+                   machinefeaturesURL = None, jobfeaturesURL = None, joboutputsURL = None, rootImageURL = None, heartbeatMachinesURL = None,
+                   userDataCache = None, tmpDir = None, proxyKeyBits = 1024, keyPool = None):
+
+   compiled = getCompiledUserDataTemplate(userDataPath, machinetypePath, versionString, userDataCache, tmpDir)
 
-   # Default substitutions (plus ##user_data_url## possibly done already)
-   userDataContents = userDataContents.replace('##user_data_space##',            spaceName)
-   userDataContents = userDataContents.replace('##user_data_machinetype##',      machinetypeName)
-   userDataContents = userDataContents.replace('##user_data_machine_hostname##', hostName)
-   userDataContents = userDataContents.replace('##user_data_manager_version##',  versionString)
-   userDataContents = userDataContents.replace('##user_data_manager_hostname##', os.uname()[1])
+   substitutions = {}
+
+   # We only do this substitution if it was an HTTP(S) URL
+   if (userDataPath[0:7] == 'http://') or (userDataPath[0:8] == 'https://'):
+     substitutions['user_data_url'] = userDataPath
+
+   # Default substitutions
+   substitutions['user_data_space']            = spaceName
+   substitutions['user_data_machinetype']      = machinetypeName
+   substitutions['user_data_machine_hostname'] = hostName
+   substitutions['user_data_manager_version']  = versionString
+   substitutions['user_data_manager_hostname'] = os.uname()[1]
 
    if machinefeaturesURL:
-     userDataContents = userDataContents.replace('##user_data_machinefeatures_url##', machinefeaturesURL)
+     substitutions['user_data_machinefeatures_url'] = machinefeaturesURL
 
    if jobfeaturesURL:
-     userDataContents = userDataContents.replace('##user_data_jobfeatures_url##', jobfeaturesURL)
+     substitutions['user_data_jobfeatures_url'] = jobfeaturesURL
 
    if joboutputsURL:
-     userDataContents = userDataContents.replace('##user_data_joboutputs_url##', joboutputsURL)
+     substitutions['user_data_joboutputs_url'] = joboutputsURL
 
    if rootImageURL:
-     userDataContents = userDataContents.replace('##user_data_root_image_url##', rootImageURL)
+     substitutions['user_data_root_image_url'] = rootImageURL
 
    if heartbeatMachinesURL:
-     userDataContents = userDataContents.replace('##user_data_heartbeat_machines_url##', heartbeatMachinesURL)
+     substitutions['user_data_heartbeat_machines_url'] = heartbeatMachinesURL
 
    # Deprecated vmtype/VM/VMLM terminology
-   userDataContents = userDataContents.replace('##user_data_vmtype##',           machinetypeName)
-   userDataContents = userDataContents.replace('##user_data_vm_hostname##',      hostName)
-   userDataContents = userDataContents.replace('##user_data_vmlm_version##',     versionString)
-   userDataContents = userDataContents.replace('##user_data_vmlm_hostname##',    os.uname()[1])
+   substitutions['user_data_vmtype']        = machinetypeName
+   substitutions['user_data_vm_hostname']   = hostName
+   substitutions['user_data_vmlm_version']  = versionString
+   substitutions['user_data_vmlm_hostname'] = os.uname()[1]
 
    if uuidStr:
-     userDataContents = userDataContents.replace('##user_data_uuid##', uuidStr)
+     substitutions['user_data_uuid'] = uuidStr
+
+   # Site configurable substitutions for this machinetype
+   compiledFiles = {}
+
+   for oneOption, oneValue in options.iteritems():
+      if oneOption.startswith('user_data_option_'):
+        substitutions.setdefault(oneOption, oneValue)
+      elif oneOption.startswith('user_data_file_'):
+        if oneValue[0] == '/':
+          fileName = oneValue
+        else:
+          fileName = machinetypePath + '/files/' + oneValue
+
+        try:
+          compiledFiles[oneOption] = readTemplateFile(fileName)[1]
+        except:
+          raise VacutilsError('Failed to read ' + oneValue + ' for ' + oneOption)
 
    # Insert a proxy created from user_data_proxy_cert / user_data_proxy_key
    if 'user_data_proxy' in options and options['user_data_proxy'] == True:
@@ -280,41 +400,32 @@ def createUserData(shutdownTime, machinetypePath, options, versionString, spaceN
 
      try:
        if ('legacy_proxy' in options) and options['legacy_proxy']:
-         userDataContents = userDataContents.replace('##user_data_option_x509_proxy##',
-                              makeX509Proxy(certPath, keyPath, shutdownTime, isLegacyProxy=True))
+         substitutions['user_data_option_x509_proxy'] = makeX509Proxy(certPath, keyPath, shutdownTime, isLegacyProxy=True,
+                                                                      keyBits=proxyKeyBits, keyPool=keyPool)
        else:
-         userDataContents = userDataContents.replace('##user_data_option_x509_proxy##',
-                              makeX509Proxy(certPath, keyPath, shutdownTime, isLegacyProxy=False, cn=machinetypeName))
+         substitutions['user_data_option_x509_proxy'] = makeX509Proxy(certPath, keyPath, shutdownTime, isLegacyProxy=False, cn=machinetypeName,
+                                                                      keyBits=proxyKeyBits, keyPool=keyPool)
      except Exception as e:
        raise VacutilsError('Faled to make proxy (' + str(e) + ')')
 
-   # Site configurable substitutions for this machinetype
-   for oneOption, oneValue in options.iteritems():
-      if oneOption.startswith('user_data_option_'):
-        userDataContents = userDataContents.replace('##' + oneOption + '##', oneValue)
-      elif oneOption.startswith('user_data_file_'):
-        try:
-           if oneValue[0] == '/':
-             f = open(oneValue, 'r')
-           else:
-             f = open(machinetypePath + '/files/' + oneValue, 'r')
-
-           fileContents = f.read()
-           f.close()
+   # Patterns in the contents of user_data_file_ files are substituted and
+   # removed too, before the contents are inserted into the template
+   fileSubstitutions = {}
 
-           # deprecated: replace ##user_data_file_xxxx## with value
-           userDataContents = userDataContents.replace('##' + oneOption + '##', fileContents)
+   for oneOption in compiledFiles:
+     fileContents = renderUserDataTemplate(compiledFiles[oneOption], substitutions)
 
-           # new behaviour: replace ##user_data_option_xxxx## with value from user_data_file_xxxx
-           userDataContents = userDataContents.replace('##user_data_option_' + oneOption[15:] + '##', fileContents)
+     # deprecated: replace ##user_data_file_xxxx## with value
+     fileSubstitutions[oneOption] = fileContents
 
-        except:
-           raise VacutilsError('Failed to read ' + oneValue + ' for ' + oneOption)
+     # new behaviour: replace ##user_data_option_xxxx## with value from user_data_file_xxxx
+     fileSubstitutions.setdefault('user_data_option_' + oneOption[15:], fileContents)
 
-   # Remove any unused patterns from the template
-   userDataContents = re.sub('##user_data_[a-z,0-9,_]*##', '', userDataContents)
+   for name in fileSubstitutions:
+     substitutions.setdefault(name, fileSubstitutions[name])
 
-   return userDataContents
+   # One pass through the template, removing any unused patterns
+   return renderUserDataTemplate(compiled, substitutions)
 
 def emptyCallback1(p1):
    return
@@ -322,10 +433,61 @@ def emptyCallback1(p1):
 def emptyCallback2(p1, p2):
    return
 
-def makeX509Proxy(certPath, keyPath, expirationTime, isLegacyProxy=False, cn=None):
+def takePooledRsaKey(keyPool, keyBits):
+   # Return an RSA key of keyBits from the pool directory keyPool, removing 
+   # it so no one else uses it, or None if the pool is empty
+
+   poolDir = keyPool + '/' + str(keyBits)
+
+   try:
+     fileNames = os.listdir(poolDir)
+   except:
+     return None
+
+   for fileName in fileNames:
+     if not fileName.endswith('.pem'):
+       continue
+
+     # Only one process can succeed in renaming each key file
+     try:
+       os.rename(poolDir + '/' + fileName, poolDir + '/' + fileName + '.taken')
+     except:
+       continue
+
+     try:
+       return M2Crypto.RSA.load_key(poolDir + '/' + fileName + '.taken', emptyCallback1)
+     except Exception as e:
+       logLine('Failed to load pooled RSA key ' + fileName + ' (' + str(e) + ')')
+     finally:
+       os.remove(poolDir + '/' + fileName + '.taken')
+
+   return None
+
+def topUpRsaKeyPool(keyPool, keyBits, poolSize, tmpDir):
+   # Generate RSA keys of keyBits until there are poolSize in keyPool
+
+   poolDir = keyPool + '/' + str(keyBits)
+
+   try:
+     os.makedirs(poolDir, stat.S_IRUSR|stat.S_IWUSR|stat.S_IXUSR)
+   except:
+     pass
+
+   try:
+     numKeys = len([ fileName for fileName in os.listdir(poolDir) if fileName.endswith('.pem') ])
+   except Exception as e:
+     raise VacutilsError('Failed to list ' + poolDir + ' (' + str(e) + ')')
+
+   while numKeys < poolSize:
+     rsaKey = M2Crypto.RSA.gen_key(keyBits, 65537, emptyCallback2)
+     createFile(poolDir + '/' + str(uuid.uuid4()) + '.pem', rsaKey.as_pem(cipher = None), stat.S_IRUSR|stat.S_IWUSR, tmpDir)
+     numKeys += 1
+
+def makeX509Proxy(certPath, keyPath, expirationTime, isLegacyProxy=False, cn=None, keyBits=1024, keyPool=None):
    # Return a PEM-encoded limited proxy as a string in either Globus Legacy
    # or RFC 3820 format. Checks that the existing cert/proxy expires after
-   # the given expirationTime, but no other checks are done.
+   # the given expirationTime, but no other checks are done. If keyPool is
+   # given, the new key is taken from there if possible rather than generated.
 
    # First get the existing priviate key
 
@@ -360,8 +522,16 @@ def makeX509Proxy(certPath, keyPath, expirationTime, isLegacyProxy=False, cn=Non
 
    # Create the public/private keypair for the new proxy
 
+   newRsaKey = None
+
+   if keyPool:
+     newRsaKey = takePooledRsaKey(keyPool, keyBits)
+
+   if newRsaKey is None:
+     newRsaKey = M2Crypto.RSA.gen_key(keyBits, 65537, emptyCallback2)
+
    newKey = M2Crypto.EVP.PKey()
-   newKey.assign_rsa(M2Crypto.RSA.gen_key(1024, 65537, emptyCallback2))
+   newKey.assign_rsa(newRsaKey)
 
    # Start filling in the new certificate object
 
@@ -476,9 +646,20 @@ def getCernvmImageData(fileName):
      return data
 
    try:
+     # Hash in chunks rather than reading multi-GB images into memory
      f.seek(0, os.SEEK_SET)
-     digestableImage = f.read(length - 32 * 1024)
-     hash = hashlib.sha256(digestableImage)
+     hash = hashlib.sha256()
+     remaining = length - 32 * 1024
+
+     while remaining > 0:
+       chunk = f.read(min(remaining, 1024 * 1024))
+
+       if not chunk:
+         raise VacutilsError('Unexpected end of file')
+
+       hash.update(chunk)
+       remaining -= len(chunk)
+
      digest = hash.digest()
    except Exception as e:
      logLine('Failed to make digest of CernVM image (' + str(e) + ')')
@@ -524,18 +705,26 @@ def getCernvmImageData(fileName):
    return data
 
 def getRemoteRootImage(url, imageCache, tmpDir, versionString):
+   return getRemoteFile(url, imageCache, tmpDir, versionString)
+
+def getRemoteFile(url, imageCache, tmpDir, versionString, requireLastModified = True, timeout = 120):
+   # Fetch url into the cache directory imageCache if it has changed, and return
+   # the file name of the cached copy
 
    try:
      f, tempName = tempfile.mkstemp(prefix = 'tmp', dir = tmpDir)
    except Exception as e:
-     VacutilsError('Failed to create temporary image file in ' + tmpDir)
+     raise VacutilsError('Failed to create temporary file in ' + tmpDir)
 
    ff = os.fdopen(f, 'wb')
 
+   responseHeaders = []
+
    c = pycurl.Curl()
    c.setopt(c.USERAGENT, versionString)
    c.setopt(c.URL, url)
    c.setopt(c.WRITEDATA, ff)
+   c.setopt(c.HEADERFUNCTION, responseHeaders.append)
 
    urlEncoded = urllib.quote(url,'')
 
@@ -546,8 +735,14 @@ def getRemoteRootImage(url, imageCache, tmpDir, versionString):
      c.setopt(c.TIMECONDITION, c.TIMECONDITION_IFMODSINCE)
    except:
      pass
+   else:
+     # If we have the ETag of the existing file, the server can check that too
+     try:
+       c.setopt(c.HTTPHEADER, [ 'If-None-Match: ' + open(imageCache + '/' + urlEncoded + '.etag').read().strip() ])
+     except:
+       pass
 
-   c.setopt(c.TIMEOUT, 120)
+   c.setopt(c.TIMEOUT, timeout)
 
    # You will thank me for following redirects one day :)
    c.setopt(c.FOLLOWLOCATION, 1)
@@ -573,12 +768,13 @@ def getRemoteRootImage(url, imageCache, tmpDir, versionString):
      try:
        lastModified = float(c.getinfo(c.INFO_FILETIME))
      except:
-       # We fail rather than use a server that doesn't give Last-Modified:
-       raise VacutilsError('Failed to get last modified time for ' + url)
+       lastModified = -1.0
 
      if lastModified < 0.0:
-       # We fail rather than use a server that doesn't give Last-Modified:
-       raise VacutilsError('Failed to get last modified time for ' + url)
+       if requireLastModified:
+         # We fail rather than use a server that doesn't give Last-Modified:
+         os.remove(tempName)
+         raise VacutilsError('Failed to get last modified time for ' + url)
      else:
        # We set mtime to Last-Modified: in case our system clock is very wrong, to prevent
        # continually downloading the image based on our faulty filesystem timestamps
@@ -592,11 +788,28 @@ def getRemoteRootImage(url, imageCache, tmpDir, versionString):
        except:
          pass
 
-       raise VacutilsError('Failed renaming new image ' + imageCache + '/' + urlEncoded)
+       raise VacutilsError('Failed renaming new file ' + imageCache + '/' + urlEncoded)
+
+     # Keep the ETag from the final response, if any, for the next conditional GET
+     eTag = None
+     for header in responseHeaders:
+       if header.lower().startswith('etag:'):
+         eTag = header[5:].strip()
+       elif header.startswith('HTTP/'):
+         eTag = None
+
+     try:
+       if eTag:
+         createFile(imageCache + '/' + urlEncoded + '.etag', eTag + '\n', stat.S_IRUSR|stat.S_IWUSR|stat.S_IRGRP|stat.S_IROTH, tmpDir)
+       elif os.path.exists(imageCache + '/' + urlEncoded + '.etag'):
+         os.remove(imageCache + '/' + urlEncoded + '.etag')
+     except:
+       pass
 
      logLine('New ' + url + ' put in ' + imageCache)
 
    else:
+     os.remove(tempName)
      logLine('No new version of ' + url + ' found and existing copy not replaced')
 
    c.close()